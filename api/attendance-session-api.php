@@ -8,6 +8,7 @@
 require_once __DIR__ . "/../config.php";
 require_once __DIR__ . "/../session_check.php";
 require_once __DIR__ . "/../cache_utils.php";
+require_once __DIR__ . "/../face_recognition_utils.php";
 session_start();
 
 // Ensure user is logged in and is lecturer, hod, or admin
@@ -580,6 +581,7 @@ function handleStartSession(PDO $pdo): array {
         ");
         $stmt->execute([$existing_session['id']]);
         error_log("Ended existing session ID: " . $existing_session['id'] . " to start new session");
+        notifyFaceRecognitionService('/session/end', ['session_id' => $existing_session['id']]);
     }
 
     // Start transaction
@@ -618,6 +620,9 @@ function handleStartSession(PDO $pdo): array {
 
         $pdo->commit();
 
+        // Warm the session roster in the face recognition service
+        notifyFaceRecognitionService('/session/start', ['session_id' => $session_id]);
+
         return [
             'status' => 'success',
             'message' => 'Attendance session started successfully',
@@ -661,6 +666,9 @@ function handleEndSession(PDO $pdo): array {
     ");
     $stmt->execute([$session_id]);
 
+    // Free the session roster in the face recognition service
+    notifyFaceRecognitionService('/session/end', ['session_id' => $session_id]);
+
     // Get session statistics
     $stmt = $pdo->prepare("
         SELECT
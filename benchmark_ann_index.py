@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Recall vs latency of the optional ANN index in face_recognition_service.py
+
+Builds synthetic galleries (identities spread like face encodings, a few
+templates each), then matches probes of enrolled identities with exact
+search and through the IVF index at several nprobe settings.
+
+Usage: python benchmark_ann_index.py [--sizes 10000,50000,200000] [--nprobe 1,2,4,8,16,32]
+                                     [--probes 200] [--templates-per-student 5] [--json results.json]
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import face_recognition_service as service
+
+GROUPS = 64  # Clusters of similar-looking identities, so partitions are not trivially separable
+GROUP_SPREAD = 0.045  # Per-dimension std of group centres
+INTER_PERSON_SPREAD = 0.04  # Per-dimension std of identities around their group (~0.65 apart within a group)
+INTRA_PERSON_SPREAD = 0.02  # Per-dimension std of one person's captures (~0.3 apart)
+
+def synthetic_gallery(students, templates_per_student, rng):
+    """FaceGallery of random identities, plus their centres for drawing probes"""
+    groups = rng.normal(0, GROUP_SPREAD, (GROUPS, service.ENCODING_DIM))
+    centres = groups[rng.integers(0, GROUPS, students)] + rng.normal(0, INTER_PERSON_SPREAD, (students, service.ENCODING_DIM))
+    encodings = {}
+    for student_id, centre in enumerate(centres, start=1):
+        rows = centre + rng.normal(0, INTRA_PERSON_SPREAD, (templates_per_student, service.ENCODING_DIM))
+        encodings[student_id] = {
+            'student_id': student_id,
+            'reg_no': f'REG{student_id:06d}',
+            'name': f'Student {student_id}',
+            'all_encodings': [row.astype(np.float32) for row in rows]
+        }
+    return service.FaceGallery(encodings), centres
+
+def timed_matches(gallery, probes):
+    """(ranked results, per-probe latencies in ms)"""
+    results, latencies = [], []
+    for probe in probes:
+        start = time.perf_counter()
+        results.append(gallery.match(probe))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+def benchmark(size, nprobes, probe_count, templates_per_student, seed=0):
+    rng = np.random.default_rng(seed)
+    gallery, centres = synthetic_gallery(size // templates_per_student, templates_per_student, rng)
+    owners = rng.integers(0, len(centres), probe_count)
+    probes = centres[owners] + rng.normal(0, INTRA_PERSON_SPREAD, (probe_count, service.ENCODING_DIM))
+
+    exact, exact_ms = timed_matches(gallery, probes)
+
+    build_start = time.perf_counter()
+    gallery.ann = service.IVFIndex(gallery)
+    build_ms = (time.perf_counter() - build_start) * 1000
+
+    rows = []
+    for nprobe in nprobes:
+        gallery.ann.nprobe = nprobe
+        before = dict(service.ann_stats)
+        approximate, ann_ms = timed_matches(gallery, probes)
+        fallbacks = service.ann_stats['exact_fallbacks'] - before['exact_fallbacks']
+
+        # Index-only answers, without the exact fallback, show what the index itself finds
+        index_hits = sum(1 for probe, truth in zip(probes, exact)
+                         if gallery.ann_match(probe, 3, fallback=False)[:1] == truth[:1])
+        rows.append({
+            'templates': gallery.template_count,
+            'partitions': gallery.ann.nlist,
+            'nprobe': nprobe,
+            'recall_at_1': round(sum(a[0][0] == e[0][0] for a, e in zip(approximate, exact)) / probe_count, 4),
+            'index_recall_at_1': round(index_hits / probe_count, 4),
+            'exact_fallback_rate': round(fallbacks / probe_count, 4),
+            'p50_ms': round(float(np.percentile(ann_ms, 50)), 3),
+            'p95_ms': round(float(np.percentile(ann_ms, 95)), 3),
+            'exact_p50_ms': round(float(np.percentile(exact_ms, 50)), 3),
+            'build_ms': round(build_ms, 1)
+        })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall vs latency of the gallery ANN index')
+    parser.add_argument('--sizes', default='10000,50000,200000')
+    parser.add_argument('--nprobe', default='1,2,4,8,16,32')
+    parser.add_argument('--probes', type=int, default=200)
+    parser.add_argument('--templates-per-student', type=int, default=5)
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    nprobes = [int(n) for n in args.nprobe.split(',')]
+    results = []
+    print(f"{'templates':>9} {'lists':>5} {'nprobe':>6} {'recall@1':>8} {'index@1':>8} "
+          f"{'fallback':>8} {'p50 ms':>8} {'p95 ms':>8} {'exact ms':>8}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        for row in benchmark(size, nprobes, args.probes, args.templates_per_student):
+            results.append(row)
+            print(f"{row['templates']:>9} {row['partitions']:>5} {row['nprobe']:>6} {row['recall_at_1']:>8.3f} "
+                  f"{row['index_recall_at_1']:>8.3f} {row['exact_fallback_rate']:>8.3f} {row['p50_ms']:>8.2f} "
+                  f"{row['p95_ms']:>8.2f} {row['exact_p50_ms']:>8.2f}")
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -86,6 +86,7 @@ try {
                 INDEX idx_status (status),
                 INDEX idx_method (method),
                 INDEX idx_recorded_at (recorded_at),
+                UNIQUE KEY uq_attendance_session_student (session_id, student_id),
                 FOREIGN KEY (session_id) REFERENCES attendance_sessions(id) ON DELETE CASCADE,
                 FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
@@ -1,12 +1,10 @@
 from flask import Flask, render_template, request, jsonify
 import os
 import cv2
-# try:
-#     import face_recognition
-#     print("Face recognition imported successfully")
-# except Exception as e:
-#     print(f"Failed to import face_recognition: {e}")
-#     exit(1)
+import tempfile
+import threading
+import time
+import face_recognition
 import numpy as np
 from datetime import datetime
 
@@ -16,19 +14,122 @@ DATASET_DIR = 'dataset'
 if not os.path.exists(DATASET_DIR):
     os.makedirs(DATASET_DIR)
 
+ENCODINGS_FILE = os.path.join(DATASET_DIR, 'encodings.npz')  # Encodings persisted next to the images
+WATCH_INTERVAL = 2  # Seconds between scans of the dataset directory
+
+# In-memory gallery: one row per image with a face. /check reads the
+# (matrix, names) pair without locking; updates swap in a new pair.
+known_files = {}  # filename -> (mtime, size, encoding or None when no face was found)
+known_gallery = (np.empty((0, 128)), [])
+sync_lock = threading.Lock()
+gallery_lock = threading.Lock()
+gallery_started = False
+
 # --- Helper functions ---
-def load_known_faces():
-    known_faces = []
-    known_names = []
-    for file in os.listdir(DATASET_DIR):
-        if file.endswith((".jpg", ".png")):
-            path = os.path.join(DATASET_DIR, file)
-            image = face_recognition.load_image_file(path)
-            encoding = face_recognition.face_encodings(image)
-            if encoding:
-                known_faces.append(encoding[0])
-                known_names.append(file.split("_")[0])
-    return known_faces, known_names
+def is_image(file):
+    return file.endswith((".jpg", ".png"))
+
+def encode_file(path):
+    image = face_recognition.load_image_file(path)
+    encoding = face_recognition.face_encodings(image)
+    return encoding[0] if encoding else None
+
+def load_encodings():
+    """Read the persisted encodings; entries are re-checked against the files on the next sync"""
+    if not os.path.exists(ENCODINGS_FILE):
+        return
+    try:
+        with np.load(ENCODINGS_FILE) as data:
+            for file, mtime, size, encoding, has_face in zip(data['files'], data['mtimes'], data['sizes'],
+                                                             data['encodings'], data['has_face']):
+                known_files[str(file)] = (float(mtime), int(size), encoding if has_face else None)
+    except Exception as e:
+        print(f"Ignoring unreadable {ENCODINGS_FILE}: {e}")
+        known_files.clear()
+
+def save_encodings():
+    files = sorted(known_files)
+    entries = [known_files[file] for file in files]
+    # A unique temp file in the same directory, so concurrent writers never share one
+    fd, temp_path = tempfile.mkstemp(prefix='encodings.', suffix='.tmp', dir=DATASET_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f,
+                     files=np.array(files, dtype=str),
+                     mtimes=np.array([mtime for mtime, _, _ in entries], dtype=np.float64),
+                     sizes=np.array([size for _, size, _ in entries], dtype=np.int64),
+                     encodings=np.array([enc if enc is not None else np.zeros(128) for _, _, enc in entries]).reshape(-1, 128),
+                     has_face=np.array([enc is not None for _, _, enc in entries], dtype=bool))
+        os.replace(temp_path, ENCODINGS_FILE)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def publish_gallery():
+    global known_gallery
+    files = sorted(file for file, (_, _, enc) in known_files.items() if enc is not None)
+    matrix = np.array([known_files[file][2] for file in files]).reshape(-1, 128)
+    known_gallery = (matrix, [file.split("_")[0] for file in files])
+
+def sync_known_faces(only=None):
+    """
+    Bring the gallery in line with the dataset directory: encode new or
+    changed images, drop removed ones. `only` limits the scan to the given
+    filenames (used by /register). Returns the number of changed entries.
+    """
+    with sync_lock:
+        present = {}
+        for entry in os.scandir(DATASET_DIR):
+            if is_image(entry.name) and (only is None or entry.name in only):
+                stat = entry.stat()
+                present[entry.name] = (stat.st_mtime, stat.st_size)
+
+        changed = 0
+        for file, (mtime, size) in present.items():
+            known = known_files.get(file)
+            if known is None or known[:2] != (mtime, size):
+                try:
+                    known_files[file] = (mtime, size, encode_file(os.path.join(DATASET_DIR, file)))
+                except Exception as e:
+                    print(f"Could not encode {file}: {e}")
+                    continue
+                changed += 1
+        if only is None:
+            for file in [file for file in known_files if file not in present]:
+                del known_files[file]
+                changed += 1
+
+        if changed:
+            publish_gallery()
+            save_encodings()
+        return changed
+
+def watch_dataset():
+    """Pick up images added, replaced or removed outside the app"""
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        try:
+            changed = sync_known_faces()
+            if changed:
+                print(f"Dataset changed: {changed} images updated, {len(known_gallery[1])} faces known")
+        except Exception as e:
+            print(f"Dataset scan failed: {e}")
+
+def start_gallery():
+    load_encodings()
+    sync_known_faces()
+    publish_gallery()
+    threading.Thread(target=watch_dataset, name='dataset-watcher', daemon=True).start()
+
+def ensure_gallery():
+    """Start the gallery once, on first use, in whichever process serves requests"""
+    global gallery_started
+    if gallery_started:
+        return
+    with gallery_lock:
+        if not gallery_started:
+            start_gallery()
+            gallery_started = True
 
 def mark_attendance(name):
     with open("attendance.csv", "a") as f:
@@ -50,8 +151,13 @@ def register_student():
     file = request.files['image']
 
     if name and file:
-        filepath = os.path.join(DATASET_DIR, f"{name}_{datetime.now().strftime('%H%M%S')}.jpg")
-        file.save(filepath)
+        ensure_gallery()
+        filename = f"{name}_{datetime.now().strftime('%H%M%S')}.jpg"
+        file.save(os.path.join(DATASET_DIR, filename))
+        # Encode now so the student can be checked straight away
+        sync_known_faces(only={filename})
+        if known_files.get(filename, (None, None, None))[2] is None:
+            return jsonify({"status": "success", "message": f"{name} registered, but no face was detected in the image"})
         return jsonify({"status": "success", "message": f"{name} registered successfully"})
     return jsonify({"status": "error", "message": "Missing name or image"})
 
@@ -61,20 +167,20 @@ def check_attendance():
     if not file:
         return jsonify({"status": "error", "message": "No image uploaded"})
 
-    # Save temp frame
-    file.save("temp.jpg")
-    test_img = face_recognition.load_image_file("temp.jpg")
+    test_img = face_recognition.load_image_file(file)
     test_encodings = face_recognition.face_encodings(test_img)
 
     if not test_encodings:
         return jsonify({"status": "error", "message": "No face detected"})
 
     test_encoding = test_encodings[0]
-    known_faces, known_names = load_known_faces()
+    ensure_gallery()
+    known_faces, known_names = known_gallery
 
-    if not known_faces:
+    if not known_names:
         return jsonify({"status": "error", "message": "No registered students"})
 
+    # One vectorized distance computation over the whole gallery
     face_distances = face_recognition.face_distance(known_faces, test_encoding)
     best_match = np.argmin(face_distances)
 
@@ -86,4 +192,9 @@ def check_attendance():
         return jsonify({"status": "error", "message": "Unknown face"})
 
 if __name__ == '__main__':
+    # With debug=True the reloader runs this file in a watcher process and again in
+    # the serving child; warm the gallery up front only in the child. Under other
+    # servers it starts on the first request.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ensure_gallery()
     app.run(debug=True)
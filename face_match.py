@@ -2,104 +2,367 @@
 """
 Face Recognition Script for RP Attendance System
 Simplified version that compares a captured image with stored student photos
+
+Run with --daemon to keep the models and the encoded gallery warm behind a
+local Unix socket; the normal CLI then forwards each image to the daemon and
+only does the work in-process when no daemon is running.
 """
 
 import sys
 import os
-import face_recognition
-import pymysql
+import io
+import stat
+import tempfile
 import json
+import time
+import struct
+import socket
+import threading
+import socketserver
+
+# face_recognition (dlib), numpy and pymysql are imported where they are used,
+# so the thin client that forwards to a running daemon starts instantly
+
+DB_CONFIG = {
+    'host': 'localhost',
+    'user': 'root',
+    'password': '',
+    'database': 'rp_attendance_system'
+}
+
+# The socket lives in a directory only the daemon's user (and group) can enter
+SOCKET_PATH = os.getenv('FACE_MATCH_SOCKET', os.path.join(tempfile.gettempdir(), 'rp-face-match', 'face_match.sock'))
+SOCKET_DIR_MODE = 0o750
+SOCKET_MODE = 0o660  # Owner and group; clients only trust a daemon run as their own user
+MAX_REQUEST_BYTES = 10 * 1024 * 1024  # Same 10MB image limit as the recognition service
+GALLERY_REFRESH = 60  # Seconds between checks of student_photos in daemon mode
+CLIENT_TIMEOUT = 30  # Seconds the CLI waits for a daemon reply
+
+# Binary protocol: request = magic, version, payload length + raw image bytes;
+# reply = payload length + UTF-8 JSON
+REQUEST_HEADER = struct.Struct('<4sBI')
+REPLY_HEADER = struct.Struct('<I')
+PROTOCOL_MAGIC = b'RPFM'
+PROTOCOL_VERSION = 1
+
+def encode_live_image(image):
+    """Encode the captured face(s)"""
+    import face_recognition
+    return face_recognition.face_encodings(image, model='large', num_jitters=10)
+
+def encode_stored_photo(photo_path):
+    """Encode a stored student photo, or return None if no face is found"""
+    import face_recognition
+    stored_image = face_recognition.load_image_file(photo_path)
+    stored_encodings = face_recognition.face_encodings(stored_image, model='small', num_jitters=1)
+    return stored_encodings[0] if stored_encodings else None
+
+def fetch_primary_photos(cursor):
+    """All primary student photos"""
+    cursor.execute("SELECT student_id, photo_path FROM student_photos WHERE is_primary = 1")
+    return cursor.fetchall()
+
+def build_gallery(photos, encode=encode_stored_photo):
+    """Encode the existing photos, returning (student ids, encodings) in query order"""
+    student_ids = []
+    encodings = []
+    for student_id, photo_path in photos:
+        if photo_path and os.path.exists(photo_path):
+            try:
+                encoding = encode(photo_path)
+                if encoding is not None:
+                    student_ids.append(student_id)
+                    encodings.append(encoding)
+            except Exception as e:
+                continue  # Skip bad images
+    return student_ids, encodings
+
+def match_encodings(cursor, live_encodings, student_ids, encodings, stored_count):
+    """Pick the best gallery match for the live face and build the JSON result"""
+    import face_recognition
+    import numpy as np
+
+    live_encoding = live_encodings[0]
+
+    best_match = None
+    best_distance = 1.0  # Max distance for match
+
+    if encodings:
+        distances = face_recognition.face_distance(encodings, live_encoding)
+        best_index = int(np.argmin(distances))
+        if distances[best_index] < best_distance:  # Find best match
+            best_distance = distances[best_index]
+            best_match = student_ids[best_index]
+
+    # Get student details if match found
+    student_info = None
+    if best_match:
+        cursor.execute("SELECT id, reg_no, first_name, last_name FROM students WHERE id = %s", (best_match,))
+        student_data = cursor.fetchone()
+        if student_data:
+            student_info = {
+                "student_id": student_data[0],
+                "reg_no": student_data[1],
+                "name": f"{student_data[2]} {student_data[3]}"
+            }
+
+    if best_match and student_info:
+        confidence = round((1 - best_distance) * 100, 1)
+        return {
+            "status": "success",
+            "student_id": student_info["student_id"],
+            "student_name": student_info["name"],
+            "student_reg": student_info["reg_no"],
+            "distance": round(best_distance, 4),
+            "confidence": confidence,
+            "live_faces": len(live_encodings),
+            "stored_count": stored_count
+        }
+    else:
+        return {
+            "status": "no_match",
+            "message": "No matching face found in database",
+            "live_faces": len(live_encodings),
+            "stored_count": stored_count
+        }
 
 def match_face(live_image_path):
     """Match face from live image with stored student photos"""
+    import face_recognition
+    import pymysql
+
     # Load live image
     try:
         live_image = face_recognition.load_image_file(live_image_path)
-        live_encodings = face_recognition.face_encodings(live_image, model='large', num_jitters=10)
+        live_encodings = encode_live_image(live_image)
         if not live_encodings:
             return {"status": "error", "message": "No face detected in live image"}
-        live_encoding = live_encodings[0]
     except Exception as e:
         return {"status": "error", "message": f"Error loading live image: {str(e)}"}
 
     # Database connection
     try:
-        conn = pymysql.connect(
-            host='localhost',
-            user='root',
-            password='',
-            database='rp_attendance_system'
-        )
+        conn = pymysql.connect(**DB_CONFIG)
         cursor = conn.cursor()
     except Exception as e:
         return {"status": "error", "message": f"Database connection failed: {str(e)}"}
 
     try:
         # Get all student photos
-        cursor.execute("SELECT student_id, photo_path FROM student_photos WHERE is_primary = 1")
-        photos = cursor.fetchall()
-
-        best_match = None
-        best_distance = 1.0  # Max distance for match
-
-        for student_id, photo_path in photos:
-            if photo_path and os.path.exists(photo_path):
-                try:
-                    stored_image = face_recognition.load_image_file(photo_path)
-                    stored_encodings = face_recognition.face_encodings(stored_image, model='small', num_jitters=1)
-                    if stored_encodings:
-                        distance = face_recognition.face_distance([stored_encodings[0]], live_encoding)[0]
-                        if distance < best_distance:  # Find best match
-                            best_distance = distance
-                            best_match = student_id
-                except Exception as e:
-                    continue  # Skip bad images
-
-        # Get student details if match found
-        student_info = None
-        if best_match:
-            cursor.execute("SELECT id, reg_no, first_name, last_name FROM students WHERE id = %s", (best_match,))
-            student_data = cursor.fetchone()
-            if student_data:
-                student_info = {
-                    "student_id": student_data[0],
-                    "reg_no": student_data[1],
-                    "name": f"{student_data[2]} {student_data[3]}"
-                }
+        photos = fetch_primary_photos(cursor)
+        student_ids, encodings = build_gallery(photos)
+        result = match_encodings(cursor, live_encodings, student_ids, encodings, len(photos))
 
         cursor.close()
         conn.close()
-
-        if best_match and student_info:
-            confidence = round((1 - best_distance) * 100, 1)
-            return {
-                "status": "success",
-                "student_id": student_info["student_id"],
-                "student_name": student_info["name"],
-                "student_reg": student_info["reg_no"],
-                "distance": round(best_distance, 4),
-                "confidence": confidence,
-                "live_faces": len(live_encodings),
-                "stored_count": len(photos)
-            }
-        else:
-            return {
-                "status": "no_match",
-                "message": "No matching face found in database",
-                "live_faces": len(live_encodings),
-                "stored_count": len(photos)
-            }
+        return result
 
     except Exception as e:
         cursor.close()
         conn.close()
         return {"status": "error", "message": f"Face matching error: {str(e)}"}
 
+class WarmGallery:
+    """
+    Encoded primary photos kept in memory by the daemon. Photos are keyed by
+    path, size and mtime, so a refresh only encodes new or changed files.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conn = None
+        self.encoded = {}  # photo_path -> ((size, mtime_ns), encoding or None)
+        self.student_ids = []
+        self.encodings = []
+        self.stored_count = 0
+        self.refreshed_at = 0
+
+    def cursor(self):
+        """Cursor on the daemon's persistent connection, reconnecting if it dropped"""
+        import pymysql
+
+        if self.conn is None:
+            self.conn = pymysql.connect(**DB_CONFIG)
+        else:
+            self.conn.ping(reconnect=True)
+        return self.conn.cursor()
+
+    def encode_cached(self, photo_path):
+        stat_result = os.stat(photo_path)
+        key = (stat_result.st_size, stat_result.st_mtime_ns)
+        cached = self.encoded.get(photo_path)
+        if cached and cached[0] == key:
+            return cached[1]
+        encoding = encode_stored_photo(photo_path)
+        self.encoded[photo_path] = (key, encoding)
+        return encoding
+
+    def refresh(self, cursor):
+        """Re-read student_photos at most every GALLERY_REFRESH seconds"""
+        if time.time() - self.refreshed_at < GALLERY_REFRESH:
+            return
+        photos = fetch_primary_photos(cursor)
+        self.student_ids, self.encodings = build_gallery(photos, self.encode_cached)
+        self.stored_count = len(photos)
+        self.refreshed_at = time.time()
+
+    def match(self, image_bytes):
+        import face_recognition
+
+        try:
+            live_image = face_recognition.load_image_file(io.BytesIO(image_bytes))
+            live_encodings = encode_live_image(live_image)
+            if not live_encodings:
+                return {"status": "error", "message": "No face detected in live image"}
+        except Exception as e:
+            return {"status": "error", "message": f"Error loading live image: {str(e)}"}
+
+        with self.lock:
+            try:
+                cursor = self.cursor()
+            except Exception as e:
+                self.conn = None
+                return {"status": "error", "message": f"Database connection failed: {str(e)}"}
+
+            try:
+                self.refresh(cursor)
+                return match_encodings(cursor, live_encodings, self.student_ids, self.encodings, self.stored_count)
+            except Exception as e:
+                return {"status": "error", "message": f"Face matching error: {str(e)}"}
+            finally:
+                cursor.close()
+
+def recv_exact(sock, size):
+    """Read exactly size bytes or raise ConnectionError"""
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-message")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+class MatchRequestHandler(socketserver.BaseRequestHandler):
+    """One binary request and one JSON reply per connection"""
+
+    def handle(self):
+        try:
+            magic, version, length = REQUEST_HEADER.unpack(recv_exact(self.request, REQUEST_HEADER.size))
+            if magic != PROTOCOL_MAGIC or version != PROTOCOL_VERSION:
+                result = {"status": "error", "message": "Unsupported face match request"}
+            elif length > MAX_REQUEST_BYTES:
+                # Answer before reading the body, so a bad length cannot make us allocate it
+                result = {"status": "error",
+                          "message": f"Image too large ({length} bytes, limit {MAX_REQUEST_BYTES})"}
+            else:
+                result = self.server.gallery.match(recv_exact(self.request, length))
+        except ConnectionError:
+            return
+
+        body = json.dumps(result).encode('utf-8')
+        self.request.sendall(REPLY_HEADER.pack(len(body)) + body)
+
+class MatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def check_socket_dir(socket_dir):
+    """Refuse a socket directory another user owns or others can write to"""
+    dir_stat = os.lstat(socket_dir)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid():
+        raise PermissionError(f"{socket_dir} is not a directory owned by this user")
+    if dir_stat.st_mode & 0o022:
+        raise PermissionError(f"{socket_dir} is writable by other users")
+
+def private_socket_dir(socket_path):
+    """Create the socket's directory and check it is private to this user"""
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(socket_dir, mode=SOCKET_DIR_MODE, exist_ok=True)
+    check_socket_dir(socket_dir)
+    return socket_dir
+
+def run_daemon(socket_path=SOCKET_PATH):
+    """Serve match requests on a Unix socket with a warm gallery"""
+    private_socket_dir(socket_path)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    # Bind with the final permissions so the socket is never reachable by others
+    previous_umask = os.umask(0o777 & ~SOCKET_MODE)
+    try:
+        server = MatchServer(socket_path, MatchRequestHandler)
+    finally:
+        os.umask(previous_umask)
+    server.gallery = WarmGallery()
+    os.chmod(socket_path, SOCKET_MODE)
+
+    # Encode the gallery before the first frame arrives
+    with server.gallery.lock:
+        cursor = server.gallery.cursor()
+        server.gallery.refresh(cursor)
+        cursor.close()
+
+    print(json.dumps({"status": "ready", "socket": socket_path, "stored_count": server.gallery.stored_count}))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def request_daemon(live_image_path, socket_path=SOCKET_PATH):
+    """
+    Forward an image to a running daemon; None means no daemon is listening,
+    or the socket is not one this user's daemon created, so it is not trusted.
+    Once a daemon has taken the request, a timeout or dropped connection is
+    reported as an error rather than retried in-process.
+    """
+    try:
+        check_socket_dir(os.path.dirname(os.path.abspath(socket_path)))
+        socket_stat = os.lstat(socket_path)
+    except OSError:
+        # Missing, or a directory another user could have planted
+        return None
+    if not stat.S_ISSOCK(socket_stat.st_mode) or socket_stat.st_uid != os.getuid():
+        return None
+
+    try:
+        with open(live_image_path, 'rb') as f:
+            image_bytes = f.read()
+    except Exception as e:
+        return {"status": "error", "message": f"Error loading live image: {str(e)}"}
+
+    if len(image_bytes) > MAX_REQUEST_BYTES:
+        return {"status": "error", "message": f"Image too large ({len(image_bytes)} bytes, limit {MAX_REQUEST_BYTES})"}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CLIENT_TIMEOUT)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            # Stale socket file or no daemon behind it
+            return None
+
+        try:
+            sock.sendall(REQUEST_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, len(image_bytes)) + image_bytes)
+            (length,) = REPLY_HEADER.unpack(recv_exact(sock, REPLY_HEADER.size))
+            return json.loads(recv_exact(sock, length).decode('utf-8'))
+        except socket.timeout:
+            return {"status": "error", "message": f"Face match daemon did not answer within {CLIENT_TIMEOUT}s"}
+        except (OSError, ValueError) as e:
+            return {"status": "error", "message": f"Face match daemon failed: {str(e)}"}
+
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == '--daemon':
+        run_daemon(sys.argv[2] if len(sys.argv) > 2 else SOCKET_PATH)
+        sys.exit(0)
+
     if len(sys.argv) != 2:
-        print(json.dumps({"status": "error", "message": "Usage: python face_match.py <live_image_path>"}))
+        print(json.dumps({"status": "error", "message": "Usage: python face_match.py <live_image_path> | --daemon [socket_path]"}))
         sys.exit(1)
 
     live_image_path = sys.argv[1]
-    result = match_face(live_image_path)
-    print(json.dumps(result))
\ No newline at end of file
+    result = request_daemon(live_image_path)
+    if result is None:
+        result = match_face(live_image_path)
+    print(json.dumps(result))
@@ -10,13 +10,30 @@ import json
 import base64
 import tempfile
 import logging
+import hashlib
+import struct
+import mmap
+import signal
+import socket
+import glob
+import atexit
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+try:
+    from flask_sock import Sock, ConnectionClosed
+except ImportError:  # /stream is only available with flask-sock installed
+    Sock = None
 import face_recognition
 import numpy as np
 from PIL import Image
 import io
 import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 
 # Configure logging
@@ -44,129 +61,2009 @@ class Config:
     MIN_FACE_RATIO = 0.05  # Minimum face size as percentage of image (5%)
     CENTER_TOLERANCE = 0.3  # Maximum allowed face offset from center (30%)
     CONFIDENCE_MARGIN = 0.15  # Minimum confidence difference from second best match (15%)
-    NUM_JITTERS = 3  # Number of times to jitter image for better encoding
+    NUM_JITTERS = 3  # Number of times to jitter image for better encoding (ambiguous matches)
+    FAST_NUM_JITTERS = 1  # Jitters for the first, cheap encoding pass
+    CASCADE_BOUNDARY_BAND = 0.05  # Re-encode when confidence is this close to CONFIDENCE_THRESHOLD_MEDIUM
     UPSAMPLE_FACTOR = 1  # How many times to upsample image for face detection
+    DETECTION_MAX_DIMENSION = int(os.getenv('FACE_DETECTION_MAX_DIM', 640))  # Longest side used for detection (0 = full resolution)
+    DECODE_MAX_DIMENSION = int(os.getenv('FACE_DECODE_MAX_DIM', 1280))  # JPEGs are draft-decoded down to about this size (0 = full size)
+    BATCH_MAX_SIZE = int(os.getenv('FACE_BATCH_MAX_SIZE', 8))  # Frames recognized together
+    BATCH_MAX_WAIT_MS = float(os.getenv('FACE_BATCH_MAX_WAIT_MS', 15))  # Wait for a batch to fill after its first frame
+    BATCH_QUEUE_SIZE = int(os.getenv('FACE_BATCH_QUEUE', 32))  # Queued frames before /recognize answers 429
+    BATCH_WORKERS = int(os.getenv('FACE_BATCH_WORKERS', 1))  # Threads running batches
+    BATCH_RESULT_TIMEOUT = 60  # Seconds a request waits for its batch
+    GROUP_DECODE_MAX_DIMENSION = int(os.getenv('FACE_GROUP_DECODE_MAX_DIM', 2560))  # Group photos keep more resolution
+    GROUP_DETECTION_MAX_DIMENSION = int(os.getenv('FACE_GROUP_DETECTION_MAX_DIM', 1600))  # Longest side used for group detection
+    GROUP_MIN_FACE_SIZE = 40  # Smallest face side (full-resolution pixels) matched in a group photo
+    GROUP_MAX_FACES = 100  # Faces matched per group photo
+    RESPONSE_TIMINGS = os.getenv('FACE_RESPONSE_TIMINGS', 'false').lower() == 'true'  # Per-stage timings in every /recognize response
+    ENROLL_WORKERS = int(os.getenv('FACE_ENROLL_WORKERS', os.cpu_count() or 1))  # Processes encoding photos on cold/bulk loads
+    ENROLL_STAT_THREADS = int(os.getenv('FACE_ENROLL_STAT_THREADS', 16))  # Threads stat-ing photo files
+    ENROLL_POOL_MIN_IMAGES = 8  # Fewer images to encode than this are encoded in-thread
+    WRITE_BEHIND = os.getenv('FACE_WRITE_BEHIND', 'false').lower() == 'true'  # Record attendance and audit rows from /recognize
+    WRITE_BATCH_SIZE = int(os.getenv('FACE_WRITE_BATCH_SIZE', 200))  # Rows per multi-row INSERT
+    WRITE_FLUSH_MS = float(os.getenv('FACE_WRITE_FLUSH_MS', 500))  # Longest a row waits for its batch to fill
+    WRITE_QUEUE_SIZE = int(os.getenv('FACE_WRITE_QUEUE', 5000))  # Queued rows before requests spool to disk
+    WRITE_SPOOL_PATH = os.getenv('FACE_WRITE_SPOOL', 'cache/write_behind.spool')  # Rows waiting for the database
 
 config = Config()
 
-# Global face encodings cache
+# Global face encodings cache; requests only read face_gallery, the immutable
+# snapshot built from it, which a reload replaces in one assignment
 face_encodings_cache = {}
 cache_timestamp = 0
 CACHE_DURATION = 300  # 5 minutes
+reload_lock = threading.Lock()  # One gallery rebuild at a time
+refresh_lock = threading.Lock()
+refresh_thread = None  # Background rebuild of an expired gallery, while it runs
+refresh_stats = {'background_refreshes': 0, 'reloads': 0, 'last_reload_ms': 0}
+
+# Persistent gallery store
+GALLERY_STORE_PATH = os.getenv('FACE_GALLERY_STORE', 'cache/face_gallery.bin')
+GALLERY_STORE_MAGIC = b'RPFGAL\x00\x01'
+GALLERY_STORE_VERSION = 1
+ENCODING_DIM = 128
+
+class GalleryIndex:
+    """
+    In-memory template index of the gallery store, as parallel arrays with
+    one entry per store row rather than one dict per template. Paths are
+    fixed-width UTF-8 bytes, searched through a sorted permutation.
+    """
+
+    def __init__(self, templates):
+        self.paths = np.array([t['path'].encode('utf-8') for t in templates], dtype=np.bytes_)
+        self.order = np.argsort(self.paths, kind='stable').astype(np.int32)
+        self.sizes = np.array([t['size'] for t in templates], dtype=np.int64)
+        self.mtimes = np.array([t['mtime_ns'] for t in templates], dtype=np.int64)
+        self.sha1s = np.array([bytes.fromhex(t['sha1']) if t.get('sha1') else b'' for t in templates], dtype='S20')
+        self.student_ids = np.array([t.get('student_id', -1) for t in templates], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.paths, self.order, self.sizes, self.mtimes, self.sha1s, self.student_ids))
+
+    def find(self, path):
+        """Row of a path, or None (the last row wins if a path is stored twice)"""
+        if not len(self.paths):
+            return None
+        key = path.encode('utf-8')
+        position = np.searchsorted(self.paths, key, side='right', sorter=self.order) - 1
+        if position < 0 or self.paths[self.order[position]] != key:
+            return None
+        return int(self.order[position])
+
+    def template(self, row):
+        """The template record of one row, as written to the store"""
+        sha1 = self.sha1s[row]
+        template = {'path': self.paths[row].decode('utf-8'), 'size': int(self.sizes[row]),
+                    'mtime_ns': int(self.mtimes[row]), 'sha1': sha1.hex() if sha1 else None, 'row': row}
+        if self.student_ids[row] >= 0:
+            template['student_id'] = int(self.student_ids[row])
+        return template
+
+    def templates(self, start, count):
+        """Template records of consecutive rows, without their row numbers"""
+        return [{k: v for k, v in self.template(row).items() if k != 'row'} for row in range(start, start + count)]
+
+class GalleryStore:
+    """
+    Versioned on-disk gallery file.
+
+    Layout: magic, version and index length, a JSON template index, then one
+    contiguous float32 (N x 128) encodings block aligned to 64 bytes. The block
+    is memory-mapped on open, so a restart only re-encodes images whose
+    path/size/mtime (or, failing that, content hash) no longer match.
+
+    The index and its mapping are swapped in as one (GalleryIndex, encodings)
+    pair, so a reader never pairs rows of one file with the index of another.
+    """
+
+    HEADER = struct.Struct('<8sII')
+    ALIGNMENT = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.mapping = (GalleryIndex([]), np.empty((0, ENCODING_DIM), dtype=np.float32))
+
+    @property
+    def index(self):
+        return self.mapping[0]
+
+    @property
+    def encodings(self):
+        return self.mapping[1]
+
+    def open(self):
+        """Memory-map an existing store; a missing or stale file leaves it empty"""
+        self.mapping = (GalleryIndex([]), np.empty((0, ENCODING_DIM), dtype=np.float32))
+
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, 'rb') as f:
+                magic, version, index_len = self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != GALLERY_STORE_MAGIC or version != GALLERY_STORE_VERSION:
+                    logger.warning(f"Ignoring gallery store {self.path}: unsupported format version {version}")
+                    return False
+                index = json.loads(f.read(index_len).decode('utf-8'))
+
+            count = index['count']
+            encodings = np.empty((0, ENCODING_DIM), dtype=np.float32)
+            if count:
+                # A plain ndarray over the map, so per-student slices carry no memmap attributes
+                encodings = np.memmap(self.path, dtype=np.float32, mode='r',
+                                      offset=index['data_offset'], shape=(count, ENCODING_DIM)).view(np.ndarray)
+            self.mapping = (GalleryIndex(index['templates']), encodings)
+            logger.info(f"Memory-mapped {count} face encodings from {self.path}")
+            return True
+        except Exception as e:
+            logger.warning(f"Could not open gallery store {self.path}: {str(e)}")
+            return False
+
+    def lookup(self, full_path, stat_result):
+        """
+        Return (encoding, template, mapping the template's row refers to)
+        for an unchanged image, or (None, None, None) when it has to be re-encoded
+        """
+        mapping = self.mapping
+        index, encodings = mapping
+        row = index.find(full_path)
+        if row is None:
+            return None, None, None
+
+        template = index.template(row)
+        if template['size'] == stat_result.st_size and template['mtime_ns'] == stat_result.st_mtime_ns:
+            return encodings[row], template, mapping
+
+        # Size/mtime changed: the file may only have been touched or copied
+        if template['size'] == stat_result.st_size and template['sha1'] == file_sha1(full_path):
+            template['mtime_ns'] = stat_result.st_mtime_ns
+            return encodings[row], template, mapping
+
+        return None, None, None
+
+    def write(self, templates, encodings):
+        """Atomically replace the store with the given templates and encodings"""
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        templates = [dict(t, row=row) for row, t in enumerate(templates)]
+
+        # The data offset depends on the index length, which contains the offset
+        index = {'count': len(templates), 'data_offset': 0, 'templates': templates,
+                 'written_at': datetime.now().isoformat()}
+        while True:
+            index_bytes = json.dumps(index).encode('utf-8')
+            header_end = self.HEADER.size + len(index_bytes)
+            data_offset = -(-header_end // self.ALIGNMENT) * self.ALIGNMENT
+            if index['data_offset'] == data_offset:
+                break
+            index['data_offset'] = data_offset
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.face_gallery_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.HEADER.pack(GALLERY_STORE_MAGIC, GALLERY_STORE_VERSION, len(index_bytes)))
+                f.write(index_bytes)
+                f.write(b'\x00' * (data_offset - header_end))
+                f.write(encodings.tobytes())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        logger.info(f"Wrote {len(templates)} face encodings to gallery store {self.path}")
+        return self.open()
+
+def file_sha1(path):
+    """Content hash used to recognise images whose mtime changed but bytes did not"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+gallery_store = GalleryStore(GALLERY_STORE_PATH)
+
+# Candidates within this squared-distance band of the k-th approximate minimum
+# (plus the int8 quantization bound) are re-ranked exactly, so rounding can
+# never change the result
+MATCH_RERANK_TOLERANCE = 1e-4
+QUANT_CHUNK = 1024  # Template rows dequantized per block while scanning (cache-sized)
+
+def quantize(matrix):
+    """int8 codes and per-row float32 scales with row ~= codes * scale"""
+    matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.empty(0, dtype=np.float32)
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(matrix / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+    return codes, scales
+
+def is_memory_mapped(array):
+    """Whether an array's data lives in a file mapping rather than the heap"""
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+def encoding_rows(encodings):
+    """encodings as an (n x 128) float32 array, sharing the caller's array when it already is one"""
+    rows = np.asarray(encodings, dtype=np.float32)
+    return rows if rows.ndim == 2 and rows.shape[1] == ENCODING_DIM else rows.reshape(-1, ENCODING_DIM)
+
+def object_bytes(obj, seen):
+    """
+    Resident size of a cache value and what it holds (dicts, lists, tuples,
+    strings, numbers); arrays count their heap buffer, memory-mapped ones
+    nothing. Objects whose id is in `seen` are not counted again.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, GalleryIndex):
+        return obj.nbytes
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) if is_memory_mapped(obj) or obj.base is not None else obj.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(object_bytes(key, seen) + object_bytes(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(object_bytes(item, seen) for item in obj)
+    return size
+
+class FaceGallery:
+    """
+    Matching engine over a compact, int8-quantized (N_templates x 128) matrix.
+
+    Templates are grouped by student, so owners[i] is the student index of
+    row i and segment_starts marks where each student's rows begin. The scan
+    runs on int8 codes with a per-template scale (132 bytes per template);
+    the float32 encodings are only read for the few candidates re-ranked at
+    the end, and are normally memory-mapped from the gallery store.
+    Student metadata is held in parallel arrays rather than per-student dicts.
+    """
+
+    def __init__(self, encodings):
+        students = list(encodings.values())
+        self.student_ids = np.array([s['student_id'] for s in students], dtype=np.int64)
+        self.names = [sys.intern(s['name']) for s in students]
+        self.reg_nos = [sys.intern(s['reg_no']) for s in students]
+        self.photo_counts = np.array([s.get('photo_count', 1) for s in students], dtype=np.int32)
+
+        # float32 source rows per student, for the exact re-rank only
+        self.exact = [encoding_rows(s['all_encodings']) for s in students]
+        counts = np.array([len(rows) for rows in self.exact], dtype=np.int64)
+        self.counts = counts
+        self.owners = np.repeat(np.arange(len(students), dtype=np.int32), counts)
+        self.segment_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+
+        self.codes = np.empty((int(counts.sum()), ENCODING_DIM), dtype=np.int8)
+        self.scales = np.empty(len(self.codes), dtype=np.float32)
+        self.sq_norms = np.empty(len(self.codes), dtype=np.float32)
+        for start, rows in zip(self.segment_starts, self.exact):
+            self.codes[start:start + len(rows)], self.scales[start:start + len(rows)] = quantize(rows)
+            self.sq_norms[start:start + len(rows)] = np.einsum('ij,ij->i', rows, rows)
+
+        # Scope columns for resolving session rosters in memory (-1 = unset)
+        self.department_ids = np.array([s.get('department_id') or -1 for s in students], dtype=np.int64)
+        self.option_ids = np.array([s.get('option_id') or -1 for s in students], dtype=np.int64)
+        self.ann = None
+
+    @classmethod
+    def from_arrays(cls, names, reg_nos, student_ids, photo_counts, codes, scales, sq_norms, owners,
+                    segment_starts, counts, department_ids, option_ids, exact):
+        """Gallery over prebuilt arrays (e.g. views into a shared snapshot)"""
+        gallery = cls.__new__(cls)
+        gallery.names = [sys.intern(name) for name in names]
+        gallery.reg_nos = [sys.intern(reg_no) for reg_no in reg_nos]
+        gallery.student_ids = student_ids
+        gallery.photo_counts = photo_counts
+        gallery.codes = codes
+        gallery.scales = scales
+        gallery.sq_norms = sq_norms
+        gallery.owners = owners
+        gallery.segment_starts = segment_starts
+        gallery.counts = counts
+        gallery.department_ids = department_ids
+        gallery.option_ids = option_ids
+        gallery.exact = exact  # One (N_templates x 128) float32 array here
+        gallery.ann = None
+        return gallery
+
+    def __len__(self):
+        return len(self.student_ids)
+
+    @property
+    def template_count(self):
+        return len(self.codes)
+
+    def student(self, student_index):
+        """Metadata of one student, as used in recognition results"""
+        return {
+            'student_id': int(self.student_ids[student_index]),
+            'name': self.names[student_index],
+            'reg_no': self.reg_nos[student_index],
+            'photo_count': int(self.photo_counts[student_index])
+        }
+
+    def exact_rows(self, student_index):
+        """float32 encodings of one student"""
+        if isinstance(self.exact, list):
+            return self.exact[student_index]
+        start = self.segment_starts[student_index]
+        return self.exact[start:start + self.counts[student_index]]
+
+    def exact_matrix(self):
+        """All float32 encodings as one array (copied when held per student)"""
+        if isinstance(self.exact, list):
+            return np.concatenate(self.exact) if self.exact else np.empty((0, ENCODING_DIM), dtype=np.float32)
+        return self.exact
+
+    def decode(self, rows):
+        """Dequantized float32 copy of the given template rows"""
+        return self.codes[rows].astype(np.float32) * self.scales[rows, np.newaxis]
+
+    def memory_usage(self, encodings=None, store=None):
+        """
+        Resident bytes of the gallery; memory-mapped float32 rows are not counted.
+        With the cache entries and gallery store it was built from, their
+        per-template metadata (entry fields, template records, the store
+        index) is counted as well.
+        """
+        arrays = [self.codes, self.scales, self.sq_norms, self.owners, self.segment_starts, self.counts,
+                  self.student_ids, self.photo_counts, self.department_ids, self.option_ids]
+        resident = sum(a.nbytes for a in arrays if not is_memory_mapped(a))
+        resident += sys.getsizeof(self.names) + sys.getsizeof(self.reg_nos)
+        resident += sum(sys.getsizeof(s) for s in self.names) + sum(sys.getsizeof(s) for s in self.reg_nos)
+
+        exact = self.exact if isinstance(self.exact, list) else [self.exact]
+        mapped = all(is_memory_mapped(rows) for rows in exact)
+        if isinstance(self.exact, list):
+            resident += sys.getsizeof(self.exact) + sum(sys.getsizeof(rows) for rows in exact)
+        resident += sum(rows.nbytes for rows in exact if not is_memory_mapped(rows))
+
+        metadata = 0
+        seen = {id(name) for name in self.names} | {id(reg_no) for reg_no in self.reg_nos}
+        if store is not None:
+            metadata += object_bytes(store.index, seen)
+        for entry in (encodings or {}).values():
+            # The encodings themselves are the gallery's float32 rows, counted above
+            seen.add(id(entry.get('all_encodings')))
+            metadata += object_bytes(entry, seen)
+        resident += metadata
+        return {
+            'students': len(self),
+            'templates': self.template_count,
+            'metadata_bytes': metadata,
+            'resident_bytes': resident,
+            'bytes_per_template': round(resident / self.template_count, 1) if self.template_count else 0,
+            'float32_rows': 'memory-mapped' if mapped and self.template_count else 'in memory'
+        }
+
+    def updated(self, entries=(), removed=()):
+        """
+        Gallery with the `removed` students dropped and the given cache entries
+        appended; an entry for a student already present replaces its rows.
+        Everyone else's rows are copied as already quantized, and an ANN index
+        keeps its partitions, with only the new rows assigned to them.
+        """
+        entries = list(entries)
+        dropped = set(removed) | {entry['student_id'] for entry in entries}
+        keep = np.flatnonzero(~np.isin(self.student_ids, np.fromiter(dropped, dtype=np.int64, count=len(dropped))))
+        kept_rows = np.flatnonzero(np.isin(self.owners, keep))
+        addition = FaceGallery({entry['student_id']: entry for entry in entries})
+
+        gallery = FaceGallery.__new__(FaceGallery)
+        gallery.student_ids = np.concatenate((self.student_ids[keep], addition.student_ids))
+        gallery.names = [self.names[i] for i in keep] + addition.names
+        gallery.reg_nos = [self.reg_nos[i] for i in keep] + addition.reg_nos
+        gallery.photo_counts = np.concatenate((self.photo_counts[keep], addition.photo_counts))
+        gallery.exact = [self.exact_rows(i) for i in keep] + addition.exact
+        gallery.counts = np.concatenate((self.counts[keep], addition.counts))
+        gallery.owners = np.repeat(np.arange(len(gallery.counts), dtype=np.int32), gallery.counts)
+        gallery.segment_starts = np.concatenate(([0], np.cumsum(gallery.counts)[:-1])).astype(np.int64)
+        gallery.codes = np.concatenate((self.codes[kept_rows], addition.codes))
+        gallery.scales = np.concatenate((self.scales[kept_rows], addition.scales))
+        gallery.sq_norms = np.concatenate((self.sq_norms[kept_rows], addition.sq_norms))
+        gallery.department_ids = np.concatenate((self.department_ids[keep], addition.department_ids))
+        gallery.option_ids = np.concatenate((self.option_ids[keep], addition.option_ids))
+        gallery.ann = self.ann.updated(gallery, kept_rows) if self.ann is not None and gallery.template_count else None
+        return gallery
+
+    def student_distances(self, student_indices, probes):
+        """Exact (probes x students) distance of each probe to each student's closest template"""
+        probes64 = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        distances = np.empty((len(probes64), len(student_indices)))
+        for column, student_index in enumerate(student_indices):
+            rows = self.exact_rows(student_index)
+            distances[:, column] = np.linalg.norm(rows[np.newaxis, :, :] - probes64[:, np.newaxis, :], axis=2).min(axis=1)
+        return distances
+
+    def student_mask(self, student_ids):
+        """Boolean mask over gallery students for the given ids"""
+        return np.isin(self.student_ids, np.fromiter(student_ids, dtype=np.int64))
+
+    def roster_mask(self, department_id, option_id):
+        """Students in the session's department or option"""
+        mask = np.zeros(len(self), dtype=bool)
+        if department_id:
+            mask |= self.department_ids == int(department_id)
+        if option_id:
+            mask |= self.option_ids == int(option_id)
+        return mask
+
+    def match(self, probe, mask=None, top_k=3):
+        """
+        Return up to max(top_k, 2) (student index, distance) pairs, best first.
+        Distances are exactly what face_recognition.face_distance reports.
+        """
+        return self.match_many([probe], [mask], top_k)[0]
+
+    def match_many(self, probes, masks=None, top_k=3):
+        """match() for K probes at once, sharing one scan of the int8 matrix"""
+        if not len(self) or not len(probes):
+            return [[] for _ in probes]
+        masks = masks if masks is not None else [None] * len(probes)
+
+        # Probes without a roster can use the approximate index
+        results = [None] * len(probes)
+        if self.ann is not None:
+            for i, mask in enumerate(masks):
+                if mask is None:
+                    results[i] = self.ann_match(probes[i], top_k)
+        exact = [i for i, ranked in enumerate(results) if ranked is None]
+        if not exact:
+            return results
+
+        # |g - p|^2 = |g|^2 - 2 g.p + |p|^2, with g.p from the int8 codes,
+        # dequantized block by block
+        probes32 = np.asarray([probes[i] for i in exact], dtype=np.float32).reshape(-1, ENCODING_DIM)
+        dots = np.empty((len(probes32), self.template_count), dtype=np.float32)
+        for start in range(0, self.template_count, QUANT_CHUNK):
+            block = self.codes[start:start + QUANT_CHUNK].astype(np.float32)
+            dots[:, start:start + QUANT_CHUNK] = (probes32 @ block.T) * self.scales[start:start + QUANT_CHUNK]
+        sq_distances = (self.sq_norms[np.newaxis, :] - 2.0 * dots
+                        + np.einsum('ij,ij->i', probes32, probes32)[:, np.newaxis])
+
+        # Segmented per-student minimum
+        minima = np.minimum.reduceat(sq_distances, self.segment_starts, axis=1)
+
+        for row, i in enumerate(exact):
+            results[i] = self.rerank(probes[i], minima[row], masks[i], top_k)
+        return results
+
+    def ann_match(self, probe, top_k, fallback=True):
+        """
+        match() through the IVF index, or None when the answer could differ
+        from an exact search in a way that matters (unless fallback=False)
+        """
+        probe32 = np.asarray(probe, dtype=np.float32)
+        rows = self.ann.search(probe32)
+        dots = (self.codes[rows].astype(np.float32) @ probe32) * self.scales[rows]
+        sq_distances = self.sq_norms[rows] - 2.0 * dots + float(probe32 @ probe32)
+
+        minima = np.full(len(self), np.inf, dtype=np.float32)
+        np.minimum.at(minima, self.owners[rows], sq_distances)
+        ranked = self.rerank(probe, minima, None, top_k)
+
+        # Students in unscanned partitions are unknown: if one of them could
+        # change the CONFIDENCE_MARGIN decision, search exactly instead
+        ann_stats['searches'] += 1
+        if fallback and (len(ranked) < 2 or ranked[1][1] - ranked[0][1] < config.CONFIDENCE_MARGIN + ANN_FALLBACK_BAND):
+            ann_stats['exact_fallbacks'] += 1
+            return None
+        return ranked
+
+    def rerank(self, probe, minima, mask, top_k):
+        """Pick the top students from approximate minima and re-rank them exactly"""
+        if mask is not None:
+            minima = np.where(mask, minima, np.inf)
+
+        valid = np.count_nonzero(np.isfinite(minima))
+        if not valid:
+            return []
+
+        # Quantization moves each squared distance by at most |p|_1 * max scale
+        probe64 = np.asarray(probe, dtype=np.float64)
+        quantization_error = float(np.abs(probe64).sum() * self.scales.max())
+
+        k = min(max(top_k, 2), valid)
+        kth = np.partition(minima, k - 1)[k - 1]
+        candidates = np.flatnonzero(minima <= kth + 2 * quantization_error + MATCH_RERANK_TOLERANCE)
+
+        # Exact re-rank of the few candidates, in float64 like face_distance
+        exact = np.empty(len(candidates))
+        for i, student_index in enumerate(candidates):
+            exact[i] = np.linalg.norm(self.exact_rows(student_index) - probe64, axis=1).min()
+
+        order = np.argsort(exact, kind='stable')[:k]
+        return [(int(candidates[i]), float(exact[i])) for i in order]
+
+face_gallery = FaceGallery({})
+
+# Optional approximate index for matching without a session roster
+ANN_ENABLED = os.getenv('FACE_ANN_INDEX', 'false').lower() == 'true'
+ANN_MIN_TEMPLATES = int(os.getenv('FACE_ANN_MIN_TEMPLATES', 20000))  # Smaller galleries are always searched exactly
+ANN_NPROBE = int(os.getenv('FACE_ANN_NPROBE', 8))  # Partitions scanned per probe
+ANN_KMEANS_ITERATIONS = 8
+ANN_KMEANS_SAMPLE_PER_LIST = 64  # Training rows per partition
+ANN_FALLBACK_BAND = 0.05  # Search exactly when the best/second gap is within this of CONFIDENCE_MARGIN
+ann_stats = {'searches': 0, 'exact_fallbacks': 0}
+
+def nearest_centroids(rows, centroids, chunk=4096):
+    """Index of the closest centroid for each row, in bounded-memory chunks"""
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(rows), dtype=np.int32)
+    for start in range(0, len(rows), chunk):
+        block = rows[start:start + chunk]
+        labels[start:start + chunk] = np.argmin(centroid_norms - 2.0 * (block @ centroids.T), axis=1)
+    return labels
+
+class IVFIndex:
+    """
+    Inverted-file index over the gallery matrix. Templates are partitioned by
+    k-means (trained on a sample) and a probe only scans the templates of the
+    nprobe partitions whose centroids are closest to it.
+    """
+
+    def __init__(self, gallery, nlist=None, nprobe=ANN_NPROBE, iterations=ANN_KMEANS_ITERATIONS, seed=0):
+        rng = np.random.default_rng(seed)
+        templates = gallery.template_count
+        self.nlist = nlist or max(1, int(4 * np.sqrt(templates)))
+        self.nprobe = nprobe
+
+        sample_size = min(templates, self.nlist * ANN_KMEANS_SAMPLE_PER_LIST)
+        sample = gallery.decode(np.sort(rng.choice(templates, sample_size, replace=False)))
+        centroids = sample[rng.choice(sample_size, self.nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = nearest_centroids(sample, centroids)
+            counts = np.bincount(labels, minlength=self.nlist)
+            nonempty = np.flatnonzero(counts)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+            sums = np.add.reduceat(sample[np.argsort(labels, kind='stable')], starts, axis=0)
+            centroids[nonempty] = sums / counts[nonempty, np.newaxis]  # Empty partitions keep their centroid
+
+        labels = np.concatenate([nearest_centroids(gallery.decode(slice(start, start + QUANT_CHUNK)), centroids)
+                                 for start in range(0, templates, QUANT_CHUNK)])
+        self.centroids = centroids
+        self.centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.rows = np.argsort(labels, kind='stable').astype(np.int32)
+        self.list_starts = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=self.nlist)))).astype(np.int64)
+
+    @classmethod
+    def from_arrays(cls, centroids, rows, list_starts, nprobe=ANN_NPROBE):
+        """Index from already trained arrays (a shared snapshot, or an updated index)"""
+        index = cls.__new__(cls)
+        index.nlist = len(centroids)
+        index.nprobe = nprobe
+        index.centroids = centroids
+        index.centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        index.rows = rows
+        index.list_starts = list_starts
+        return index
+
+    def search(self, probe32):
+        """Gallery rows in the nprobe partitions closest to the probe"""
+        nprobe = min(self.nprobe, self.nlist)
+        scores = self.centroid_norms - 2.0 * (self.centroids @ probe32)
+        lists = np.argpartition(scores, nprobe - 1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+        return np.concatenate([self.rows[self.list_starts[l]:self.list_starts[l + 1]] for l in lists])
+
+    def updated(self, gallery, kept_rows):
+        """
+        Index for a gallery whose first rows are this gallery's kept_rows (in
+        order) followed by new rows: same centroids, new rows assigned to them
+        """
+        labels = np.empty(len(self.rows), dtype=np.int64)
+        labels[self.rows] = np.repeat(np.arange(self.nlist), np.diff(self.list_starts))
+        new_rows = np.arange(len(kept_rows), gallery.template_count)
+        labels = np.concatenate((labels[kept_rows], nearest_centroids(gallery.decode(new_rows), self.centroids)
+                                 if len(new_rows) else np.empty(0, dtype=np.int64)))
+
+        return IVFIndex.from_arrays(
+            self.centroids, np.argsort(labels, kind='stable').astype(np.int32),
+            np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=self.nlist)))).astype(np.int64), self.nprobe)
+
+def build_ann_index(gallery):
+    """Attach an IVF index to large galleries when FACE_ANN_INDEX is enabled"""
+    if ANN_ENABLED and gallery.template_count >= ANN_MIN_TEMPLATES:
+        start = time.perf_counter()
+        gallery.ann = IVFIndex(gallery)
+        logger.info(f"Built ANN index over {gallery.template_count} templates ({gallery.ann.nlist} partitions) "
+                    f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return gallery
+
+# Shared gallery snapshots for pre-fork workers
+SHARED_GALLERY_DIR = os.getenv('FACE_SHARED_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+SHARED_GALLERY_MAGIC = b'RPFSHM\x00\x03'
+SHARED_GALLERY_HEADER = struct.Struct('<8sIQIII')  # magic, version, metadata length, templates, students, ANN lists
+
+def shared_gallery_layout(data_start, n_templates, n_students, n_lists=0):
+    """Byte offsets of the arrays in a snapshot, each aligned to 64 bytes"""
+    fields = [
+        ('codes', np.int8, (n_templates, ENCODING_DIM)),
+        ('scales', np.float32, (n_templates,)),
+        ('sq_norms', np.float32, (n_templates,)),
+        ('owners', np.int32, (n_templates,)),
+        ('exact', np.float32, (n_templates, ENCODING_DIM)),
+        ('student_ids', np.int64, (n_students,)),
+        ('photo_counts', np.int32, (n_students,)),
+        ('segment_starts', np.int64, (n_students,)),
+        ('counts', np.int64, (n_students,)),
+        ('department_ids', np.int64, (n_students,)),
+        ('option_ids', np.int64, (n_students,)),
+    ]
+    if n_lists:
+        # The parent's trained ANN index, so workers never run k-means themselves
+        fields += [
+            ('ann_centroids', np.float32, (n_lists, ENCODING_DIM)),
+            ('ann_rows', np.int32, (n_templates,)),
+            ('ann_list_starts', np.int64, (n_lists + 1,)),
+        ]
+    layout = []
+    offset = data_start
+    for name, dtype, shape in fields:
+        offset = (offset + 63) // 64 * 64
+        layout.append((name, dtype, shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return layout, offset
+
+class SharedGallery:
+    """
+    Gallery snapshots shared between a parent process and its pre-forked workers.
+
+    The parent writes each rebuilt gallery to one file under SHARED_GALLERY_DIR
+    (tmpfs by default), swaps it in with os.replace and then bumps a shared
+    version counter. Workers memory-map the file read-only when the counter
+    moves, so every process reads the same pages and a worker never sees a
+    half-written snapshot. The parent's ANN index travels in the snapshot too. Reload requests from workers go to the parent over
+    a queue; only the parent talks to the database for the gallery.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(SHARED_GALLERY_DIR, f'face_gallery_{os.getpid()}.shm')
+        self.version = multiprocessing.Value('Q', 0)
+        self.reloads = multiprocessing.Queue()
+        self.local_version = 0
+        self.local_gallery = None
+        self.local_timestamp = 0  # When the parent last loaded the attached version from the database
+        self.lock = threading.Lock()
+
+    def publish(self, gallery):
+        """Parent side: write a new snapshot and announce it"""
+        version = self.version.value + 1
+        metadata = json.dumps({'names': gallery.names, 'reg_nos': gallery.reg_nos,
+                               'cache_timestamp': cache_timestamp}).encode('utf-8')
+        n_lists = gallery.ann.nlist if gallery.ann is not None else 0
+
+        data_start = SHARED_GALLERY_HEADER.size + len(metadata)
+        layout, total_size = shared_gallery_layout(data_start, gallery.template_count, len(gallery), n_lists)
+        arrays = {name: getattr(gallery, name) for name, _, _, _ in layout
+                  if name != 'exact' and not name.startswith('ann_')}
+        arrays['exact'] = gallery.exact_matrix()
+        if n_lists:
+            arrays.update(ann_centroids=gallery.ann.centroids, ann_rows=gallery.ann.rows,
+                          ann_list_starts=gallery.ann.list_starts)
+
+        fd, tmp_path = tempfile.mkstemp(dir=SHARED_GALLERY_DIR, prefix='.face_gallery_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(SHARED_GALLERY_HEADER.pack(SHARED_GALLERY_MAGIC, version, len(metadata),
+                                                   gallery.template_count, len(gallery), n_lists))
+                f.write(metadata)
+                for name, dtype, shape, offset in layout:
+                    f.write(b'\x00' * (offset - f.tell()))
+                    f.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+                f.truncate(max(total_size, f.tell()))
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        with self.version.get_lock():
+            self.version.value = version
+        logger.info(f"Published gallery version {version} ({len(gallery)} students, {total_size} bytes)")
+
+    def current(self):
+        """Worker side: the latest published gallery, mapped on first use"""
+        version = self.version.value
+        if version == self.local_version:
+            return self.local_gallery
+
+        with self.lock:
+            if version != self.local_version:
+                self.local_gallery, self.local_version, self.local_timestamp = self.attach()
+        return self.local_gallery
+
+    def attach(self):
+        """Map the snapshot: (gallery, version, parent's cache timestamp); nothing is rebuilt here"""
+        raw = np.memmap(self.path, dtype=np.uint8, mode='r')
+        magic, version, metadata_length, n_templates, n_students, n_lists = SHARED_GALLERY_HEADER.unpack_from(raw, 0)
+        if magic != SHARED_GALLERY_MAGIC:
+            raise ValueError(f"Not a shared gallery snapshot: {self.path}")
+
+        data_start = SHARED_GALLERY_HEADER.size + metadata_length
+        metadata = json.loads(bytes(raw[SHARED_GALLERY_HEADER.size:data_start]).decode('utf-8'))
+        layout, _ = shared_gallery_layout(data_start, n_templates, n_students, n_lists)
+        arrays = {
+            name: raw[offset:offset + int(np.prod(shape)) * np.dtype(dtype).itemsize].view(dtype).reshape(shape)
+            for name, dtype, shape, offset in layout
+        }
+        ann_arrays = [arrays.pop(name, None) for name in ('ann_centroids', 'ann_rows', 'ann_list_starts')]
+        gallery = FaceGallery.from_arrays(metadata['names'], metadata['reg_nos'], **arrays)
+        if n_lists:
+            gallery.ann = IVFIndex.from_arrays(*ann_arrays)
+        return gallery, version, metadata['cache_timestamp']
+
+    def request_reload(self, student_ids=None, full=False, timeout=120):
+        """Worker side: ask the parent to reload and wait for the new version"""
+        version = self.version.value
+        self.reloads.put({'student_ids': student_ids, 'full': full})
+        deadline = time.time() + timeout
+        while self.version.value == version and time.time() < deadline:
+            time.sleep(0.05)
+        return self.current()
+
+    def request_enrollment(self, action, student_id):
+        """Worker side: hand an enroll/unenroll request to the parent without waiting"""
+        self.reloads.put({'enrollment': action, 'student_id': student_id})
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+shared_gallery = None  # Set in pre-fork workers
+
+def current_gallery():
+    """
+    The gallery to match against: the shared snapshot in a worker, else the
+    local snapshot. An expired snapshot is still served while it is rebuilt
+    in the background; only an empty one is loaded before returning.
+    """
+    if shared_gallery is not None:
+        return shared_gallery.current()
+    gallery = face_gallery
+    if not len(gallery):
+        load_student_faces()
+        return face_gallery
+    if time.time() - cache_timestamp >= CACHE_DURATION:
+        refresh_in_background()
+    return gallery
+
+def refresh_in_background():
+    """Start a background rebuild of the expired gallery unless one is already running"""
+    global refresh_thread
+    with refresh_lock:
+        if refresh_thread is not None and refresh_thread.is_alive():
+            return False
+        refresh_thread = threading.Thread(target=load_student_faces, name='gallery-refresh', daemon=True)
+        refresh_thread.start()
+        refresh_stats['background_refreshes'] += 1
+        return True
+
+def cached_student_count():
+    """Students in the gallery without triggering a refresh"""
+    if shared_gallery is not None:
+        return len(shared_gallery.current())
+    return len(face_gallery)
+
+# Delta refresh state
+MISSING_PATH_RECHECK = 3600  # Seconds before a missing image path is checked again
+DELTA_FETCH_CHUNK = 500  # Student rows fetched per IN (...) query during a delta refresh
+student_sync_state = {}  # student_id -> checksum of the row data the cache was built from
+STUDENT_CHECKSUM_SQL = ("MD5(CONCAT_WS('|', s.reg_no, s.first_name, s.last_name, s.department_id, s.option_id, "
+                        "s.student_photos))")
+missing_paths = {}  # full_path -> (student_id, last checked timestamp)
+
+def get_db_config():
+    """Database connection settings shared by the service"""
+    return {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'database': os.getenv('DB_NAME', 'rp_attendance_system'),
+        'user': os.getenv('DB_USER', 'root'),
+        'password': os.getenv('DB_PASS', ''),
+        'charset': 'utf8mb4',
+        'collation': 'utf8mb4_unicode_ci'
+    }
+
+# Connection pool shared by the service's threads
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = 5  # Seconds to wait for a free pooled connection
+DB_FETCH_BATCH = 100  # Rows per fetchmany() while streaming the gallery
+DB_PIPELINE_DEPTH = 4  # Row batches buffered between the DB reader and the encoder
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Create the connection pool on first use (after any fork)"""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            from mysql.connector import pooling
+            db_pool = pooling.MySQLConnectionPool(pool_name=f'face_recognition_{os.getpid()}',
+                                                  pool_size=DB_POOL_SIZE, pool_reset_session=True,
+                                                  **get_db_config())
+        return db_pool
+
+@contextmanager
+def db_connection():
+    """
+    Borrow a health-checked connection from the pool; closing it returns it
+    to the pool
+    """
+    from mysql.connector import errors
+
+    deadline = time.time() + DB_POOL_TIMEOUT
+    while True:
+        try:
+            conn = get_db_pool().get_connection()
+            break
+        except errors.PoolError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.05)
+
+    try:
+        # Reconnects a connection the server dropped while it sat idle in the pool
+        conn.ping(reconnect=True, attempts=2, delay=0)
+        yield conn
+    finally:
+        conn.close()
+
+def stream_student_rows(conn, student_ids, rows_queue, stop):
+    """
+    Producer: stream full student rows with an unbuffered cursor in fetchmany
+    batches onto a bounded queue, so only a few batches are ever held in memory.
+    Once `stop` is set it reads out the open result and returns, so the
+    connection is back in sync before it goes back to the pool.
+    """
+    query = """
+    SELECT DISTINCT s.id, s.reg_no, s.first_name, s.last_name, s.department_id, s.option_id, s.student_photos
+    FROM students s
+    WHERE s.id IN ({})
+    """
+
+    def offer(item):
+        """Put unless the consumer has gone away; False when it has"""
+        while not stop.is_set():
+            try:
+                rows_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        try:
+            for start in range(0, len(student_ids), DELTA_FETCH_CHUNK):
+                chunk = student_ids[start:start + DELTA_FETCH_CHUNK]
+                cursor.execute(query.format(', '.join(['%s'] * len(chunk))), chunk)
+                while True:
+                    rows = cursor.fetchmany(DB_FETCH_BATCH)
+                    if not rows:
+                        break
+                    if not offer(rows):
+                        while cursor.fetchmany(DB_FETCH_BATCH):
+                            pass
+                        return
+        finally:
+            cursor.close()
+        offer(None)
+    except Exception as e:
+        offer(e)
+
+class EnrollmentProgress:
+    """
+    Progress and per-image report of the current (or last) enrollment pass:
+    how many images are done, and the timing or failure of each one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.finished_at = None
+        self.students = 0
+        self.pending = 0
+        self.counts = {}
+        self.images = []  # dicts of student_id, path, status, ms, error
+
+    def start(self, students):
+        with self.lock:
+            self.started_at = time.time()
+            self.finished_at = None
+            self.students = students
+            self.pending = 0
+            self.counts = {}
+            self.images = []
+
+    def add_pending(self, images):
+        with self.lock:
+            self.pending += images
+
+    def record(self, student_id, path, status, ms=None, error=None):
+        """status: reused, encoded, no_face, failed or missing"""
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            self.images.append({
+                'student_id': student_id,
+                'path': path,
+                'status': status,
+                'ms': round(ms, 1) if ms is not None else None,
+                'error': error
+            })
+
+    def finish(self):
+        with self.lock:
+            self.finished_at = time.time()
+
+    def snapshot(self, images=False):
+        with self.lock:
+            encode_times = [image['ms'] for image in self.images if image['ms'] is not None]
+            done = sum(self.counts.get(status, 0) for status in ('encoded', 'no_face', 'failed'))
+            end = self.finished_at or time.time()
+            report = {
+                'running': self.started_at is not None and self.finished_at is None,
+                'started_at': datetime.fromtimestamp(self.started_at).isoformat() if self.started_at else None,
+                'elapsed_seconds': round(end - self.started_at, 2) if self.started_at else 0,
+                'students': self.students,
+                'images_to_encode': self.pending,
+                'images_encoded': done,
+                'percent': round(100.0 * done / self.pending, 1) if self.pending else 100.0,
+                'counts': dict(self.counts),
+                'avg_encode_ms': round(sum(encode_times) / len(encode_times), 1) if encode_times else 0,
+                'failures': [image for image in self.images if image['status'] in ('failed', 'no_face', 'missing')][:50],
+                'slowest': sorted((image for image in self.images if image['ms'] is not None),
+                                  key=lambda image: image['ms'], reverse=True)[:10]
+            }
+            if images:
+                report['images'] = list(self.images)
+            return report
+
+enrollment_progress = EnrollmentProgress()
+
+def plan_student_images(student):
+    """
+    Thread-pool step for one student row: parse its photo list, stat each
+    file and reuse persisted encodings for unchanged images. Returns a list
+    of image dicts; those still without an encoding need encoding.
+    """
+    student_id = student['id']
+    images = []
+
+    # Parse biometric data from JSON
+    biometric_data = student.get('student_photos')
+    if not biometric_data:
+        return images
+    try:
+        bio_json = json.loads(biometric_data) if isinstance(biometric_data, str) else biometric_data
+        face_images = bio_json.get('biometric_data', {}).get('face_images', [])
+    except json.JSONDecodeError as e:
+        logger.warning(f"Invalid JSON in student_photos for student {student['reg_no']}: {str(e)}")
+        return images
+
+    for face_img in face_images:
+        image_path = face_img.get('image_path')
+        if not image_path:
+            continue
+
+        # Handle both relative and absolute paths
+        if not os.path.isabs(image_path):
+            full_path = os.path.join(os.getcwd(), image_path)
+        else:
+            full_path = image_path
+
+        # Skip paths already known to be missing until their recheck is due
+        missing = missing_paths.get(full_path)
+        if missing and time.time() - missing[1] < MISSING_PATH_RECHECK:
+            continue
+
+        try:
+            stat_result = os.stat(full_path)
+        except FileNotFoundError:
+            missing_paths[full_path] = (student_id, time.time())
+            logger.warning(f"Image file not found: {full_path} for student {student['reg_no']}")
+            enrollment_progress.record(student_id, full_path, 'missing')
+            continue
+        missing_paths.pop(full_path, None)
+
+        # Reuse the persisted encoding when the image is unchanged
+        try:
+            encoding, template, mapping = gallery_store.lookup(full_path, stat_result)
+        except Exception as e:
+            logger.warning(f"Failed to process image {full_path} for student {student['reg_no']}: {str(e)}")
+            continue
+        if encoding is not None:
+            enrollment_progress.record(student_id, full_path, 'reused')
+        else:
+            template = {
+                'path': full_path,
+                'size': stat_result.st_size,
+                'mtime_ns': stat_result.st_mtime_ns
+            }
+        images.append({'full_path': full_path, 'encoding': encoding, 'template': template, 'mapping': mapping})
+
+    return images
+
+def encode_enrollment_image(full_path):
+    """
+    Encoding task for one enrolled photo, run in the enrollment process pool.
+    JPEGs are draft-decoded to about DECODE_MAX_DIMENSION before detection.
+    Returns (float32 encoding or None when no face was found, ms, error or
+    None, content hash of the file for the gallery store)
+    """
+    start = time.perf_counter()
+    try:
+        image = np.asarray(open_image(full_path))
+        face_encodings = face_recognition.face_encodings(image)
+        encoding = face_encodings[0].astype(np.float32) if face_encodings else None
+        sha1 = file_sha1(full_path) if encoding is not None else None
+        return encoding, (time.perf_counter() - start) * 1000, None, sha1
+    except Exception as e:
+        return None, (time.perf_counter() - start) * 1000, str(e), None
+
+def enrollment_pool(workers):
+    """
+    Process pool for encoding photos. Workers come from a forkserver (spawn
+    where that is unavailable), never a fork of this process: the request,
+    batcher and refresh threads may hold logging, BLAS or dlib locks that
+    a forked child would inherit locked.
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+def encode_student_images(students_images, pool):
+    """
+    Encode every image still missing an encoding, through the process pool
+    when one is given. Updates the image dicts in place.
+    """
+    pending = [(student_id, image) for student_id, images in students_images
+               for image in images if image['encoding'] is None]
+    paths = [image['full_path'] for _, image in pending]
+    results = pool.map(encode_enrollment_image, paths) if pool else map(encode_enrollment_image, paths)
+
+    for (student_id, image), (encoding, elapsed_ms, error, sha1) in zip(pending, results):
+        if error is not None:
+            logger.warning(f"Failed to process image {image['full_path']} for student {student_id}: {error}")
+            enrollment_progress.record(student_id, image['full_path'], 'failed', elapsed_ms, error)
+        elif encoding is None:
+            enrollment_progress.record(student_id, image['full_path'], 'no_face', elapsed_ms)
+        else:
+            image['encoding'] = encoding
+            image['template'] = dict(image['template'], sha1=sha1)
+            image['encoded'] = True
+            enrollment_progress.record(student_id, image['full_path'], 'encoded', elapsed_ms)
+            logger.info(f"Loaded face encoding for student {student_id} from {image['full_path']}")
+
+def build_student_entry(student, images):
+    """
+    Build the cache entry for one student from its planned and encoded
+    images. Returns (entry or None, number of images newly encoded)
+    """
+    student_id = student['id']
+    student_encodings = []
+    student_templates = []
+    student_rows = []  # Gallery store row of each reused encoding (None when newly encoded)
+    student_mappings = []  # Store mapping each of those rows refers to
+    encoded_count = 0
+
+    for image in images:
+        if image['encoding'] is None:
+            continue
+        template = image['template']
+        encoded_count += 1 if image.get('encoded') else 0
+        student_rows.append(template.get('row'))
+        student_mappings.append(image.get('mapping'))
+        student_encodings.append(image['encoding'])
+        student_templates.append(dict({k: v for k, v in template.items() if k != 'row'}, student_id=student_id))
+
+    if not student_encodings:
+        return None, encoded_count
+
+    # Unchanged students keep a view of their consecutive rows in the mapping they
+    # were planned against; the store may have been rewritten and remapped since.
+    # When the store's records still match, the entry keeps no template dicts of its own.
+    first_row = student_rows[0]
+    mapping = student_mappings[0]
+    template_rows = None
+    if (first_row is not None and mapping is not None and all(m is mapping for m in student_mappings)
+            and student_rows == list(range(first_row, first_row + len(student_rows)))):
+        index, block = mapping
+        all_encodings = block[first_row:first_row + len(student_rows)]
+        if index.templates(first_row, len(student_rows)) == student_templates:
+            template_rows, student_templates = (index, first_row), None
+    else:
+        all_encodings = np.array(student_encodings, dtype=np.float32)
+
+    # All encodings as one (n x 128) float32 array; the first is the primary one
+    return {
+        'all_encodings': all_encodings,
+        'student_id': student_id,
+        'reg_no': student['reg_no'],
+        'name': f"{student['first_name']} {student['last_name']}",
+        'department_id': student.get('department_id'),
+        'option_id': student.get('option_id'),
+        'photo_count': len(student_encodings),
+        'templates': student_templates,
+        'template_rows': template_rows
+    }, encoded_count
+
+def entry_templates(entry):
+    """
+    Template records of a cache entry: its own list until the entry is
+    persisted, afterwards read back from the store index it points into
+    """
+    if entry.get('templates') is not None:
+        return entry['templates']
+    index, first_row = entry['template_rows']
+    return index.templates(first_row, len(entry['all_encodings']))
+
+def persist_gallery(encodings):
+    """Rewrite the gallery store from the cache and serve from the new mapping"""
+    templates = []
+    rows = []
+    for student_data in encodings.values():
+        templates.extend(entry_templates(student_data))
+        rows.append(student_data['all_encodings'])
+
+    try:
+        matrix = np.concatenate(rows) if rows else np.empty((0, ENCODING_DIM), dtype=np.float32)
+        if not gallery_store.write(templates, matrix):
+            return
+
+        # Serve from the freshly mapped file rather than the in-process copies, and
+        # drop the entries' template dicts now that the store index holds them
+        index, block = gallery_store.mapping
+        row = 0
+        for student_id, student_data in encodings.items():
+            count = len(student_data['all_encodings'])
+            encodings[student_id] = dict(student_data, all_encodings=block[row:row + count],
+                                         templates=None, template_rows=(index, row))
+            row += count
+    except Exception as e:
+        logger.warning(f"Could not persist gallery store: {str(e)}")
 
-def load_student_faces():
+def load_student_faces(student_ids=None, full=False):
     """
     Load and cache face encodings for all students with photos
     Supports multiple images per student from student_images table
+
+    Refreshes are incremental: only students whose row checksum changed since
+    the last sync (plus any explicitly requested student_ids, or everyone when
+    full=True) are re-read, and removed or deactivated students are dropped.
+
+    Rebuilds are single-flight: callers queue on reload_lock, and a plain
+    refresh that waited for another one to finish returns its result.
     """
-    global face_encodings_cache, cache_timestamp
+    requested_at = time.time()
 
     # Check if cache is still valid
-    if time.time() - cache_timestamp < CACHE_DURATION and face_encodings_cache:
+    if not student_ids and not full and requested_at - cache_timestamp < CACHE_DURATION and face_encodings_cache:
         return face_encodings_cache
 
-    logger.info("Loading student face encodings...")
-    encodings = {}
+    with reload_lock:
+        if not student_ids and not full and cache_timestamp >= requested_at:
+            return face_encodings_cache
+        return rebuild_gallery(student_ids, full)
+
+def rebuild_gallery(student_ids, full):
+    """Build a new gallery snapshot from a copy of the cache and swap it in"""
+    global face_encodings_cache, face_gallery, cache_timestamp
+
+    logger.info("Refreshing student face encodings...")
+    start = time.perf_counter()
+    encodings = dict(face_encodings_cache)
+    sync_state = dict(student_sync_state)
+    forced = set(student_ids or [])
+    encoded_count = 0
+
+    from mysql.connector import Error
 
     try:
         # Connect to database to get student photos
-        import mysql.connector
-        from mysql.connector import Error
-
-        # Database connection (configure these)
-        db_config = {
-            'host': os.getenv('DB_HOST', 'localhost'),
-            'database': os.getenv('DB_NAME', 'rp_attendance_system'),
-            'user': os.getenv('DB_USER', 'root'),
-            'password': os.getenv('DB_PASS', ''),
-            'charset': 'utf8mb4',
-            'collation': 'utf8mb4_unicode_ci'
-        }
+        with db_connection() as conn:
+            encoded_count, store_changed = refresh_from_database(conn, encodings, sync_state, forced, full)
+
+        # Persist the gallery when images were added, changed or removed
+        if store_changed:
+            persist_gallery(encodings)
+
+        student_sync_state.clear()
+        student_sync_state.update(sync_state)
+
+    except Error as e:
+        logger.error(f"Database error: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error loading student faces: {str(e)}")
+
+    # Requests holding the previous snapshot finish with it
+    face_gallery = build_ann_index(FaceGallery(encodings))
+    face_encodings_cache = encodings
+    cache_timestamp = time.time()
+    refresh_stats['reloads'] += 1
+    refresh_stats['last_reload_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    logger.info(f"Loaded face encodings for {len(encodings)} students ({encoded_count} images newly encoded)")
+    return encodings
+
+def refresh_from_database(conn, encodings, sync_state, forced, full):
+    """
+    Apply a delta refresh to the encodings/sync_state copies in place.
+    Returns (images newly encoded, whether the persisted gallery is stale)
+    """
+    encoded_count = 0
+    store_changed = False
+    cursor = conn.cursor(dictionary=True, buffered=False)
+
+    # Cheap listing: one checksum per active student instead of the full photo JSON
+    cursor.execute(f"""
+    SELECT s.id, {STUDENT_CHECKSUM_SQL} AS checksum
+    FROM students s
+    WHERE s.student_photos IS NOT NULL AND s.student_photos != ''
+    AND s.status = 'active'
+    """)
+    current = {row['id']: row['checksum'] for row in cursor}
+    cursor.close()
+
+    # Drop removed or deactivated students
+    for student_id in (set(sync_state) | set(encodings)) - set(current):
+        sync_state.pop(student_id, None)
+        if encodings.pop(student_id, None) is not None:
+            store_changed = True
+    for path in [p for p, (sid, _) in missing_paths.items() if sid not in current]:
+        missing_paths.pop(path)
+
+    # Students with missing images are re-read once their recheck is due
+    now = time.time()
+    recheck = {sid for sid, checked_at in missing_paths.values() if now - checked_at >= MISSING_PATH_RECHECK}
+
+    dirty = {sid for sid, checksum in current.items() if sync_state.get(sid) != checksum or sid in forced}
+    changed = [sid for sid in current if full or sid in dirty or sid in recheck]
+
+    # A changed or explicitly requested row may point at files that have since appeared
+    for path in [p for p, (sid, _) in missing_paths.items() if sid in dirty]:
+        missing_paths.pop(path)
+
+    logger.info(f"Found {len(current)} students with biometric data, {len(changed)} changed since last sync")
+
+    # Stream the changed rows; parsing and encoding overlap the DB transfer
+    rows_queue = queue.Queue(maxsize=DB_PIPELINE_DEPTH)
+    stop_producer = threading.Event()
+    producer = threading.Thread(target=stream_student_rows, args=(conn, changed, rows_queue, stop_producer),
+                                daemon=True)
+    producer.start()
+
+    enrollment_progress.start(len(changed))
+    stat_pool = ThreadPoolExecutor(max_workers=config.ENROLL_STAT_THREADS)
+    encode_pool = None
+    try:
+        while True:
+            batch = rows_queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+
+            # Stat and reuse checks on the thread pool, then encode what is left in the
+            # process pool; small batches are not worth the hand-off
+            planned = list(zip(batch, stat_pool.map(plan_student_images, batch)))
+            pending = sum(1 for _, images in planned for image in images if image['encoding'] is None)
+            if pending >= config.ENROLL_POOL_MIN_IMAGES and config.ENROLL_WORKERS > 1 and encode_pool is None:
+                encode_pool = enrollment_pool(config.ENROLL_WORKERS)
+            enrollment_progress.add_pending(pending)
+            encode_student_images([(student['id'], images) for student, images in planned],
+                                  encode_pool if pending >= config.ENROLL_POOL_MIN_IMAGES else None)
+
+            for student, images in planned:
+                try:
+                    entry, student_encoded = build_student_entry(student, images)
+                    encoded_count += student_encoded
+
+                    previous = encodings.pop(student['id'], None)
+                    if entry:
+                        encodings[student['id']] = entry
+                        logger.info(f"Loaded {entry['photo_count']} face encodings for student {student['reg_no']}")
+                    previous_templates = entry_templates(previous) if previous else None
+                    if student_encoded or previous_templates != (entry_templates(entry) if entry else None):
+                        store_changed = True
+
+                    sync_state[student['id']] = current[student['id']]
+                except Exception as e:
+                    logger.error(f"Error loading faces for student {student['reg_no']}: {str(e)}")
+                    continue
+    finally:
+        # The producer shares this connection: when we leave early it must stop and
+        # finish its result before the caller hands the connection back to the pool
+        stop_producer.set()
+        while True:
+            try:
+                rows_queue.get_nowait()
+            except queue.Empty:
+                break
+        producer.join()
+        stat_pool.shutdown()
+        if encode_pool:
+            encode_pool.shutdown()
+        enrollment_progress.finish()
+
+    return encoded_count, store_changed
+
+# Live enrollment: /enroll and /unenroll update the gallery without a reload
+ENROLL_QUEUE_SIZE = 64  # Pending enrollment requests before /enroll answers 429
+ENROLL_RECENT = 200  # Enrollment outcomes kept for /enroll/<student_id>
+ENROLL_PUBLISH_DELAY = 1.0  # Seconds an applied enrollment may wait for the rest of its burst (worker mode)
+enrollment_queue = queue.Queue(maxsize=ENROLL_QUEUE_SIZE)
+enrollment_jobs = OrderedDict()  # student_id -> state of its latest enrollment request
+enrollment_lock = threading.Lock()
+enrollment_worker = None
+enrollment_stats = {'enrolled': 0, 'unenrolled': 0, 'failed': 0, 'rejected': 0, 'persisted': 0}
+
+def fetch_enrollment_row(conn, student_id):
+    """One active student's row and checksum, or None"""
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(f"""
+    SELECT s.id, s.reg_no, s.first_name, s.last_name, s.department_id, s.option_id, s.student_photos,
+           {STUDENT_CHECKSUM_SQL} AS checksum
+    FROM students s
+    WHERE s.id = %s AND s.student_photos IS NOT NULL AND s.student_photos != ''
+    AND s.status = 'active'
+    """, (student_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row
+
+def apply_enrollment(student_id, entry=None, checksum=None):
+    """
+    Swap in a gallery with one student's rows replaced (or removed when
+    entry is None), built from the current one without touching the others
+    """
+    global face_encodings_cache, face_gallery
+
+    with reload_lock:
+        encodings = dict(face_encodings_cache)
+        encodings.pop(student_id, None)
+        if entry:
+            encodings[student_id] = entry
+        gallery = face_gallery.updated([entry] if entry else [], removed=[student_id])
 
-        conn = mysql.connector.connect(**db_config)
+        if checksum is None:
+            student_sync_state.pop(student_id, None)
+        else:
+            student_sync_state[student_id] = checksum
+        face_gallery = gallery
+        face_encodings_cache = encodings
+
+def enroll_student(student_id, encode_pool=None):
+    """Encode one student's images and add them to the live gallery; returns the templates added"""
+    with db_connection() as conn:
+        student = fetch_enrollment_row(conn, student_id)
+    if student is None:
+        # Deactivated, deleted or without photos: nothing to match against
+        unenroll_student(student_id)
+        return 0
+
+    for path in [p for p, (sid, _) in missing_paths.items() if sid == student_id]:
+        missing_paths.pop(path)
+    images = plan_student_images(student)
+    encode_student_images([(student_id, images)], encode_pool)
+    entry, _ = build_student_entry(student, images)
+    apply_enrollment(student_id, entry, student['checksum'])
+    return entry['photo_count'] if entry else 0
+
+def unenroll_student(student_id):
+    """Drop a student from the live gallery until a refresh finds them active again"""
+    for path in [p for p, (sid, _) in missing_paths.items() if sid == student_id]:
+        missing_paths.pop(path)
+    apply_enrollment(student_id)
+
+def persist_enrollments():
+    """Write the enrolled changes to the gallery store in one go"""
+    global face_encodings_cache
+    with reload_lock:
+        encodings = dict(face_encodings_cache)
+        persist_gallery(encodings)
+        face_encodings_cache = encodings
+    enrollment_stats['persisted'] += 1
+
+def set_enrollment_state(student_id, **state):
+    with enrollment_lock:
+        job = enrollment_jobs.pop(student_id, {})
+        job.update(state)
+        enrollment_jobs[student_id] = job
+        while len(enrollment_jobs) > ENROLL_RECENT:
+            enrollment_jobs.popitem(last=False)
+
+def run_enrollments():
+    """
+    Worker thread: applies queued requests one at a time. Photos are encoded
+    in a separate process so enrollment never holds the GIL against
+    /recognize, and the gallery store is rewritten once the queue is empty.
+    """
+    encode_pool = None
+    store_stale = False
+    while True:
+        try:
+            action, student_id, queued_at = enrollment_queue.get(timeout=1 if store_stale else None)
+        except queue.Empty:
+            try:
+                persist_enrollments()
+            except Exception as e:
+                logger.warning(f"Could not persist enrolled students: {str(e)}")
+            store_stale = False
+            continue
+
+        set_enrollment_state(student_id, state='running')
+        try:
+            if action == 'enroll':
+                if encode_pool is None:
+                    encode_pool = enrollment_pool(1)
+                templates = enroll_student(student_id, encode_pool)
+            else:
+                templates = 0
+                unenroll_student(student_id)
+            store_stale = True
+
+            latency_ms = round((time.perf_counter() - queued_at) * 1000, 1)
+            enrollment_stats['enrolled' if action == 'enroll' else 'unenrolled'] += 1
+            set_enrollment_state(student_id, state='done', templates=templates, latency_ms=latency_ms,
+                                 finished_at=datetime.now().isoformat())
+            logger.info(f"{action.capitalize()}ed student {student_id} ({templates} templates) in {latency_ms} ms")
+        except Exception as e:
+            enrollment_stats['failed'] += 1
+            set_enrollment_state(student_id, state='failed', error=str(e), finished_at=datetime.now().isoformat())
+            logger.error(f"Error in {action} of student {student_id}: {str(e)}")
+
+def queue_enrollment(action, student_id):
+    """Queue an enroll/unenroll request; raises queue.Full when the queue is at capacity"""
+    global enrollment_worker
+    with enrollment_lock:
+        if enrollment_worker is None:
+            enrollment_worker = threading.Thread(target=run_enrollments, name='enrollment', daemon=True)
+            enrollment_worker.start()
+    try:
+        enrollment_queue.put_nowait((action, student_id, time.perf_counter()))
+    except queue.Full:
+        enrollment_stats['rejected'] += 1
+        raise
+    set_enrollment_state(student_id, action=action, state='queued', queued_at=datetime.now().isoformat())
+
+# Session roster index
+SESSION_ROSTER_IDLE_TTL = 4 * 3600  # Rosters unused for this long are evicted
+session_rosters = {}  # session_id -> resolved roster
+roster_lock = threading.Lock()
+
+def fetch_session_scope(session_id):
+    """
+    Department and option of an attendance session (primary key lookup).
+    Sessions only store their option, so the department comes from the course.
+    """
+    with db_connection() as conn:
         cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+        SELECT c.department_id, sess.option_id
+        FROM attendance_sessions sess
+        LEFT JOIN courses c ON c.id = sess.course_id
+        WHERE sess.id = %s
+        """, (session_id,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row
 
-        # Get students with photos from students table (including JSON biometric data)
-        query = """
-        SELECT DISTINCT s.id, s.reg_no, s.first_name, s.last_name, s.student_photos
-        FROM students s
-        WHERE s.student_photos IS NOT NULL AND s.student_photos != ''
-        AND s.status = 'active'
-        """
-        cursor.execute(query)
-        students = cursor.fetchall()
+def get_session_roster(session_id, gallery):
+    """
+    Resolve a session's roster to a boolean mask over the gallery students.
+
+    The session's department/option is always read from attendance_sessions,
+    once, and cached, so every worker resolves a session the same way; the
+    mask is recomputed in memory whenever the gallery is rebuilt.
+    """
+    session_id = str(session_id)
+    now = time.time()
+
+    with roster_lock:
+        # Evict rosters of sessions that were never ended explicitly
+        for stale_id in [sid for sid, r in session_rosters.items() if now - r['last_used'] > SESSION_ROSTER_IDLE_TTL]:
+            session_rosters.pop(stale_id)
+        roster = session_rosters.get(session_id)
+
+    if roster is None:
+        # Looked up without holding roster_lock; a concurrent lookup of the same session is harmless
+        scope = fetch_session_scope(session_id)
+        if not scope:
+            return None
+        with roster_lock:
+            roster = session_rosters.setdefault(session_id, {
+                'session_id': session_id,
+                'department_id': scope['department_id'],
+                'option_id': scope['option_id'],
+                'gallery': None,
+                'started_at': now
+            })
+
+    with roster_lock:
+        if roster['gallery'] is not gallery:
+            mask = gallery.roster_mask(roster['department_id'], roster['option_id'])
+            roster.update(gallery=gallery, mask=mask, size=int(mask.sum()))
+
+        roster['last_used'] = now
+        return roster
+
+# Write-behind attendance and recognition audit
+WRITE_PUT_TIMEOUT = 0.05  # Seconds a request waits for queue space before spooling its rows
+WRITE_RETRY_INTERVAL = 10  # Seconds after a failed write before the database is tried again
+# INSERT IGNORE relies on uq_attendance_session_student (see update_database_schema.php): two
+# workers flushing the same student both pass NOT EXISTS, and the key rejects the second row
+ATTENDANCE_INSERT_SQL = """
+INSERT IGNORE INTO attendance_records (session_id, student_id, status, method, recorded_at)
+SELECT pending.session_id, pending.student_id, 'present', 'face_recognition', pending.recorded_at
+FROM ({}) pending
+WHERE EXISTS (SELECT 1 FROM attendance_sessions sess WHERE sess.id = pending.session_id AND sess.end_time IS NULL)
+AND NOT EXISTS (SELECT 1 FROM attendance_records ar
+                WHERE ar.session_id = pending.session_id AND ar.student_id = pending.student_id)
+"""
+ATTENDANCE_KEY_SQL = "SHOW INDEX FROM attendance_records WHERE Key_name = 'uq_attendance_session_student'"
+AUDIT_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS recognition_audit (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    session_id INT NULL,
+    student_id INT NULL,
+    outcome VARCHAR(32) NOT NULL,
+    confidence DECIMAL(5,1) NULL,
+    faces_detected SMALLINT NOT NULL DEFAULT 0,
+    mode VARCHAR(16) NOT NULL DEFAULT 'single',
+    recognized_at DATETIME(3) NOT NULL,
+    INDEX idx_session (session_id),
+    INDEX idx_recognized_at (recognized_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+AUDIT_INSERT_SQL = ("INSERT INTO recognition_audit "
+                    "(session_id, student_id, outcome, confidence, faces_detected, mode, recognized_at) VALUES {}")
 
-        logger.info(f"Found {len(students)} students with biometric data")
+class WriteBehindQueue:
+    """
+    Bounded queue of attendance and audit rows written by one thread.
+
+    Rows are gathered until WRITE_BATCH_SIZE or WRITE_FLUSH_MS after the
+    first one, then written as one multi-row INSERT per table through the
+    pool. Attendance inserts skip pairs already recorded, so replaying a
+    batch is harmless. When the queue stays full or the database is down,
+    rows are appended to a local spool file and replayed once writes succeed.
+    Each process appends only to its own spool (the path plus its pid), and
+    spools left by processes that have exited are claimed by renaming them,
+    so concurrent workers never lose or replay a row twice.
+    """
 
-        for student in students:
+    def __init__(self, enabled, batch_size, flush_ms, queue_size, spool_path):
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.flush_wait = max(0, flush_ms) / 1000
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.spool_path = spool_path
+        self.spool_lock = threading.Lock()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.audit_table_ready = False
+        self.attendance_key_checked = False
+        self.retry_at = 0
+        self.stats = {'queued': 0, 'batches': 0, 'attendance_written': 0, 'attendance_existing': 0,
+                      'audit_written': 0, 'spooled': 0, 'replayed': 0, 'dropped': 0, 'write_failures': 0,
+                      'write_ms': 0.0, 'last_error': None}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+                self.thread.start()
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def submit(self, row):
+        """Queue one row; returns 'queued', or 'spooled' when the queue stayed full"""
+        self.start()
+        try:
+            self.queue.put(row, timeout=WRITE_PUT_TIMEOUT)
+        except queue.Full:
+            self.spool([row])
+            return 'spooled'
+        self.count('queued')
+        return 'queued'
+
+    def collect(self):
+        """Wait for a first row (or a spool retry tick), then gather until the batch is full or the wait expires"""
+        try:
+            batch = [self.queue.get(timeout=WRITE_RETRY_INTERVAL)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.flush_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.perf_counter()
             try:
-                student_id = student['id']
-                student_encodings = []
-
-                # Parse biometric data from JSON
-                biometric_data = student.get('student_photos')
-                if biometric_data:
-                    try:
-                        bio_json = json.loads(biometric_data) if isinstance(biometric_data, str) else biometric_data
-                        face_images = bio_json.get('biometric_data', {}).get('face_images', [])
-
-                        for face_img in face_images:
-                            image_path = face_img.get('image_path')
-                            if image_path:
-                                # Handle both relative and absolute paths
-                                if not os.path.isabs(image_path):
-                                    full_path = os.path.join(os.getcwd(), image_path)
-                                else:
-                                    full_path = image_path
-
-                                if os.path.exists(full_path):
-                                    try:
-                                        # Load and encode face
-                                        image = face_recognition.load_image_file(full_path)
-                                        face_encodings = face_recognition.face_encodings(image)
-
-                                        if face_encodings:
-                                            student_encodings.append(face_encodings[0])
-                                            logger.info(f"Loaded face encoding for student {student['reg_no']} from {full_path}")
-                                    except Exception as e:
-                                        logger.warning(f"Failed to process image {full_path} for student {student['reg_no']}: {str(e)}")
-                                        continue
-                                else:
-                                    logger.warning(f"Image file not found: {full_path} for student {student['reg_no']}")
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Invalid JSON in student_photos for student {student['reg_no']}: {str(e)}")
-                        continue
-
-                # If we have encodings for this student, store them
-                if student_encodings:
-                    # Use the first encoding as primary, but store all for potential future use
-                    encodings[student_id] = {
-                        'encoding': student_encodings[0].tolist(),  # Convert numpy array to list
-                        'all_encodings': [enc.tolist() for enc in student_encodings],  # Store all encodings
-                        'student_id': student_id,
-                        'reg_no': student['reg_no'],
-                        'name': f"{student['first_name']} {student['last_name']}",
-                        'photo_count': len(student_encodings)
-                    }
-                    logger.info(f"Loaded {len(student_encodings)} face encodings for student {student['reg_no']}")
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
 
+    def run(self):
+        while True:
+            try:
+                self.run_once()
             except Exception as e:
-                logger.error(f"Error loading faces for student {student['reg_no']}: {str(e)}")
-                continue
+                # The writer must survive anything, or every later row would only be spooled
+                logger.error(f"Write-behind writer error: {str(e)}")
+                time.sleep(1)
+
+    def run_once(self):
+        """Write (or spool) one batch, then replay spooled rows when the database is usable"""
+        batch = self.collect()
+        if batch:
+            if time.time() < self.retry_at:
+                self.spool(batch)
+                return
+            try:
+                self.flush(batch)
+            except Exception as e:
+                self.write_failed(e)
+                self.spool(batch)
+                return
 
+        if time.time() >= self.retry_at and self.spool_files():
+            self.replay_spool()
+
+    def write_failed(self, error):
+        self.retry_at = time.time() + WRITE_RETRY_INTERVAL
+        with self.lock:
+            self.stats['write_failures'] += 1
+            self.stats['last_error'] = str(error)
+        logger.warning(f"Write-behind batch failed, spooling until the database is back: {str(error)}")
+
+    def flush(self, rows):
+        """
+        Write rows in one transaction. A batch the database rejects (a
+        deleted student, bad data) is retried row by row so only the
+        offending rows are dropped; connection errors propagate
+        """
+        from mysql.connector import errors
+
+        try:
+            self.write_rows(rows)
+        except (errors.IntegrityError, errors.DataError, errors.ProgrammingError) as e:
+            if len(rows) == 1:
+                self.count('dropped')
+                logger.warning(f"Dropped write-behind row {rows[0]}: {str(e)}")
+                if rows[0][0] == 'attendance':
+                    settle_attendance([(rows[0][1], rows[0][2])], written=False)
+                return
+            for row in rows:
+                self.flush([row])
+
+    def write_rows(self, rows):
+        attendance = {}
+        audits = []
+        for row in rows:
+            if row[0] == 'attendance':
+                attendance.setdefault((row[1], row[2]), row[3])
+            else:
+                audits.append(row[1:])
+
+        started = time.perf_counter()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                inserted = 0
+                if attendance and not self.attendance_key_checked:
+                    cursor.execute(ATTENDANCE_KEY_SQL)
+                    if not cursor.fetchall():
+                        logger.warning("attendance_records has no uq_attendance_session_student key; "
+                                       "run update_database_schema.php or concurrent writers may duplicate rows")
+                    self.attendance_key_checked = True
+                if attendance:
+                    pending = ' UNION ALL '.join(['SELECT %s AS session_id, %s AS student_id, %s AS recorded_at']
+                                                 + ['SELECT %s, %s, %s'] * (len(attendance) - 1))
+                    params = [value for (session_id, student_id), recorded_at in attendance.items()
+                              for value in (session_id, student_id, recorded_at)]
+                    cursor.execute(ATTENDANCE_INSERT_SQL.format(pending), params)
+                    inserted = cursor.rowcount
+                if audits:
+                    if not self.audit_table_ready:
+                        cursor.execute(AUDIT_TABLE_SQL)
+                        self.audit_table_ready = True
+                    cursor.execute(AUDIT_INSERT_SQL.format(', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(audits))),
+                                   [value for audit in audits for value in audit])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+        settle_attendance(attendance, written=True)
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['attendance_written'] += inserted
+            self.stats['attendance_existing'] += len(attendance) - inserted
+            self.stats['audit_written'] += len(audits)
+            self.stats['write_ms'] += (time.perf_counter() - started) * 1000
+
+    def own_spool(self):
+        return f'{self.spool_path}.{os.getpid()}'
+
+    def spool(self, rows):
+        """Append rows to this process's spool file, synced to disk, for replay once the database is back"""
+        try:
+            with self.spool_lock:
+                os.makedirs(os.path.dirname(self.spool_path) or '.', exist_ok=True)
+                with open(self.own_spool(), 'a') as f:
+                    f.write(''.join(json.dumps(row) + '\n' for row in rows))
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.count('spooled', len(rows))
+        except OSError as e:
+            self.count('dropped', len(rows))
+            logger.error(f"Could not spool {len(rows)} write-behind rows: {str(e)}")
+
+    def spool_files(self):
+        """
+        Spool files this process may replay: its own, and any (including
+        half-replayed '.replay' claims) of processes that have since exited
+        """
+        pid = os.getpid()
+        paths = [self.spool_path] if os.path.exists(self.spool_path) else []  # Written before per-process spools
+        for path in glob.glob(f'{glob.escape(self.spool_path)}.*'):
+            try:
+                owner = int(path[len(self.spool_path) + 1:].split('.')[0])
+                if owner != pid:
+                    os.kill(owner, 0)
+                    continue
+            except ProcessLookupError:
+                pass
+            except (ValueError, OSError):
+                continue
+            paths.append(path)
+        return paths
+
+    def replay_spool(self):
+        """Claim spooled rows file by file and write them in batches; whatever fails goes back to the spool"""
+        claimed = f'{self.own_spool()}.replay'
+        for path in self.spool_files():
+            rows = []
+            with self.spool_lock:
+                try:
+                    if path != claimed:
+                        os.replace(path, claimed)
+                except FileNotFoundError:
+                    continue  # Another worker claimed it first
+                with open(claimed) as f:
+                    for line in f:
+                        try:
+                            rows.append(json.loads(line))
+                        except ValueError:
+                            continue  # A line cut short by a crash mid-write
+                os.remove(claimed)
+
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                try:
+                    self.flush(batch)
+                except Exception as e:
+                    self.write_failed(e)
+                    self.spool(rows[start:])
+                    return
+                self.count('replayed', len(batch))
+            if rows:
+                logger.info(f"Replayed {len(rows)} spooled write-behind rows from {path}")
+
+    def drain(self):
+        """Spool rows still queued at shutdown"""
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows:
+            self.spool(rows)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        try:
+            spool_bytes = sum(os.path.getsize(path) for path in self.spool_files())
+        except OSError:
+            spool_bytes = 0
+        batches = stats.pop('batches')
+        write_ms = stats.pop('write_ms')
+        return dict(stats, enabled=self.enabled, batches=batches, queue_depth=self.queue.qsize(),
+                    spool_bytes=spool_bytes, avg_write_ms=round(write_ms / batches, 1) if batches else 0)
+
+write_behind = WriteBehindQueue(config.WRITE_BEHIND, config.WRITE_BATCH_SIZE, config.WRITE_FLUSH_MS,
+                                config.WRITE_QUEUE_SIZE, config.WRITE_SPOOL_PATH)
+atexit.register(write_behind.drain)
+
+session_attendance = {}  # session_id -> students present, students with a row not yet written, last use
+attendance_lock = threading.Lock()
+
+def fetch_session_attendance(session_id):
+    """Students already recorded for a session (one indexed query)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT student_id FROM attendance_records WHERE session_id = %s", (session_id,))
+        present = {row[0] for row in cursor.fetchall()}
         cursor.close()
-        conn.close()
+        return present
 
-    except Error as e:
-        logger.error(f"Database error: {str(e)}")
+def session_present(session_id):
+    """
+    A session's attendance state: 'present' is loaded from the database the
+    first time the session is seen and grows as queued rows are committed,
+    'pending' holds students whose row is queued or spooled
+    """
+    session_id = int(session_id)
+    now = time.time()
+    with attendance_lock:
+        for stale_id in [sid for sid, s in session_attendance.items() if now - s['last_used'] > SESSION_ROSTER_IDLE_TTL]:
+            session_attendance.pop(stale_id)
+        known = session_attendance.get(session_id)
+        if known is not None:
+            known['last_used'] = now
+            return known
+
+    try:
+        present = fetch_session_attendance(session_id)
     except Exception as e:
-        logger.error(f"Error loading student faces: {str(e)}")
+        # Duplicates are still skipped by the insert itself
+        logger.warning(f"Could not load attendance of session {session_id}: {str(e)}")
+        present = set()
+
+    with attendance_lock:
+        known = session_attendance.setdefault(session_id, {'present': set(), 'pending': set(), 'last_used': now})
+        known['present'] |= present
+        return known
+
+def settle_attendance(pairs, written):
+    """Writer side: move (session_id, student_id) pairs out of pending, into present once committed"""
+    with attendance_lock:
+        for session_id, student_id in pairs:
+            known = session_attendance.get(session_id)
+            if known is not None:
+                known['pending'].discard(student_id)
+                if written:
+                    known['present'].add(student_id)
+
+def mark_attendance(session_id, student_id, recognized_at):
+    """
+    'already_present' without a query once the student's row is committed,
+    'queued' while it waits (without queueing it again), otherwise queue it
+    """
+    known = session_present(session_id)
+    with attendance_lock:
+        if student_id in known['present']:
+            return 'already_present'
+        if student_id in known['pending']:
+            return 'queued'
+        known['pending'].add(student_id)
+    return write_behind.submit(('attendance', int(session_id), int(student_id),
+                                recognized_at.strftime('%Y-%m-%d %H:%M:%S')))
+
+def record_recognition(result, session_id=None, mode='single', mark=False):
+    """
+    Queue the audit rows of a recognition and, when mark is set (the session
+    was resolved), the attendance of each auto-marked student. Each face's
+    result gets an 'attendance' state.
+    """
+    now = datetime.now()
+    audit_session = int(session_id) if session_id is not None and str(session_id).isdigit() else None
+    faces = result['faces'] if mode == 'group' else [result]
+
+    for face in faces:
+        if mark and audit_session and face.get('recognized') and face.get('auto_mark'):
+            face['attendance'] = mark_attendance(audit_session, face['student_id'], now)
+        outcome = recognition_outcome(dict(face, faces_detected=1) if mode == 'group' else face)
+        write_behind.submit(('audit', audit_session, face.get('student_id'), outcome, face.get('confidence'),
+                             1 if mode == 'group' else face.get('faces_detected', 0), mode,
+                             now.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]))
+    if mode == 'group' and not faces:
+        write_behind.submit(('audit', audit_session, None, 'no_face', None, 0, mode,
+                             now.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]))
+
+# Room for form fields and multipart headers
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+UPLOAD_FORM_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+def max_request_size(content_type):
+    """
+    Largest request body accepted for the given upload style. Either form
+    type can carry the legacy base64 'image_data' field: 4/3 of the image,
+    plus 1/16 when urlencoded ('+' and '/', one character in 32, become
+    3-byte escapes). The exact limit is applied to the decoded bytes.
+    """
+    if content_type in UPLOAD_FORM_TYPES:
+        base64_size = -(-config.MAX_IMAGE_SIZE // 3) * 4
+        return base64_size * 17 // 16 + UPLOAD_FORM_OVERHEAD
+    return config.MAX_IMAGE_SIZE + UPLOAD_FORM_OVERHEAD
 
-    face_encodings_cache = encodings
-    cache_timestamp = time.time()
+# Newer Flask caps a non-file form field at 500 KB; let image_data reach the form limit
+app.config['MAX_FORM_MEMORY_SIZE'] = max_request_size('multipart/form-data')
 
-    logger.info(f"Loaded face encodings for {len(encodings)} students")
-    return encodings
+class ImageTooLarge(ValueError):
+    """Upload exceeds Config.MAX_IMAGE_SIZE"""
+
+    def __init__(self, size):
+        super().__init__(f'Image too large ({size} bytes, limit {config.MAX_IMAGE_SIZE})')
+        self.size = size
+
+def read_image_upload():
+    """
+    Image bytes of a /recognize request, from a raw image/* (or
+    application/octet-stream) body, a multipart 'image' file, or the legacy
+    base64 'image_data' form field. Returns None when there is no image.
+    Raises ImageTooLarge before the body is read when it exceeds the limit.
+    """
+    if request.content_length is not None and request.content_length > max_request_size(request.mimetype):
+        raise ImageTooLarge(request.content_length)
+
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        # Chunked bodies have no length up front: read one byte past the limit
+        image_bytes = request.stream.read(config.MAX_IMAGE_SIZE + 1)
+        if len(image_bytes) > config.MAX_IMAGE_SIZE:
+            raise ImageTooLarge(len(image_bytes))
+        return image_bytes or None
+
+    upload = request.files.get('image')
+    if upload is not None:
+        image_bytes = upload.read(config.MAX_IMAGE_SIZE + 1)
+        if len(image_bytes) > config.MAX_IMAGE_SIZE:
+            raise ImageTooLarge(len(image_bytes))
+        return image_bytes or None
+
+    image_data = request.form.get('image_data')
+    if not image_data:
+        return None
+
+    # Remove data URL prefix if present
+    if image_data.startswith('data:image'):
+        image_data = image_data.partition(',')[2]
+    image_bytes = base64.b64decode(image_data)
+    if len(image_bytes) > config.MAX_IMAGE_SIZE:
+        raise ImageTooLarge(len(image_bytes))
+    return image_bytes
+
+def open_image(source, max_dimension=None):
+    """
+    Open an image path or file object as an RGB PIL Image. JPEGs are decoded
+    in draft mode, which lets libjpeg scale by 1/2, 1/4 or 1/8 while
+    decoding, so a large photo comes out at no less than max_dimension
+    (default DECODE_MAX_DIMENSION) without ever being materialised at full size.
+    """
+    image = Image.open(source)
+
+    max_dimension = max_dimension or config.DECODE_MAX_DIMENSION
+    if image.format == 'JPEG' and max_dimension and max(image.size) > max_dimension:
+        scale = max_dimension / max(image.size)
+        image.draft('RGB', (max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    else:
+        image.load()
+
+    return image
+
+def decode_image(image_bytes):
+    """Decode uploaded image bytes to an RGB PIL Image (see open_image)"""
+    return open_image(io.BytesIO(image_bytes))
 
 def process_image_data(image_data):
     """
@@ -175,27 +2072,49 @@ def process_image_data(image_data):
     try:
         # Remove data URL prefix if present
         if image_data.startswith('data:image'):
-            image_data = image_data.split(',')[1]
-
-        # Decode base64
-        image_bytes = base64.b64decode(image_data)
-
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_bytes))
-
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+            image_data = image_data.partition(',')[2]
 
-        return image
+        # Decode base64 and convert to PIL Image
+        return decode_image(base64.b64decode(image_data))
 
     except Exception as e:
         logger.error(f"Error processing image data: {str(e)}")
         raise
 
+PREPROCESS_CONTRAST = 1.2  # Increase contrast by 20%
+PREPROCESS_BRIGHTNESS = 1.1  # Increase brightness by 10%
+
+# The enhancement table is applied two bytes at a time through a 65536-entry uint16
+# table, in chunks so np.take's index temporary stays small
+PREPROCESS_PAIR_INDEX = np.arange(65536, dtype=np.uint16).view(np.uint8)
+PREPROCESS_CHUNK = 1 << 16  # Byte pairs per np.take call
+
+# Reusable frame arrays of each pipeline thread, one pair per position in a batch
+preprocess_buffers = threading.local()
+preprocess_stats = {'frames': 0, 'buffer_allocations': 0, 'buffer_bytes_allocated': 0}
+preprocess_stats_lock = threading.Lock()
+
+def enhancement_lut(image):
+    """
+    uint8 lookup table (256 entries, the same for every channel) with the same
+    output as ImageEnhance.Contrast(1.2) followed by ImageEnhance.Brightness(1.1):
+    the contrast blend pivots on the mean of the greyscale ('L') image, taken
+    from its histogram as ImageEnhance.Contrast does (the weighted channel
+    means differ from it, since 'L' rounds per pixel), and both blends
+    truncate like PIL's.
+    """
+    histogram = np.array(image.convert('L').histogram(), dtype=np.float64)
+    mean = int(histogram @ np.arange(256) / (image.width * image.height) + 0.5)
+
+    levels = np.arange(256, dtype=np.float32)
+    contrast = np.clip((mean + np.float32(PREPROCESS_CONTRAST) * (levels - mean)).astype(np.int32), 0, 255)
+    brightness = np.clip((np.float32(PREPROCESS_BRIGHTNESS) * contrast.astype(np.float32)).astype(np.int32), 0, 255)
+    return brightness.astype(np.uint8)
+
 def preprocess_image(image):
     """
-    Preprocess image for better face recognition
+    Preprocess image for better face recognition: contrast and brightness
+    in a single lookup-table pass
     """
     try:
         # Convert to RGB if necessary
@@ -203,217 +2122,1099 @@ def preprocess_image(image):
             image = image.convert('RGB')
 
         # Enhance contrast and brightness for better recognition
-        from PIL import ImageEnhance
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(1.2)  # Increase contrast by 20%
-
-        enhancer = ImageEnhance.Brightness(image)
-        image = enhancer.enhance(1.1)  # Increase brightness by 10%
-
-        return image
+        return image.point(enhancement_lut(image).tolist() * 3)
     except Exception as e:
         logger.warning(f"Image preprocessing failed: {str(e)}")
         return image
 
-def recognize_face(captured_image, student_encodings, session_filter=None):
+def frame_buffer(slot, shape):
+    """This thread's uint8 array for a batch position, reallocated only when the frame size changes"""
+    buffers = getattr(preprocess_buffers, 'arrays', None)
+    if buffers is None:
+        buffers = preprocess_buffers.arrays = {}
+
+    buffer = buffers.get(slot)
+    if buffer is None or buffer.shape != shape:
+        buffer = buffers[slot] = np.empty(shape, dtype=np.uint8)
+        with preprocess_stats_lock:
+            preprocess_stats['buffer_allocations'] += 1
+            preprocess_stats['buffer_bytes_allocated'] += buffer.nbytes
+    return buffer
+
+def enhance_to_buffer(image, lut, pair_lut, slot):
+    """Apply the enhancement table to an RGB image straight into a reusable, writable, C-contiguous array"""
+    buffer = frame_buffer(slot, (image.height, image.width, 3))
+    source = np.asarray(image).reshape(-1)
+    target = buffer.reshape(-1)
+    pairs = source.size // 2
+    source_pairs = source[:pairs * 2].view(np.uint16)
+    target_pairs = target[:pairs * 2].view(np.uint16)
+    for start in range(0, pairs, PREPROCESS_CHUNK):
+        end = start + PREPROCESS_CHUNK
+        np.take(pair_lut, source_pairs[start:end], out=target_pairs[start:end], mode='clip')
+    if source.size % 2:
+        target[-1] = lut[source[-1]]
+    return buffer
+
+def prepare_frame(image, position, detection_max_dimension=None):
     """
-    Enhanced face recognition with improved accuracy and multiple validation checks
+    Fused preprocessing stage for the frame at a batch position: RGB,
+    contrast and brightness, the detection-resolution copy, and both as
+    contiguous uint8 arrays in this thread's reusable buffers. The lookup
+    table is written directly into the buffers; the detection copy is
+    downscaled first and enhanced with the full frame's table.
+    Returns (RGB image, full-resolution array, detection array)
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    lut = enhancement_lut(image)
+    pair_lut = lut[PREPROCESS_PAIR_INDEX].view(np.uint16)
+    detect_image = downscale_for_detection(image, detection_max_dimension)
+
+    array = enhance_to_buffer(image, lut, pair_lut, (position, 'full'))
+    detect_array = array if detect_image is image else enhance_to_buffer(detect_image, lut, pair_lut,
+                                                                         (position, 'detect'))
+    with preprocess_stats_lock:
+        preprocess_stats['frames'] += 1
+    return image, array, detect_array
+
+# Per-stage latency metrics
+METRICS_WINDOW = 2048  # Most recent samples per stage that percentiles are computed over
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+LATENCY_STAGES = ('upload', 'decode', 'roster', 'queue_wait', 'preprocess', 'detect_hog', 'detect_cnn',
+                  'encode', 'match', 'rejitter', 'total')
+RECOGNITION_OUTCOMES = ('recognized', 'low_confidence', 'uncertain', 'no_face', 'multiple_faces',
+                        'face_too_small', 'no_match', 'error', 'rejected')
+
+class LatencyMetrics:
+    """
+    Rolling per-stage latency samples and outcome counters.
+
+    Each stage keeps its last METRICS_WINDOW samples for the p50/p95/p99
+    plus a lifetime count and sum; render_text() writes them in the
+    Prometheus text format.
     """
-    try:
-        # Preprocess the captured image
-        captured_image = preprocess_image(captured_image)
 
-        # Convert PIL to numpy array
-        captured_array = np.array(captured_image)
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.samples = {stage: deque(maxlen=window) for stage in LATENCY_STAGES}
+        self.counts = dict.fromkeys(LATENCY_STAGES, 0)
+        self.sums = dict.fromkeys(LATENCY_STAGES, 0.0)
+        self.outcomes = dict.fromkeys(RECOGNITION_OUTCOMES, 0)
+
+    def observe(self, stage, ms):
+        with self.lock:
+            self.samples[stage].append(ms)
+            self.counts[stage] += 1
+            self.sums[stage] += ms
+
+    def count(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] += 1
+
+    def snapshot(self):
+        with self.lock:
+            samples = {stage: np.array(values) for stage, values in self.samples.items()}
+            counts, sums, outcomes = dict(self.counts), dict(self.sums), dict(self.outcomes)
+
+        stages = {}
+        for stage, values in samples.items():
+            quantiles = np.percentile(values, [q * 100 for q in METRICS_QUANTILES]) if len(values) else [0] * 3
+            stages[stage] = dict(
+                {f'p{round(q * 100)}_ms': round(float(v), 2) for q, v in zip(METRICS_QUANTILES, quantiles)},
+                count=counts[stage], sum_ms=round(sums[stage], 1), window=len(values))
+        return {'stages': stages, 'outcomes': outcomes}
+
+    def render_text(self):
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP face_recognition_stage_latency_ms Per-stage recognition latency over the recent window',
+            '# TYPE face_recognition_stage_latency_ms summary'
+        ]
+        for stage, stats in snapshot['stages'].items():
+            for q in METRICS_QUANTILES:
+                lines.append(f'face_recognition_stage_latency_ms{{stage="{stage}",quantile="{q}"}} '
+                             f'{stats[f"p{round(q * 100)}_ms"]}')
+            lines.append(f'face_recognition_stage_latency_ms_sum{{stage="{stage}"}} {stats["sum_ms"]}')
+            lines.append(f'face_recognition_stage_latency_ms_count{{stage="{stage}"}} {stats["count"]}')
+        lines += [
+            '# HELP face_recognition_outcomes_total Recognition requests by outcome',
+            '# TYPE face_recognition_outcomes_total counter'
+        ]
+        for outcome, count in snapshot['outcomes'].items():
+            lines.append(f'face_recognition_outcomes_total{{outcome="{outcome}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+latency_metrics = LatencyMetrics(METRICS_WINDOW)
+
+def observe_stage(timings, stage, start):
+    """Record the milliseconds since start (a perf_counter value) for one stage"""
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    timings[stage] = timings.get(stage, 0) + elapsed_ms
+    latency_metrics.observe(stage, elapsed_ms)
+    return elapsed_ms
+
+def recognition_outcome(result):
+    """Outcome category of a recognition result, for the outcome counters"""
+    if result.get('message', '').startswith('Face recognition error'):
+        return 'error'
+    if result.get('recognized'):
+        return 'recognized'
+    if not result.get('faces_detected'):
+        return 'no_face'
+    if result['faces_detected'] > 1:
+        return 'multiple_faces'
+    if result.get('confidence_level') == 'uncertain':
+        return 'uncertain'
+    if 'student_id' in result:
+        return 'low_confidence'
+    if 'face_ratio' in result:
+        return 'face_too_small'
+    return 'no_match'
+
+def rounded_timings(timings):
+    return {stage: round(ms, 1) for stage, ms in timings.items()}
+
+# Detection timings per detection resolution, for tuning DETECTION_MAX_DIMENSION
+detection_stats = {}
+detection_stats_lock = threading.Lock()
+
+def downscale_for_detection(image, max_dimension=None):
+    """Copy of the image whose longest side is at most max_dimension (default DETECTION_MAX_DIMENSION)"""
+    width, height = image.size
+    max_dimension = max_dimension or config.DETECTION_MAX_DIMENSION
+    if max_dimension and max(width, height) > max_dimension:
+        scale = max_dimension / max(width, height)
+        return image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    return image
+
+def scale_locations(locations, full_size, detection_size):
+    """Map (top, right, bottom, left) boxes from detection to full resolution"""
+    width, height = full_size
+    scale_x = width / detection_size[0]
+    scale_y = height / detection_size[1]
+    return [
+        (max(0, round(top * scale_y)), min(width, round(right * scale_x)),
+         min(height, round(bottom * scale_y)), max(0, round(left * scale_x)))
+        for top, right, bottom, left in locations
+    ]
 
-        # Find faces in captured image using CNN model for better accuracy
-        face_locations = face_recognition.face_locations(captured_array, model="cnn", number_of_times_to_upsample=config.UPSAMPLE_FACTOR)
-        face_encodings = face_recognition.face_encodings(captured_array, face_locations, num_jitters=config.NUM_JITTERS)
+def array_size(array):
+    """(width, height) of an image array"""
+    return array.shape[1], array.shape[0]
 
-        if not face_encodings:
-            return {
-                'recognized': False,
-                'message': 'No faces detected in captured image. Please ensure good lighting and face visibility.',
-                'faces_detected': 0
-            }
+def detect_faces(detect_array, full_size, model="cnn"):
+    """
+    Detect faces on the copy downscaled to DETECTION_MAX_DIMENSION (see
+    prepare_frame) and map the boxes back to the full_size resolution.
+    Returns (face locations as (top, right, bottom, left), detection size)
+    """
+    locations = face_recognition.face_locations(detect_array, model=model,
+                                                number_of_times_to_upsample=config.UPSAMPLE_FACTOR)
+    return scale_locations(locations, full_size, array_size(detect_array)), array_size(detect_array)
 
-        if len(face_encodings) > 1:
-            return {
-                'recognized': False,
-                'message': 'Multiple faces detected. Please ensure only one person is in frame.',
-                'faces_detected': len(face_encodings)
-            }
+def detect_faces_batch(detect_arrays, full_sizes):
+    """
+    CNN detection for several frames. Frames with the same detection size
+    share one batch_face_locations call.
+    Returns a list of (face locations, detection size, detect ms per frame)
+    """
+    groups = {}
+    for i, detect_array in enumerate(detect_arrays):
+        groups.setdefault(array_size(detect_array), []).append(i)
+
+    results = [None] * len(detect_arrays)
+    for size, indices in groups.items():
+        start = time.perf_counter()
+        arrays = [detect_arrays[i] for i in indices]
+        if len(arrays) > 1:
+            batch_locations = face_recognition.batch_face_locations(
+                arrays, number_of_times_to_upsample=config.UPSAMPLE_FACTOR, batch_size=len(arrays))
+        else:
+            batch_locations = [face_recognition.face_locations(
+                arrays[0], model="cnn", number_of_times_to_upsample=config.UPSAMPLE_FACTOR)]
+        per_frame_ms = (time.perf_counter() - start) * 1000 / len(indices)
+
+        for i, locations in zip(indices, batch_locations):
+            results[i] = (scale_locations(locations, full_sizes[i], size), size, per_frame_ms)
+    return results
+
+def record_detection_timing(model, detection_size, detect_ms, encode_ms):
+    """Accumulate per-model/resolution timings and return this request's detection info"""
+    resolution = f"{detection_size[0]}x{detection_size[1]}"
+    with detection_stats_lock:
+        stats = detection_stats.setdefault(f"{model} {resolution}",
+                                           {'count': 0, 'detect_ms_total': 0.0, 'encode_ms_total': 0.0})
+        stats['count'] += 1
+        stats['detect_ms_total'] += detect_ms
+        stats['encode_ms_total'] += encode_ms
+
+    return {
+        'model': model,
+        'resolution': resolution,
+        'detect_ms': round(detect_ms, 1),
+        'encode_ms': round(encode_ms, 1)
+    }
+
+# Detector/jitter cascade counters
+cascade_stats = {'requests': 0, 'cnn_fallback': 0, 'rejitter': 0, 'slow_path': 0}
+
+def needs_refinement(ranked):
+    """Match fails the margin check or sits near the medium-confidence boundary"""
+    confidence = 1 - ranked[0][1]
+    if len(ranked) > 1 and confidence - (1 - ranked[1][1]) < config.CONFIDENCE_MARGIN:
+        return True
+    return abs(confidence - config.CONFIDENCE_THRESHOLD_MEDIUM) < config.CASCADE_BOUNDARY_BAND
+
+def record_cascade(stages):
+    """Count which cascade stages ran, to track the share of fast-path traffic"""
+    cnn = 'cnn' in stages
+    rejitter = 'rejitter' in stages
+    with detection_stats_lock:
+        cascade_stats['requests'] += 1
+        cascade_stats['cnn_fallback'] += cnn
+        cascade_stats['rejitter'] += rejitter
+        cascade_stats['slow_path'] += cnn or rejitter
+
+def recognize_face(captured_image, gallery, session_mask=None):
+    """
+    Enhanced face recognition with improved accuracy and multiple validation checks
+    """
+    return recognize_faces([(captured_image, session_mask)], gallery)[0]
 
-        captured_encoding = face_encodings[0]
-        best_match = None
-        best_distance = float('inf')
-        all_matches = []
-        second_best_distance = float('inf')
+def recognition_error(e):
+    logger.error(f"Error in face recognition: {str(e)}")
+    return {
+        'recognized': False,
+        'message': f'Face recognition error: {str(e)}',
+        'faces_detected': 0
+    }
 
-        # Compare with student encodings using multiple validation checks
-        for student_id, student_data in student_encodings.items():
-            # Skip if session filter is provided and student not in session
-            if session_filter and student_id not in session_filter:
-                continue
+def recognize_faces(frames, gallery):
+    """
+    Recognition pipeline for a batch of (image, session_mask) frames.
 
-            try:
-                # Use all encodings for this student for better recognition
-                student_all_encodings = student_data.get('all_encodings', [student_data['encoding']])
-
-                # Find the best match among all encodings for this student
-                student_best_distance = float('inf')
-                student_best_encoding = None
-
-                for encoding_data in student_all_encodings:
-                    stored_encoding = np.array(encoding_data)
-                    distance = face_recognition.face_distance([stored_encoding], captured_encoding)[0]
-
-                    if distance < student_best_distance:
-                        student_best_distance = distance
-                        student_best_encoding = encoding_data
-
-                # Use the best distance for this student
-                distance = student_best_distance
-
-                confidence = 1 - distance
-
-                all_matches.append({
-                    'student_id': student_id,
-                    'name': student_data['name'],
-                    'reg_no': student_data['reg_no'],
-                    'distance': float(distance),
-                    'confidence': confidence,
-                    'photo_count': student_data.get('photo_count', 1)
-                })
-
-                # Track best and second best matches for validation
-                if distance < best_distance:
-                    second_best_distance = best_distance
-                    best_distance = distance
-                    best_match = student_data
-                elif distance < second_best_distance:
-                    second_best_distance = distance
+    Detection and encoding run per frame (with the CNN fallback batched), all
+    probes are matched against the gallery in one matrix product, and each
+    frame then gets the usual validation checks. Returns one result per frame.
+    """
+    jobs = [{'image': image, 'mask': session_mask, 'result': None, 'timings': {}} for image, session_mask in frames]
+
+    # Cascade: cheap HOG detection first, on a downscaled copy; boxes come back
+    # in full-resolution coordinates
+    for position, job in enumerate(jobs):
+        try:
+            # Preprocess the captured image into this thread's reusable arrays
+            preprocess_start = time.perf_counter()
+            job['image'], job['array'], job['detect_array'] = prepare_frame(job['image'], position)
+            observe_stage(job['timings'], 'preprocess', preprocess_start)
+
+            job['stages'] = ['hog']
+            detect_start = time.perf_counter()
+            job['locations'], job['detection_size'] = detect_faces(job['detect_array'], job['image'].size, model="hog")
+            job['detect_ms'] = observe_stage(job['timings'], 'detect_hog', detect_start)
+        except Exception as e:
+            job['result'] = recognition_error(e)
+
+    # CNN only where HOG found nothing, batched across frames
+    misses = [job for job in jobs if job['result'] is None and not job['locations']]
+    if misses:
+        try:
+            detections = detect_faces_batch([job['detect_array'] for job in misses], [job['image'].size for job in misses])
+            for job, (locations, size, cnn_ms) in zip(misses, detections):
+                job['stages'].append('cnn')
+                job['locations'], job['detection_size'] = locations, size
+                job['detect_ms'] += cnn_ms
+                job['timings']['detect_cnn'] = cnn_ms
+                latency_metrics.observe('detect_cnn', cnn_ms)
+        except Exception as e:
+            for job in misses:
+                job['result'] = recognition_error(e)
+
+    # Fast single-jitter encoding from the full-resolution image
+    for job in jobs:
+        if job['result'] is not None:
+            continue
+        try:
+            encode_start = time.perf_counter()
+            job['encodings'] = face_recognition.face_encodings(job['array'], job['locations'],
+                                                               num_jitters=config.FAST_NUM_JITTERS)
+            encode_ms = observe_stage(job['timings'], 'encode', encode_start)
+            job['stages'].append('encode')
+
+            job['detection'] = record_detection_timing(job['stages'][-2], job['detection_size'],
+                                                       job['detect_ms'], encode_ms)
+            job['detection']['stages'] = job['stages']
+
+            if len(job['encodings']) != 1:
+                record_cascade(job['stages'])
+                job['result'] = face_count_result(job)
+        except Exception as e:
+            job['result'] = recognition_error(e)
+
+    # Best distance per student across all of their encodings, best first,
+    # skipping students outside the session if a roster mask is provided.
+    # All probes share one matrix product.
+    pending = [job for job in jobs if job['result'] is None]
+    try:
+        match_start = time.perf_counter()
+        ranked_all = gallery.match_many([job['encodings'][0] for job in pending],
+                                        [job['mask'] for job in pending], top_k=3)
+        match_ms = (time.perf_counter() - match_start) * 1000 / max(1, len(pending))
+        for job, ranked in zip(pending, ranked_all):
+            job['ranked'] = ranked
+            job['timings']['match'] = match_ms
+            latency_metrics.observe('match', match_ms)
+
+        # Ambiguous results: re-encode with more jitters and match again
+        refine = [job for job in pending if job['ranked'] and needs_refinement(job['ranked'])]
+        if refine:
+            refine_start = time.perf_counter()
+            probes = [face_recognition.face_encodings(job['array'], job['locations'],
+                                                      num_jitters=config.NUM_JITTERS)[0] for job in refine]
+            refine_ms = (time.perf_counter() - refine_start) * 1000 / len(refine)
+            for job, ranked in zip(refine, gallery.match_many(probes, [job['mask'] for job in refine], top_k=3)):
+                job['ranked'] = ranked
+                job['stages'].append('rejitter')
+                job['detection']['refine_ms'] = round(refine_ms, 1)
+                job['timings']['rejitter'] = refine_ms
+                latency_metrics.observe('rejitter', refine_ms)
+    except Exception as e:
+        for job in pending:
+            job['result'] = recognition_error(e)
 
+    for job in pending:
+        if job['result'] is None:
+            record_cascade(job['stages'])
+            try:
+                job['result'] = build_recognition_result(job, gallery)
             except Exception as e:
-                logger.error(f"Error comparing with student {student_id}: {str(e)}")
-                continue
+                job['result'] = recognition_error(e)
 
-        # Sort matches by confidence
-        all_matches.sort(key=lambda x: x['confidence'], reverse=True)
+    # Stage timings travel with the result; /recognize decides whether to return them
+    for job in jobs:
+        job['result']['timings'] = job['timings']
+    return [job['result'] for job in jobs]
 
-        if not best_match:
-            return {
-                'recognized': False,
-                'message': 'No matching faces found in database. Student may not be registered.',
-                'faces_detected': len(face_encodings)
-            }
+def face_count_result(job):
+    """Result for a frame without exactly one face"""
+    if not job['encodings']:
+        return {
+            'recognized': False,
+            'message': 'No faces detected in captured image. Please ensure good lighting and face visibility.',
+            'faces_detected': 0,
+            'detection': job['detection']
+        }
 
-        confidence = 1 - best_distance
-
-        # Enhanced validation: Check if match is significantly better than second best
-        if second_best_distance < float('inf'):
-            second_best_confidence = 1 - second_best_distance
-            confidence_difference = confidence - second_best_confidence
-
-            if confidence_difference < config.CONFIDENCE_MARGIN:
-                logger.warning(f"Low confidence margin: {confidence_difference:.3f} (required: {config.CONFIDENCE_MARGIN})")
-                return {
-                    'recognized': False,
-                    'message': f'Face match uncertain. Please try again with better lighting. Confidence: {confidence:.1%}',
-                    'faces_detected': len(face_encodings),
-                    'confidence': round(confidence * 100, 1),
-                    'confidence_level': 'uncertain'
-                }
-
-        # Determine confidence level with stricter thresholds
-        if confidence >= config.CONFIDENCE_THRESHOLD_HIGH:
-            confidence_level = 'high'
-            auto_mark = True
-        elif confidence >= config.CONFIDENCE_THRESHOLD_MEDIUM:
-            confidence_level = 'medium'
-            auto_mark = True  # Allow auto-mark for medium confidence with validation
-        else:
-            confidence_level = 'low'
-            auto_mark = False
-
-        # Additional validation for face quality
-        face_location = face_locations[0]
-        face_width = face_location[2] - face_location[0]
-        face_height = face_location[3] - face_location[1]
-        face_area = face_width * face_height
-        image_area = captured_array.shape[0] * captured_array.shape[1]
-
-        # Check if face is large enough
-        face_ratio = face_area / image_area
-        if face_ratio < config.MIN_FACE_RATIO:
-            logger.warning(f"Face too small: {face_ratio:.3f} (minimum: {config.MIN_FACE_RATIO})")
+    return {
+        'recognized': False,
+        'message': 'Multiple faces detected. Please ensure only one person is in frame.',
+        'faces_detected': len(job['encodings']),
+        'detection': job['detection']
+    }
+
+def build_recognition_result(job, gallery):
+    """Validate the ranked matches of a single-face frame and build its result"""
+    ranked = job['ranked']
+    face_encodings = job['encodings']
+    captured_array = job['array']
+    detection = job['detection']
+
+    if not ranked:
+        return {
+            'recognized': False,
+            'message': 'No matching faces found in database. Student may not be registered.',
+            'faces_detected': len(face_encodings),
+            'detection': detection
+        }
+
+    all_matches = []
+    for student_index, distance in ranked:
+        student_data = gallery.student(student_index)
+        all_matches.append(dict(student_data, distance=distance, confidence=1 - distance))
+
+    best_match = gallery.student(ranked[0][0])
+    best_distance = ranked[0][1]
+    second_best_distance = ranked[1][1] if len(ranked) > 1 else float('inf')
+
+    confidence = 1 - best_distance
+
+    # Enhanced validation: Check if match is significantly better than second best
+    if second_best_distance < float('inf'):
+        second_best_confidence = 1 - second_best_distance
+        confidence_difference = confidence - second_best_confidence
+
+        if confidence_difference < config.CONFIDENCE_MARGIN:
+            logger.warning(f"Low confidence margin: {confidence_difference:.3f} (required: {config.CONFIDENCE_MARGIN})")
             return {
                 'recognized': False,
-                'message': 'Face too small or too far from camera. Please move closer.',
+                'message': f'Face match uncertain. Please try again with better lighting. Confidence: {confidence:.1%}',
                 'faces_detected': len(face_encodings),
-                'face_ratio': round(face_ratio * 100, 1)
+                'confidence': round(confidence * 100, 1),
+                'confidence_level': 'uncertain',
+                'detection': detection
             }
 
-        # Check face position (should be reasonably centered)
-        face_center_x = (face_location[0] + face_location[2]) / 2
-        face_center_y = (face_location[1] + face_location[3]) / 2
-        image_center_x = captured_array.shape[1] / 2
-        image_center_y = captured_array.shape[0] / 2
-
-        # Allow some tolerance for face positioning
-        x_offset = abs(face_center_x - image_center_x) / image_center_x
-        y_offset = abs(face_center_y - image_center_y) / image_center_y
-
-        if x_offset > config.CENTER_TOLERANCE or y_offset > config.CENTER_TOLERANCE:
-            logger.warning(f"Face not centered: x_offset={x_offset:.2f}, y_offset={y_offset:.2f}")
-
+    # Determine confidence level with stricter thresholds
+    if confidence >= config.CONFIDENCE_THRESHOLD_HIGH:
+        confidence_level = 'high'
+        auto_mark = True
+    elif confidence >= config.CONFIDENCE_THRESHOLD_MEDIUM:
+        confidence_level = 'medium'
+        auto_mark = True  # Allow auto-mark for medium confidence with validation
+    else:
+        confidence_level = 'low'
+        auto_mark = False
+
+    # Additional validation for face quality
+    # Locations are (top, right, bottom, left) in full-resolution pixels
+    top, right, bottom, left = job['locations'][0]
+    face_width = right - left
+    face_height = bottom - top
+    face_area = face_width * face_height
+    image_area = captured_array.shape[0] * captured_array.shape[1]
+
+    # Check if face is large enough
+    face_ratio = face_area / image_area
+    if face_ratio < config.MIN_FACE_RATIO:
+        logger.warning(f"Face too small: {face_ratio:.3f} (minimum: {config.MIN_FACE_RATIO})")
         return {
-            'recognized': confidence >= config.CONFIDENCE_THRESHOLD_MEDIUM,
-            'student_id': best_match['student_id'],
-            'student_name': best_match['name'],
-            'student_reg': best_match['reg_no'],
-            'confidence': round(confidence * 100, 1),
-            'confidence_level': confidence_level,
-            'auto_mark': auto_mark,
-            'distance': float(best_distance),
+            'recognized': False,
+            'message': 'Face too small or too far from camera. Please move closer.',
             'faces_detected': len(face_encodings),
             'face_ratio': round(face_ratio * 100, 1),
-            'top_matches': all_matches[:3],  # Return top 3 matches
-            'validation': {
-                'face_size_ok': face_ratio >= config.MIN_FACE_RATIO,
-                'confidence_margin_ok': confidence_difference >= config.CONFIDENCE_MARGIN if 'confidence_difference' in locals() else True,
-                'face_centered': x_offset <= config.CENTER_TOLERANCE and y_offset <= config.CENTER_TOLERANCE
-            }
+            'detection': detection
         }
 
-    except Exception as e:
-        logger.error(f"Error in face recognition: {str(e)}")
+    # Check face position (should be reasonably centered)
+    face_center_x = (left + right) / 2
+    face_center_y = (top + bottom) / 2
+    image_center_x = captured_array.shape[1] / 2
+    image_center_y = captured_array.shape[0] / 2
+
+    # Allow some tolerance for face positioning
+    x_offset = abs(face_center_x - image_center_x) / image_center_x
+    y_offset = abs(face_center_y - image_center_y) / image_center_y
+
+    if x_offset > config.CENTER_TOLERANCE or y_offset > config.CENTER_TOLERANCE:
+        logger.warning(f"Face not centered: x_offset={x_offset:.2f}, y_offset={y_offset:.2f}")
+
+    return {
+        'recognized': confidence >= config.CONFIDENCE_THRESHOLD_MEDIUM,
+        'student_id': best_match['student_id'],
+        'student_name': best_match['name'],
+        'student_reg': best_match['reg_no'],
+        'confidence': round(confidence * 100, 1),
+        'confidence_level': confidence_level,
+        'auto_mark': auto_mark,
+        'distance': float(best_distance),
+        'faces_detected': len(face_encodings),
+        'face_ratio': round(face_ratio * 100, 1),
+        'top_matches': all_matches[:3],  # Return top 3 matches
+        'face_location': [top, right, bottom, left],
+        'detection': detection,
+        'validation': {
+            'face_size_ok': face_ratio >= config.MIN_FACE_RATIO,
+            'confidence_margin_ok': confidence_difference >= config.CONFIDENCE_MARGIN if 'confidence_difference' in locals() else True,
+            'face_centered': x_offset <= config.CENTER_TOLERANCE and y_offset <= config.CENTER_TOLERANCE
+        }
+    }
+
+# Group-photo mode
+GROUP_CANDIDATES = 5  # Closest students per face, from the gallery scan, that enter the assignment
+
+def assign_faces(distances):
+    """
+    One-to-one assignment of faces (rows) to candidate students (columns),
+    closest pairs first, so no two faces claim the same student.
+    Returns the assigned column per face, or -1
+    """
+    assignment = np.full(distances.shape[0], -1)
+    taken = np.zeros(distances.shape[1], dtype=bool)
+    for flat_index in np.argsort(distances, axis=None, kind='stable'):
+        face, column = divmod(int(flat_index), distances.shape[1])
+        if assignment[face] < 0 and not taken[column]:
+            assignment[face] = column
+            taken[column] = True
+            if (assignment >= 0).all() or taken.all():
+                break
+    return assignment
+
+def group_face_result(row, location, gallery, candidates, distances, assignment):
+    """Result for the face in distance matrix row `row`, with the usual confidence and margin checks"""
+    top, right, bottom, left = location
+    result = {'face_location': [top, right, bottom, left], 'recognized': False}
+
+    column = assignment[row]
+    if column < 0:
+        result['message'] = 'No matching student left for this face.'
+        return result
+
+    student = gallery.student(candidates[column])
+    distance = float(distances[row, column])
+    confidence = 1 - distance
+    others = np.delete(distances[row], column)
+    second_confidence = 1 - float(others.min()) if len(others) else None
+    result.update({
+        'student_id': student['student_id'],
+        'student_name': student['name'],
+        'student_reg': student['reg_no'],
+        'confidence': round(confidence * 100, 1),
+        'distance': distance
+    })
+
+    # Same margin rule as single-face frames, against this face's closest other student
+    if second_confidence is not None and confidence - second_confidence < config.CONFIDENCE_MARGIN:
+        result.update({
+            'confidence_level': 'uncertain',
+            'auto_mark': False,
+            'message': f'Face match uncertain. Confidence: {confidence:.1%}'
+        })
+        return result
+
+    if confidence >= config.CONFIDENCE_THRESHOLD_HIGH:
+        confidence_level = 'high'
+    elif confidence >= config.CONFIDENCE_THRESHOLD_MEDIUM:
+        confidence_level = 'medium'
+    else:
+        confidence_level = 'low'
+    result.update({
+        'recognized': confidence >= config.CONFIDENCE_THRESHOLD_MEDIUM,
+        'confidence_level': confidence_level,
+        'auto_mark': confidence >= config.CONFIDENCE_THRESHOLD_MEDIUM
+    })
+    return result
+
+def recognize_group(image, gallery, session_mask=None):
+    """
+    Recognize every face in a (high-resolution) group photo.
+
+    All faces are detected and encoded in one pass, every probe is matched
+    against the gallery (or session roster) in one scan, and an exact
+    faces x candidate-students distance matrix is assigned one-to-one.
+    """
+    timings = {}
+    preprocess_start = time.perf_counter()
+    image, array, detect_array = prepare_frame(image, 0, config.GROUP_DETECTION_MAX_DIMENSION)
+    observe_stage(timings, 'preprocess', preprocess_start)
+
+    # HOG only: CNN detection at group resolution is too slow on CPU
+    detect_start = time.perf_counter()
+    locations, detection_size = detect_faces(detect_array, image.size, model="hog")
+    detect_ms = observe_stage(timings, 'detect_hog', detect_start)
+    locations = sorted(locations, key=lambda box: (box[3], box[0]))[:config.GROUP_MAX_FACES]
+
+    usable = [i for i, (top, right, bottom, left) in enumerate(locations)
+              if min(right - left, bottom - top) >= config.GROUP_MIN_FACE_SIZE]
+    encode_start = time.perf_counter()
+    probes = face_recognition.face_encodings(array, [locations[i] for i in usable],
+                                             num_jitters=config.FAST_NUM_JITTERS) if usable else []
+    encode_ms = observe_stage(timings, 'encode', encode_start)
+
+    faces = [None] * len(locations)
+    if probes:
+        match_start = time.perf_counter()
+        ranked = gallery.match_many(probes, [session_mask] * len(probes), top_k=GROUP_CANDIDATES)
+        candidates = sorted({student_index for matches in ranked for student_index, _ in matches})
+        if candidates:
+            distances = gallery.student_distances(candidates, probes)
+            assignment = assign_faces(distances)
+            for row, i in enumerate(usable):
+                faces[i] = dict(face_index=i, **group_face_result(row, locations[i], gallery, candidates,
+                                                                   distances, assignment))
+        observe_stage(timings, 'match', match_start)
+
+    for i, (top, right, bottom, left) in enumerate(locations):
+        if faces[i] is None:
+            small = i not in usable
+            faces[i] = {
+                'face_index': i,
+                'face_location': [top, right, bottom, left],
+                'recognized': False,
+                'message': ('Face too small to match reliably.' if small
+                            else 'No matching faces found in database.')
+            }
+
+    recognized = [face for face in faces if face['recognized']]
+    return {
+        'mode': 'group',
+        'recognized': bool(recognized),
+        'faces_detected': len(locations),
+        'recognized_count': len(recognized),
+        'faces': faces,
+        'message': (f'Recognized {len(recognized)} of {len(locations)} faces' if locations
+                    else 'No faces detected in captured image.'),
+        'detection': record_detection_timing('hog', detection_size, detect_ms, encode_ms),
+        'timings': timings
+    }
+
+class MicroBatcher:
+    """
+    Bounded queue in front of recognize_faces().
+
+    Request threads submit a frame and block on its result; each worker takes
+    up to BATCH_MAX_SIZE frames, waiting at most BATCH_MAX_WAIT_MS after the
+    first one, and runs them through the pipeline together. A full queue is
+    rejected straight away so callers can back off.
+    """
+
+    def __init__(self, max_size, max_wait_ms, queue_size, workers):
+        self.max_size = max(1, max_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.workers = max(1, workers)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stats = {'batches': 0, 'frames': 0, 'rejected': 0, 'max_batch': 0,
+                      'queue_wait_ms': 0.0, 'batch_ms': 0.0}
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.run, name=f'recognize-batch-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, image, gallery, session_mask):
+        """Recognize one frame; raises queue.Full when the queue is at capacity"""
+        self.start()
+        job = {'image': image, 'gallery': gallery, 'mask': session_mask,
+               'queued_at': time.perf_counter(), 'done': threading.Event(), 'result': None}
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.stats['rejected'] += 1
+            raise
+
+        if not job['done'].wait(config.BATCH_RESULT_TIMEOUT):
+            raise TimeoutError('Recognition timed out waiting for a batch slot')
+        return job['result']
+
+    def collect(self):
+        """Block for one frame, then gather more until the batch is full or the wait expires"""
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            started = time.perf_counter()
+
+            # Frames queued across a gallery reload are matched against their own snapshot
+            groups = {}
+            for job in batch:
+                groups.setdefault(id(job['gallery']), []).append(job)
+
+            for jobs in groups.values():
+                try:
+                    results = recognize_faces([(job['image'], job['mask']) for job in jobs], jobs[0]['gallery'])
+                except Exception as e:
+                    results = [recognition_error(e) for _ in jobs]
+                for job, result in zip(jobs, results):
+                    job['result'] = result
+
+            batch_ms = (time.perf_counter() - started) * 1000
+            queue_wait_ms = 0.0
+            for job in batch:
+                wait_ms = (started - job['queued_at']) * 1000
+                queue_wait_ms += wait_ms
+                job['result']['batch'] = {'size': len(batch), 'queue_wait_ms': round(wait_ms, 1)}
+                job['result'].setdefault('timings', {})['queue_wait'] = wait_ms
+                latency_metrics.observe('queue_wait', wait_ms)
+                job['done'].set()
+
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['frames'] += len(batch)
+                self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+                self.stats['queue_wait_ms'] += queue_wait_ms
+                self.stats['batch_ms'] += batch_ms
+
+    def retry_after(self):
+        """Whole seconds until the current queue should have drained"""
+        with self.lock:
+            batches = self.stats['batches']
+            avg_batch_ms = self.stats['batch_ms'] / batches if batches else 1000
+        pending_batches = -(-self.queue.qsize() // self.max_size) / self.workers
+        return max(1, int(-(-pending_batches * avg_batch_ms // 1000)))
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        batches = stats['batches']
         return {
-            'recognized': False,
-            'message': f'Face recognition error: {str(e)}',
-            'faces_detected': 0
+            'max_size': self.max_size,
+            'max_wait_ms': round(self.max_wait * 1000, 1),
+            'queue_size': self.queue.maxsize,
+            'queue_depth': self.queue.qsize(),
+            'workers': self.workers,
+            'batches': batches,
+            'frames': stats['frames'],
+            'rejected': stats['rejected'],
+            'max_batch': stats['max_batch'],
+            'avg_batch_size': round(stats['frames'] / batches, 2) if batches else 0,
+            'avg_queue_wait_ms': round(stats['queue_wait_ms'] / stats['frames'], 1) if stats['frames'] else 0,
+            'avg_batch_ms': round(stats['batch_ms'] / batches, 1) if batches else 0
         }
 
+recognition_batcher = MicroBatcher(config.BATCH_MAX_SIZE, config.BATCH_MAX_WAIT_MS,
+                                   config.BATCH_QUEUE_SIZE, config.BATCH_WORKERS)
+
+# Per-session front gate
+GATE_THUMB_WIDTH = 80  # Width of the grayscale thumbnail frames are compared on
+GATE_DIFF_THRESHOLD = 4.0  # Mean absolute grey-level change below which a frame counts as unchanged
+GATE_TRACK_THRESHOLD = 6.0  # Mean absolute change of the face patch below which the face is still there
+GATE_TRACK_RADIUS = 3  # Thumbnail pixels the face patch is searched around its last position
+GATE_MAX_REUSE_AGE = 5  # Seconds a computed result may be reused for later frames
+GATE_MEMO_SIZE = 32  # Payload hashes remembered per session
+GATE_MEMO_TTL = 30  # Seconds an identical payload is answered from the memo
+GATE_REQUEST_FIELDS = ('batch', 'timings')  # Fields describing one computation, not kept for reuse
+session_gates = {}  # session_id -> FrameGate
+gates_lock = threading.Lock()
+
+def gate_thumbnail(image):
+    """Small grayscale copy of a frame for the change and tracking tests"""
+    height = max(1, round(image.height * GATE_THUMB_WIDTH / image.width))
+    return np.asarray(image.resize((GATE_THUMB_WIDTH, height), Image.BILINEAR, reducing_gap=2.0).convert('L'),
+                      dtype=np.float32)
+
+class FrameGate:
+    """
+    Decides per session whether a frame needs the recognition pipeline.
+
+    In order: a payload seen recently (client retry) is answered from a hash
+    memo; a frame whose thumbnail barely differs from the last computed one
+    reuses that result; and when the last result recognized someone, the
+    face patch is searched in a small window of the new thumbnail and the
+    identity is reused while it is still found there. Reuse stops after
+    GATE_MAX_REUSE_AGE seconds or when the gallery changes.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.lock = threading.Lock()
+        self.memo = OrderedDict()  # payload digest -> (result, gallery, computed_at)
+        self.reference = None
+        self.last_used = time.time()
+        self.stats = {'frames': 0, 'computed': 0, 'memo': 0, 'unchanged': 0, 'tracked': 0}
+
+    def recognize(self, image_bytes, gallery, session_mask):
+        """Recognition result for a frame, computed or reused"""
+        digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+        now = time.time()
+
+        with self.lock:
+            self.last_used = now
+            self.stats['frames'] += 1
+            reused = self.from_memo(digest, gallery, now)
+        if reused is not None:
+            return reused
+
+        decode_start = time.perf_counter()
+        image = decode_image(image_bytes)
+        decode_ms = observe_stage({}, 'decode', decode_start)
+        thumb = gate_thumbnail(image)
+        with self.lock:
+            reused = self.from_reference(thumb, gallery, now)
+        if reused is not None:
+            reused['timings'] = {'decode': decode_ms}
+            return reused
+
+        result = recognition_batcher.submit(image, gallery, session_mask)
+        result.setdefault('timings', {})['decode'] = decode_ms
+        with self.lock:
+            self.stats['computed'] += 1
+            # Errors are not worth repeating to later frames
+            if not result.get('message', '').startswith('Face recognition error'):
+                self.remember(digest, thumb, image.width, result, gallery, now)
+        result['gate'] = {'reused': False, 'source': 'computed'}
+        return result
+
+    def reuse(self, source, result, computed_at, now):
+        """A fresh copy of a remembered result, marked as reused"""
+        self.stats[source] += 1
+        # The pipeline did not run for this frame, so none of its timings apply
+        return dict(result, timings={}, gate={'reused': True, 'source': source,
+                                              'age_ms': round((now - computed_at) * 1000, 1)})
+
+    def from_memo(self, digest, gallery, now):
+        entry = self.memo.get(digest)
+        if entry is None:
+            return None
+        result, memo_gallery, computed_at = entry
+        if memo_gallery is not gallery or now - computed_at > GATE_MEMO_TTL:
+            del self.memo[digest]
+            return None
+        self.memo.move_to_end(digest)
+        return self.reuse('memo', result, computed_at, now)
+
+    def from_reference(self, thumb, gallery, now):
+        reference = self.reference
+        if (reference is None or reference['gallery'] is not gallery
+                or now - reference['computed_at'] > GATE_MAX_REUSE_AGE
+                or reference['thumb'].shape != thumb.shape):
+            return None
+
+        # Nothing moved: same answer as last time (this covers empty rooms too)
+        if np.abs(thumb - reference['thumb']).mean() < GATE_DIFF_THRESHOLD:
+            return self.reuse('unchanged', reference['result'], reference['computed_at'], now)
+
+        # Something moved: keep the identity if the face is still where it was
+        box = reference['box']
+        if box is not None and self.track(reference['thumb'], thumb, box):
+            return self.reuse('tracked', reference['result'], reference['computed_at'], now)
+        return None
+
+    def track(self, previous, thumb, box):
+        """Whether the face patch reappears within GATE_TRACK_RADIUS of its last position"""
+        top, right, bottom, left = box
+        patch = previous[top:bottom, left:right]
+        height, width = patch.shape
+        best = np.inf
+        for dy in range(-GATE_TRACK_RADIUS, GATE_TRACK_RADIUS + 1):
+            for dx in range(-GATE_TRACK_RADIUS, GATE_TRACK_RADIUS + 1):
+                y, x = top + dy, left + dx
+                if y < 0 or x < 0 or y + height > thumb.shape[0] or x + width > thumb.shape[1]:
+                    continue
+                best = min(best, np.abs(thumb[y:y + height, x:x + width] - patch).mean())
+        return best < GATE_TRACK_THRESHOLD
+
+    def remember(self, digest, thumb, image_width, result, gallery, now):
+        # Keep our own copy without the per-request batch and timing fields: the
+        # caller goes on to add request fields (status, attendance...) to the
+        # result it returns, which must not leak into later reused answers
+        result = {key: value for key, value in result.items() if key not in GATE_REQUEST_FIELDS}
+        self.memo[digest] = (result, gallery, now)
+        while len(self.memo) > GATE_MEMO_SIZE:
+            self.memo.popitem(last=False)
+
+        # Only a recognized face is tracked; its box is kept in thumbnail pixels
+        box = None
+        if result.get('recognized') and result.get('face_location'):
+            scale = thumb.shape[1] / image_width
+            top, right, bottom, left = (round(v * scale) for v in result['face_location'])
+            if bottom - top >= 4 and right - left >= 4:
+                box = (top, right, bottom, left)
+
+        self.reference = {'thumb': thumb, 'result': result, 'box': box, 'gallery': gallery, 'computed_at': now}
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        reused = stats['memo'] + stats['unchanged'] + stats['tracked']
+        stats['reuse_rate'] = round(reused / stats['frames'], 3) if stats['frames'] else 0
+        return stats
+
+def get_frame_gate(session_id):
+    """The session's front gate, created on first use"""
+    session_id = str(session_id)
+    now = time.time()
+    with gates_lock:
+        for stale_id in [sid for sid, g in session_gates.items() if now - g.last_used > SESSION_ROSTER_IDLE_TTL]:
+            session_gates.pop(stale_id)
+        gate = session_gates.get(session_id)
+        if gate is None:
+            gate = session_gates[session_id] = FrameGate(session_id)
+        return gate
+
+# Streaming sessions
+STREAM_RECENT_RESULTS = 50  # Recognitions kept per streaming session
+STREAM_REPEAT_WINDOW = 30  # Seconds within which a student's recognition is flagged as a repeat
+stream_stats = {'connections': 0, 'active': 0, 'frames': 0, 'processed': 0, 'dropped': 0}
+stream_stats_lock = threading.Lock()
+
+def count_stream(key, amount=1):
+    with stream_stats_lock:
+        stream_stats[key] += amount
+
+class StreamSession:
+    """
+    One open /stream connection for an attendance session.
+
+    Incoming frames land in a single slot: a frame that arrives before the
+    previous one was picked up replaces it, so the worker always recognizes
+    the newest frame and latency cannot build up behind a slow pipeline.
+    The session's roster and its recent recognitions live here for as long
+    as the connection is open.
+    """
+
+    def __init__(self, ws, session_id):
+        self.ws = ws
+        self.session_id = session_id
+        self.condition = threading.Condition()
+        self.latest = None
+        self.sequence = 0
+        self.closed = False
+        self.dropped = 0
+        self.recent = deque(maxlen=STREAM_RECENT_RESULTS)
+        self.last_seen = {}  # student_id -> time of last recognition
+        self.roster = None
+
+    def put(self, frame_bytes):
+        """Reader side: offer a frame, replacing one still waiting"""
+        with self.condition:
+            if self.latest is not None:
+                self.dropped += 1
+                count_stream('dropped')
+            self.sequence += 1
+            self.latest = (self.sequence, frame_bytes, time.perf_counter())
+            self.condition.notify()
+        count_stream('frames')
+
+    def take(self):
+        """Worker side: wait for the newest frame; None once closed"""
+        with self.condition:
+            while self.latest is None and not self.closed:
+                self.condition.wait()
+            frame, self.latest = self.latest, None
+            return None if self.closed else frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def resolve_roster(self):
+        """Roster mask for the session, following gallery reloads"""
+        gallery = current_gallery()
+        try:
+            self.roster = get_session_roster(self.session_id, gallery)
+        except Exception as e:
+            logger.warning(f"Could not filter stream by session: {str(e)}")
+            self.roster = None
+        return gallery, self.roster['mask'] if self.roster and self.roster['size'] else None
+
+    def recognize(self, frame_bytes):
+        if len(frame_bytes) > config.MAX_IMAGE_SIZE:
+            raise ImageTooLarge(len(frame_bytes))
+
+        gallery, session_mask = self.resolve_roster()
+        result = get_frame_gate(self.session_id).recognize(frame_bytes, gallery, session_mask)
+
+        if result.get('recognized'):
+            now = time.time()
+            student_id = result['student_id']
+            result['repeat'] = now - self.last_seen.get(student_id, 0) < STREAM_REPEAT_WINDOW
+            self.last_seen[student_id] = now
+            self.recent.append({'student_id': student_id, 'confidence': result['confidence'], 'at': now})
+        return result
+
+    def run(self):
+        """Worker thread: recognize the newest frame and push the result"""
+        while True:
+            frame = self.take()
+            if frame is None:
+                return
+            sequence, frame_bytes, received_at = frame
+
+            try:
+                event = self.recognize(frame_bytes)
+            except queue.Full:
+                # The shared queue is saturated: skip this frame, the next one replaces it
+                with self.condition:
+                    self.dropped += 1
+                count_stream('dropped')
+                latency_metrics.count('rejected')
+                continue
+            except Exception as e:
+                event = {'recognized': False, 'message': f'Face recognition error: {str(e)}'}
+
+            count_stream('processed')
+            event.pop('timings', None)
+            latency_metrics.count(recognition_outcome(event))
+            if write_behind.enabled:
+                record_recognition(event, self.session_id, 'stream', mark=self.roster is not None)
+            event.update({
+                'type': 'recognition',
+                'frame': sequence,
+                'dropped': self.dropped,
+                'latency_ms': round((time.perf_counter() - received_at) * 1000, 1),
+                'timestamp': datetime.now().isoformat()
+            })
+            try:
+                self.ws.send(json.dumps(event))
+            except Exception:
+                self.close()
+                return
+
+if Sock is not None:
+    websocket = Sock(app)
+    app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 25, 'max_message_size': config.MAX_IMAGE_SIZE}
+
+    @websocket.route('/stream/<session_id>')
+    def stream(ws, session_id):
+        """
+        Streaming recognition: the client sends binary image frames and gets a
+        JSON 'recognition' event back for each frame that was processed
+        """
+        stream_session = StreamSession(ws, session_id)
+        gallery, session_mask = stream_session.resolve_roster()
+        ws.send(json.dumps({
+            'type': 'ready',
+            'session_id': session_id,
+            'roster_size': stream_session.roster['size'] if stream_session.roster else None,
+            'total_students': len(gallery)
+        }))
+
+        count_stream('connections')
+        count_stream('active')
+        worker = threading.Thread(target=stream_session.run, name=f'stream-{session_id}', daemon=True)
+        worker.start()
+        try:
+            while not stream_session.closed:
+                message = ws.receive()
+                if message is None:
+                    break
+                if isinstance(message, (bytes, bytearray)):
+                    stream_session.put(bytes(message))
+        except ConnectionClosed:
+            pass
+        finally:
+            stream_session.close()
+            worker.join(config.BATCH_RESULT_TIMEOUT)
+            count_stream('active', -1)
+            logger.info(f"Stream for session {session_id} closed after {stream_session.sequence} frames "
+                        f"({stream_session.dropped} dropped)")
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'cached_encodings': len(face_encodings_cache)
+        'cached_encodings': cached_student_count()
     })
 
 @app.route('/recognize', methods=['POST'])
 def recognize():
     """Main face recognition endpoint"""
+    request_start = time.perf_counter()
+    timings = {}
     try:
-        # Get request data
-        image_data = request.form.get('image_data')
-        session_id = request.form.get('session_id')
-        department_id = request.form.get('department_id')
-        option_id = request.form.get('option_id')
+        # Get request data; raw image bodies pass the session in the query string
+        try:
+            image_bytes = read_image_upload()
+            observe_stage(timings, 'upload', request_start)
+        except ImageTooLarge as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e),
+                'recognized': False
+            }), 413
+        session_id = request.values.get('session_id')
+        group_mode = request.values.get('mode') == 'group'
 
-        if not image_data:
+        if not image_bytes:
             return jsonify({
                 'status': 'error',
                 'message': 'No image data provided',
@@ -423,63 +3224,81 @@ def recognize():
         logger.info(f"Processing face recognition request for session {session_id}")
 
         # Load student faces
-        student_encodings = load_student_faces()
+        gallery = current_gallery()
 
-        if not student_encodings:
+        if not len(gallery):
             return jsonify({
                 'status': 'error',
                 'message': 'No student face data available',
                 'recognized': False
             }), 503
 
-        # Process captured image
-        captured_image = process_image_data(image_data)
-
         # Filter students by session if provided
-        session_filter = None
+        session_mask = None
+        roster = None
         if session_id:
             try:
-                # Get students for this session from database
-                import mysql.connector
-                conn = mysql.connector.connect(
-                    host=os.getenv('DB_HOST', 'localhost'),
-                    database=os.getenv('DB_NAME', 'rp_attendance_system'),
-                    user=os.getenv('DB_USER', 'root'),
-                    password=os.getenv('DB_PASS', '')
-                )
-                cursor = conn.cursor()
-
-                query = """
-                SELECT DISTINCT s.id
-                FROM students s
-                INNER JOIN attendance_sessions sess ON (
-                    (sess.department_id = s.department_id) OR
-                    (sess.option_id = s.option_id)
-                )
-                WHERE sess.id = %s
-                """
-                cursor.execute(query, (session_id,))
-                session_students = [row[0] for row in cursor.fetchall()]
-                cursor.close()
-                conn.close()
-
-                if session_students:
-                    session_filter = session_students
-                    logger.info(f"Filtered to {len(session_filter)} students for session {session_id}")
+                roster_start = time.perf_counter()
+                roster = get_session_roster(session_id, gallery)
+                observe_stage(timings, 'roster', roster_start)
+                if roster and roster['size']:
+                    session_mask = roster['mask']
+                    logger.info(f"Filtered to {roster['size']} students for session {session_id}")
 
             except Exception as e:
                 logger.warning(f"Could not filter by session: {str(e)}")
 
-        # Perform face recognition
-        result = recognize_face(captured_image, student_encodings, session_filter)
+        # Perform face recognition, batched with concurrent requests; frames of
+        # a session go through its gate, which may reuse an earlier result
+        try:
+            if group_mode:
+                # Every face in one classroom photo; kept at higher resolution and not gated
+                decode_start = time.perf_counter()
+                image = open_image(io.BytesIO(image_bytes), config.GROUP_DECODE_MAX_DIMENSION)
+                observe_stage(timings, 'decode', decode_start)
+                result = recognize_group(image, gallery, session_mask)
+            elif session_id:
+                result = get_frame_gate(session_id).recognize(image_bytes, gallery, session_mask)
+            else:
+                decode_start = time.perf_counter()
+                image = decode_image(image_bytes)
+                observe_stage(timings, 'decode', decode_start)
+                result = recognition_batcher.submit(image, gallery, session_mask)
+        except queue.Full:
+            latency_metrics.count('rejected')
+            retry_after = recognition_batcher.retry_after()
+            logger.warning(f"Recognition queue full, asking client to retry in {retry_after}s")
+            response = jsonify({
+                'status': 'error',
+                'message': 'Recognition queue is full. Please retry shortly.',
+                'recognized': False,
+                'retry_after': retry_after,
+                'timestamp': datetime.now().isoformat()
+            })
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+
+        timings.update(result.pop('timings', {}))
+        observe_stage(timings, 'total', request_start)
+        if group_mode:
+            for face in result['faces']:
+                latency_metrics.count(recognition_outcome(dict(face, faces_detected=1)))
+            if not result['faces']:
+                latency_metrics.count('no_face')
+        else:
+            latency_metrics.count(recognition_outcome(result))
 
         # Add metadata
         result.update({
             'status': 'success',
             'timestamp': datetime.now().isoformat(),
             'session_id': session_id,
-            'total_students': len(student_encodings)
+            'total_students': len(gallery)
         })
+        if config.RESPONSE_TIMINGS or request.values.get('timings') in ('1', 'true'):
+            result['timings'] = rounded_timings(timings)
+        if write_behind.enabled:
+            record_recognition(result, session_id, 'group' if group_mode else 'single', mark=roster is not None)
 
         logger.info(f"Face recognition result: {result['recognized']} (confidence: {result.get('confidence', 0)}%)")
 
@@ -496,17 +3315,170 @@ def recognize():
 
 @app.route('/reload_cache', methods=['POST'])
 def reload_cache():
-    """Force reload of face encodings cache"""
-    global face_encodings_cache, cache_timestamp
-    face_encodings_cache = {}
-    cache_timestamp = 0
+    """
+    Force reload of face encodings cache
+    Accepts an optional student_ids list (JSON body or comma-separated form
+    field) to refresh just those students
+    """
+    payload = request.get_json(silent=True) or {}
+    student_ids = payload.get('student_ids') or request.form.get('student_ids')
+    if isinstance(student_ids, str):
+        student_ids = [s for s in student_ids.split(',') if s.strip()]
 
-    load_student_faces()
+    try:
+        student_ids = [int(s) for s in student_ids or []]
+    except (TypeError, ValueError):
+        return jsonify({
+            'status': 'error',
+            'message': 'student_ids must be a list of integers'
+        }), 400
+
+    if shared_gallery is not None:
+        # Pre-fork workers: the parent process owns reloads
+        shared_gallery.request_reload(student_ids or None, full=not student_ids)
+        message = (f'Face encodings refreshed for {len(student_ids)} students' if student_ids
+                   else 'Face encodings cache reloaded')
+    elif student_ids:
+        load_student_faces(student_ids=student_ids)
+        message = f'Face encodings refreshed for {len(student_ids)} students'
+    else:
+        load_student_faces(full=True)
+        message = 'Face encodings cache reloaded'
+
+    return jsonify({
+        'status': 'success',
+        'message': message,
+        'cached_encodings': cached_student_count(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+def enrollment_request(action):
+    """Shared handler of /enroll and /unenroll"""
+    payload = request.get_json(silent=True) or request.form
+    try:
+        student_id = int(payload.get('student_id'))
+    except (TypeError, ValueError):
+        return jsonify({
+            'status': 'error',
+            'message': 'student_id must be an integer'
+        }), 400
 
+    accepted = {
+        'status': 'success',
+        'message': f'Student {student_id} queued for {action}ment',
+        'student_id': student_id
+    }
+    if shared_gallery is not None:
+        # Pre-fork workers: the parent process owns the gallery (and the queue, so no depth to report)
+        shared_gallery.request_enrollment(action, student_id)
+    else:
+        try:
+            queue_enrollment(action, student_id)
+        except queue.Full:
+            response = jsonify({
+                'status': 'error',
+                'message': 'Enrollment queue is full. Please retry shortly.',
+                'timestamp': datetime.now().isoformat()
+            })
+            response.headers['Retry-After'] = '5'
+            return response, 429
+        accepted['queue_depth'] = enrollment_queue.qsize()
+
+    accepted['timestamp'] = datetime.now().isoformat()
+    return jsonify(accepted), 202
+
+@app.route('/enroll', methods=['POST'])
+def enroll():
+    """
+    Encode a newly registered student's photos and add them to the live
+    gallery in the background
+    """
+    return enrollment_request('enroll')
+
+@app.route('/unenroll', methods=['POST'])
+def unenroll():
+    """Remove a student from the live gallery in the background"""
+    return enrollment_request('unenroll')
+
+@app.route('/enroll/<int:student_id>', methods=['GET'])
+def enrollment_status(student_id):
+    """State of a student's latest enroll/unenroll request in this process"""
+    with enrollment_lock:
+        job = dict(enrollment_jobs.get(student_id, {}))
     return jsonify({
         'status': 'success',
-        'message': 'Face encodings cache reloaded',
-        'cached_encodings': len(face_encodings_cache),
+        'student_id': student_id,
+        'enrollment': job or None,
+        'in_gallery': bool(np.isin(student_id, current_gallery().student_ids)),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/session/start', methods=['POST'])
+def session_start():
+    """
+    Warm the roster slice for an attendance session before its first frame.
+    Only a hint: the roster is resolved from attendance_sessions as it would
+    be on the first /recognize call, and in worker mode only the worker
+    handling this request is warmed.
+    """
+    payload = request.get_json(silent=True) or request.form
+    session_id = payload.get('session_id')
+    if not session_id:
+        return jsonify({
+            'status': 'error',
+            'message': 'session_id is required'
+        }), 400
+
+    gallery = current_gallery()
+    try:
+        roster = get_session_roster(session_id, gallery)
+    except Exception as e:
+        logger.warning(f"Could not resolve roster for session {session_id}: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Could not resolve session roster: {str(e)}'
+        }), 500
+
+    if roster is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Session not found'
+        }), 404
+
+    if write_behind.enabled and str(session_id).isdigit():
+        session_present(session_id)
+
+    logger.info(f"Warmed roster of {roster['size']} students for session {session_id}")
+    return jsonify({
+        'status': 'success',
+        'session_id': session_id,
+        'roster_size': roster['size'],
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/session/end', methods=['POST'])
+def session_end():
+    """Free the roster slice of an attendance session"""
+    payload = request.get_json(silent=True) or request.form
+    session_id = payload.get('session_id')
+    if not session_id:
+        return jsonify({
+            'status': 'error',
+            'message': 'session_id is required'
+        }), 400
+
+    with roster_lock:
+        roster = session_rosters.pop(str(session_id), None)
+    with gates_lock:
+        session_gates.pop(str(session_id), None)
+    if str(session_id).isdigit():
+        with attendance_lock:
+            session_attendance.pop(int(session_id), None)
+
+    return jsonify({
+        'status': 'success',
+        'session_id': session_id,
+        'released': roster is not None,
         'timestamp': datetime.now().isoformat()
     })
 
@@ -515,9 +3487,18 @@ def get_stats():
     """Get service statistics"""
     return jsonify({
         'status': 'success',
-        'cached_encodings': len(face_encodings_cache),
-        'cache_age': time.time() - cache_timestamp,
+        'cached_encodings': cached_student_count(),
+        'gallery_memory': (shared_gallery.current() if shared_gallery is not None else face_gallery).memory_usage(
+            face_encodings_cache, gallery_store),
+        'gallery_version': shared_gallery.local_version if shared_gallery is not None else None,
+        'worker_pid': os.getpid(),
+        'cache_age': time.time() - (shared_gallery.local_timestamp if shared_gallery is not None else cache_timestamp),
         'cache_duration': CACHE_DURATION,
+        'refresh': dict(refresh_stats, in_progress=reload_lock.locked()),
+        'live_enrollment': dict(enrollment_stats, queue_depth=enrollment_queue.qsize()),
+        'write_behind': write_behind.snapshot(),
+        'missing_paths': len(missing_paths),
+        'active_sessions': len(session_rosters),
         'config': {
             'tolerance': config.FACE_RECOGNITION_TOLERANCE,
             'min_face_size': config.MIN_FACE_SIZE,
@@ -527,18 +3508,183 @@ def get_stats():
             'center_tolerance': config.CENTER_TOLERANCE,
             'confidence_margin': config.CONFIDENCE_MARGIN,
             'num_jitters': config.NUM_JITTERS,
-            'upsample_factor': config.UPSAMPLE_FACTOR
+            'fast_num_jitters': config.FAST_NUM_JITTERS,
+            'upsample_factor': config.UPSAMPLE_FACTOR,
+            'detection_max_dimension': config.DETECTION_MAX_DIMENSION
         },
+        'preprocess': dict(preprocess_stats),
+        'cascade': dict(cascade_stats,
+                        fast_path=cascade_stats['requests'] - cascade_stats['slow_path']),
+        'detection_timings': {
+            resolution: {
+                'count': stats['count'],
+                'avg_detect_ms': round(stats['detect_ms_total'] / stats['count'], 1),
+                'avg_encode_ms': round(stats['encode_ms_total'] / stats['count'], 1)
+            }
+            for resolution, stats in list(detection_stats.items())
+        },
+        'batching': recognition_batcher.snapshot(),
+        'streams': dict(stream_stats, enabled=Sock is not None),
+        'ann': dict(ann_stats, enabled=ANN_ENABLED, nprobe=ANN_NPROBE, min_templates=ANN_MIN_TEMPLATES),
+        'gates': {session_id: gate.snapshot() for session_id, gate in list(session_gates.items())},
+        'latency': latency_metrics.snapshot(),
+        'enrollment': {key: value for key, value in enrollment_progress.snapshot().items()
+                       if key not in ('failures', 'slowest')},
         'timestamp': datetime.now().isoformat()
     })
 
-if __name__ == '__main__':
-    # Load initial face encodings
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Per-stage latency percentiles and outcome counts; Prometheus text, or JSON with ?format=json"""
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'status': 'success',
+            'worker_pid': os.getpid(),
+            'latency': latency_metrics.snapshot(),
+            'timestamp': datetime.now().isoformat()
+        })
+    return app.response_class(latency_metrics.render_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/enrollment/progress', methods=['GET'])
+def get_enrollment_progress():
+    """Progress of the current or last enrollment pass; ?images=1 adds the per-image report"""
+    return jsonify({
+        'status': 'success',
+        'enrollment': enrollment_progress.snapshot(images=request.args.get('images') == '1'),
+        'timestamp': datetime.now().isoformat()
+    })
+
+def run_worker(channel, listen_fd, port):
+    """Pre-forked worker: serve requests from the shared listening socket"""
+    global shared_gallery, db_pool
+    from werkzeug.serving import make_server
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # Connections inherited from the parent must not be shared
+    db_pool = None
+    shared_gallery = channel
+    channel.current()
+
+    server = make_server('0.0.0.0', port, app, threaded=True, fd=listen_fd)
+    logger.info(f"Worker {os.getpid()} serving gallery version {channel.local_version}")
+    server.serve_forever()
+
+def serve_prefork(port, workers):
+    """
+    Production mode: the parent loads the gallery, binds the port and forks
+    workers that share both. The parent then owns every reload, publishing a
+    new snapshot on expiry or when a worker relays /reload_cache, and
+    restarts workers that exit. Relayed enrollments are applied as a burst
+    and published once; the gallery store is rewritten when the queue is idle.
+    """
+
+    gallery_store.open()
     load_student_faces()
 
+    channel = SharedGallery()
+    channel.publish(face_gallery)
+
+    listener = socket.create_server(('0.0.0.0', port), backlog=128)
+    listener.setblocking(False)  # Workers race for accept(); losers just go back to select()
+
+    context = multiprocessing.get_context('fork')
+    children = {}
+
+    def spawn(slot):
+        process = context.Process(target=run_worker, args=(channel, listener.fileno(), port),
+                                  name=f'face-worker-{slot}', daemon=True)
+        process.start()
+        children[slot] = process
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    for slot in range(workers):
+        spawn(slot)
+    logger.info(f"Face Recognition Service listening on port {port} with {workers} workers")
+
+    unpublished = 0  # Enrollments applied in the parent but not yet in the snapshot
+    burst_started = 0
+    store_stale = False
+    try:
+        while not stopping.is_set():
+            try:
+                reload_request = channel.reloads.get(timeout=1)
+            except queue.Empty:
+                reload_request = None
+
+            if reload_request is not None and 'enrollment' in reload_request:
+                try:
+                    if reload_request['enrollment'] == 'enroll':
+                        enroll_student(reload_request['student_id'])
+                    else:
+                        unenroll_student(reload_request['student_id'])
+                    if not unpublished:
+                        burst_started = time.time()
+                    unpublished += 1
+                    store_stale = True
+                except Exception as e:
+                    logger.error(f"Error in {reload_request['enrollment']} of student {reload_request['student_id']}: {str(e)}")
+                # Apply the rest of a burst before writing the snapshot once
+                if not channel.reloads.empty() and time.time() - burst_started < ENROLL_PUBLISH_DELAY:
+                    continue
+                if unpublished:
+                    channel.publish(face_gallery)
+                    unpublished = 0
+            elif reload_request is not None:
+                load_student_faces(student_ids=reload_request['student_ids'], full=reload_request['full'])
+                channel.publish(face_gallery)
+                unpublished = 0
+            elif unpublished:
+                # The queue emptied while a burst was being applied
+                channel.publish(face_gallery)
+                unpublished = 0
+            elif store_stale:
+                # Idle: write the enrolled changes to the gallery store in one go
+                try:
+                    persist_enrollments()
+                except Exception as e:
+                    logger.warning(f"Could not persist enrolled students: {str(e)}")
+                store_stale = False
+            elif time.time() - cache_timestamp >= CACHE_DURATION:
+                load_student_faces()
+                channel.publish(face_gallery)
+
+            for slot, process in list(children.items()):
+                if not process.is_alive() and not stopping.is_set():
+                    logger.warning(f"Worker {process.pid} exited with {process.exitcode}, restarting")
+                    spawn(slot)
+    finally:
+        for process in children.values():
+            process.terminate()
+        for process in children.values():
+            process.join(5)
+        if store_stale:
+            try:
+                persist_enrollments()
+            except Exception as e:
+                logger.warning(f"Could not persist enrolled students: {str(e)}")
+        listener.close()
+        channel.close()
+
+if __name__ == '__main__':
     # Start Flask app
     port = int(os.getenv('FACE_RECOGNITION_PORT', 5000))
     debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    workers = int(os.getenv('FACE_WORKERS', 0))
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+
+    if workers > 0:
+        serve_prefork(port, workers)
+        sys.exit(0)
+
+    # Map the persisted gallery, then load only what changed since it was written
+    gallery_store.open()
+    load_student_faces()
 
     logger.info(f"Starting Face Recognition Service on port {port}")
     app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
\ No newline at end of file
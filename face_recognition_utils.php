@@ -0,0 +1,44 @@
+<?php
+/**
+ * Face Recognition Service Utilities
+ * Best-effort notifications from the PHP pages to the Python face recognition service
+ */
+
+/**
+ * POST a notification (session start/end, enrollment) to the face recognition service.
+ * Failures are only logged, so pages keep working when the service is down; the
+ * service then catches up on its next gallery refresh or roster load.
+ * @param string $path Service endpoint, e.g. '/enroll'
+ * @param array $payload Form fields to post
+ * @param object|null $logger Logger used instead of error_log when given
+ * @return bool Whether the service answered
+ */
+function notifyFaceRecognitionService(string $path, array $payload, $logger = null): bool {
+    if (!function_exists('curl_init')) {
+        return false;
+    }
+
+    $serviceUrl = rtrim(getenv('FACE_RECOGNITION_URL') ?: 'http://localhost:5000', '/');
+    $ch = curl_init($serviceUrl . $path);
+    curl_setopt_array($ch, [
+        CURLOPT_POST => true,
+        CURLOPT_POSTFIELDS => http_build_query($payload),
+        CURLOPT_RETURNTRANSFER => true,
+        CURLOPT_CONNECTTIMEOUT_MS => 500,
+        CURLOPT_TIMEOUT => 2
+    ]);
+
+    $answered = curl_exec($ch) !== false;
+    if (!$answered) {
+        if ($logger) {
+            $logger->warning('FaceRecognition', "Face recognition service notification $path failed", $payload + [
+                'error' => curl_error($ch)
+            ]);
+        } else {
+            error_log("Face recognition service notification $path failed: " . curl_error($ch));
+        }
+    }
+    curl_close($ch);
+    return $answered;
+}
+?>
@@ -1,48 +1,146 @@
 import sys
+import os
 import json
 import face_recognition
 import cv2
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-# Ensure we have both image paths
-if len(sys.argv) != 3:
-    print(json.dumps({"error": "Usage: python match.py <image1> <image2>"}))
-    sys.exit(1)
+USAGE = ("Usage: python match.py <image1> <image2> | "
+         "python match.py <probe> <candidate>... | <probe> --list <file> | <probe> - "
+         "[--workers N]")
 
-image1_path = sys.argv[1]
-image2_path = sys.argv[2]
+MATCH_THRESHOLD = 0.8  # More lenient threshold
 
-try:
-    # Load both images
-    img1 = face_recognition.load_image_file(image1_path)
-    img2 = face_recognition.load_image_file(image2_path)
+def encode_image(path):
+    """Load an image and return all face encodings found in it"""
+    return face_recognition.face_encodings(face_recognition.load_image_file(path))
 
-    # Encode faces (extract facial embeddings)
-    encodings1 = face_recognition.face_encodings(img1)
-    encodings2 = face_recognition.face_encodings(img2)
-
-    if len(encodings1) == 0 or len(encodings2) == 0:
-        print(json.dumps({"match": False, "score": 0.0, "error": f"No face detected in image 1: {len(encodings1)} faces, image 2: {len(encodings2)} faces"}))
-        sys.exit(0)
-
-    # Compare first face found in each image
-    face1 = encodings1[0]
-    face2 = encodings2[0]
+def encode_candidate(path):
+    """Worker task: (encodings, error message) for one candidate image"""
+    try:
+        return encode_image(path), None
+    except Exception as e:
+        return None, str(e)
 
+def compare(face1, face2):
+    """Score two encodings the way the single-pair mode always has"""
     # Compute Euclidean distance
     distance = np.linalg.norm(face1 - face2)
     # Lower distance = better match. We convert it to similarity score
     # Typical good match threshold: 0.6 or lower
     score = max(0.0, 1.0 - distance)  # Convert distance into a 0-1 similarity
 
-    matched = distance < 0.8  # More lenient threshold
+    matched = distance < MATCH_THRESHOLD
 
-    print(json.dumps({
+    return {
         "match": bool(matched),
         "score": float(score),
         "distance": float(distance)
+    }
+
+def match_pair(image1_path, image2_path):
+    """Original one-to-one mode: a single JSON object"""
+    try:
+        # Load both images and encode faces (extract facial embeddings)
+        encodings1 = encode_image(image1_path)
+        encodings2 = encode_image(image2_path)
+
+        if len(encodings1) == 0 or len(encodings2) == 0:
+            print(json.dumps({"match": False, "score": 0.0, "error": f"No face detected in image 1: {len(encodings1)} faces, image 2: {len(encodings2)} faces"}))
+            sys.exit(0)
+
+        # Compare first face found in each image
+        print(json.dumps(compare(encodings1[0], encodings2[0])))
+
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+
+def match_batch(probe_path, candidates, workers):
+    """
+    One-vs-many mode: the probe is encoded once, candidates in parallel.
+    Emits one JSON line per candidate (input order) and a final summary line.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(candidates) > 1 else None
+    try:
+        results = executor.map(encode_candidate, candidates) if executor else map(encode_candidate, candidates)
+
+        # The probe is encoded while the workers handle the candidates
+        try:
+            probe_encodings = encode_image(probe_path)
+        except Exception as e:
+            print(json.dumps({"error": str(e)}))
+            sys.exit(1)
+
+        best = None
+        errors = 0
+        for index, (path, (encodings, error)) in enumerate(zip(candidates, results)):
+            line = {"index": index, "candidate": path}
+            if error is not None:
+                line["error"] = error
+            elif len(probe_encodings) == 0 or len(encodings) == 0:
+                line.update({"match": False, "score": 0.0, "error": f"No face detected in image 1: {len(probe_encodings)} faces, image 2: {len(encodings)} faces"})
+            else:
+                line.update(compare(probe_encodings[0], encodings[0]))
+                if best is None or line["score"] > best["score"]:
+                    best = line
+
+            if "error" in line:
+                errors += 1
+            print(json.dumps(line))
+            sys.stdout.flush()
+    finally:
+        if executor:
+            executor.shutdown()
+
+    print(json.dumps({
+        "summary": True,
+        "probe_faces": len(probe_encodings),
+        "candidates": len(candidates),
+        "compared": len(candidates) - errors,
+        "errors": errors,
+        "best": best
     }))
 
-except Exception as e:
-    print(json.dumps({"error": str(e)}))
-    sys.exit(1)
+def parse_args(argv):
+    """Return (probe, candidates, workers, batch mode) from the command line"""
+    workers = os.cpu_count() or 1
+    list_file = None
+    positional = []
+
+    args = iter(argv)
+    for arg in args:
+        if arg == '--workers':
+            workers = max(1, int(next(args)))
+        elif arg == '--list':
+            list_file = next(args)
+        else:
+            positional.append(arg)
+
+    if not positional:
+        raise ValueError("missing probe image")
+    probe, candidates = positional[0], positional[1:]
+
+    batch = list_file is not None or candidates == ['-'] or len(candidates) > 1
+    if candidates == ['-']:
+        candidates = [line.strip() for line in sys.stdin if line.strip()]
+    if list_file is not None:
+        with open(list_file) as f:
+            candidates += [line.strip() for line in f if line.strip()]
+
+    if not candidates:
+        raise ValueError("no candidate images")
+    return probe, candidates, workers, batch
+
+if __name__ == '__main__':
+    try:
+        probe_path, candidate_paths, worker_count, batch_mode = parse_args(sys.argv[1:])
+    except (ValueError, StopIteration, OSError):
+        print(json.dumps({"error": USAGE}))
+        sys.exit(1)
+
+    if batch_mode:
+        match_batch(probe_path, candidate_paths, worker_count)
+    else:
+        match_pair(probe_path, candidate_paths[0])
@@ -8,6 +8,7 @@
 require_once 'config.php';
 require_once 'security_utils.php';
 require_once 'backend/classes/Logger.php';
+require_once 'face_recognition_utils.php';
 
 // Rate limiting for registration attempts
 $client_ip = $_SERVER['REMOTE_ADDR'] ?? 'unknown';
@@ -716,6 +717,11 @@ function createStudentRecords($pdo, $studentData, $faceImagePaths, $fingerprintD
 
         $pdo->commit();
 
+        // Make the new face images matchable without waiting for the next gallery refresh
+        if (!empty($faceImagePaths)) {
+            notifyFaceRecognitionService('/enroll', ['student_id' => $studentId], $logger);
+        }
+
         $recordTime = microtime(true) - $recordStartTime;
 
         // Create comprehensive success message
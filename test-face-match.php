@@ -258,6 +258,8 @@ try {
     exit;
 }
 
+// Collect every stored image first so match.py runs once for the whole comparison
+$candidates = [];
 while ($row = $result->fetch(PDO::FETCH_ASSOC)) {
     error_log("Processing student: {$row['reg_no']} (Type: {$row['type']})");
 
@@ -291,73 +293,81 @@ while ($row = $result->fetch(PDO::FETCH_ASSOC)) {
         }
 
         error_log("Image exists: $storedImage");
+        $candidates[] = ['image' => $storedImage, 'row' => $row];
+    }
+}
 
-        // Check if shell_exec is available
-        if (!function_exists('shell_exec')) {
-            error_log("shell_exec function is disabled");
-            $phpMatchResult = compareImagesPHP($imgFile, $storedImage);
-            if ($phpMatchResult && $phpMatchResult['score'] > $bestScore) {
-                $bestScore = $phpMatchResult['score'];
-                $bestMatch = [
-                    'student_id' => $row['id'],
-                    'reg_no' => $row['reg_no'],
-                    'score' => $phpMatchResult['score'],
-                    'distance' => $phpMatchResult['distance'],
-                    'matched' => $phpMatchResult['match']
-                ];
+// Call match.py once: the probe is encoded a single time and the stored images in parallel
+$batchResults = null;
+if (!empty($candidates) && function_exists('shell_exec')) {
+    $listFile = tempnam(sys_get_temp_dir(), 'match_list_');
+    file_put_contents($listFile, implode("\n", array_column($candidates, 'image')) . "\n");
+
+    $command = "python match.py \"$imgFile\" --list \"$listFile\" 2>&1";
+    error_log("Executing command: $command");
+    $output = shell_exec($command);
+    unlink($listFile);
+    error_log("Command output: " . substr($output, 0, 200));
+
+    if ($output !== null && !empty($output) && strpos($output, 'Python was not found') === false) {
+        $batchResults = [];
+        foreach (explode("\n", trim($output)) as $line) {
+            $lineResult = json_decode($line, true);
+            if (is_array($lineResult) && isset($lineResult['index'])) {
+                $batchResults[$lineResult['index']] = $lineResult;
             }
-            continue;
         }
+    }
+} elseif (!function_exists('shell_exec')) {
+    error_log("shell_exec function is disabled");
+}
 
-        // Call match.py script
-        $command = "python match.py \"$imgFile\" \"$storedImage\" 2>&1";
-        error_log("Executing command: $command");
-        $output = shell_exec($command);
-        error_log("Command output: " . substr($output, 0, 200));
-
-        if ($output === null || empty($output) || strpos($output, 'Python was not found') !== false || strpos($output, 'No face detected') !== false) {
-            // Python couldn't detect faces or not available, try PHP-based comparison
-            error_log("Python failed or no faces detected, using PHP comparison for: $storedImage");
-            $phpMatchResult = compareImagesPHP($imgFile, $storedImage);
-            error_log("PHP comparison result: " . json_encode($phpMatchResult));
-
-            // Log the comparison result
-            logFaceRecognitionResult($pdo, $imgFile, $row['id'], $row['reg_no'], $phpMatchResult, 'php_fallback', $row['type']);
-
-            if ($phpMatchResult && $phpMatchResult['score'] > $bestScore) {
-                $bestScore = $phpMatchResult['score'];
-                $bestMatch = [
-                    'student_id' => $row['id'],
-                    'reg_no' => $row['reg_no'],
-                    'score' => $phpMatchResult['score'],
-                    'distance' => $phpMatchResult['distance'],
-                    'matched' => $phpMatchResult['match']
-                ];
-                error_log("New best match: {$row['reg_no']} with score $bestScore");
-            }
-            continue; // Try next image
-        }
+foreach ($candidates as $index => $candidate) {
+    $storedImage = $candidate['image'];
+    $row = $candidate['row'];
 
-        $matchResult = json_decode($output, true);
-        if ($matchResult === null) {
-            // JSON decode failed, use simulation
-            $useSimulation = true;
-            break 2;
-        }
+    if ($batchResults === null || (isset($batchResults[$index]['error']) && strpos($batchResults[$index]['error'], 'No face detected') !== false)) {
+        // Python couldn't detect faces or not available, try PHP-based comparison
+        error_log("Python failed or no faces detected, using PHP comparison for: $storedImage");
+        $phpMatchResult = compareImagesPHP($imgFile, $storedImage);
+        error_log("PHP comparison result: " . json_encode($phpMatchResult));
 
-        // Log the Python comparison result
-        logFaceRecognitionResult($pdo, $imgFile, $row['id'], $row['reg_no'], $matchResult, 'python_face_recognition', $row['type']);
+        // Log the comparison result
+        logFaceRecognitionResult($pdo, $imgFile, $row['id'], $row['reg_no'], $phpMatchResult, 'php_fallback', $row['type']);
 
-        if (isset($matchResult['score']) && $matchResult['score'] > $bestScore) {
-            $bestScore = $matchResult['score'];
+        if ($phpMatchResult && $phpMatchResult['score'] > $bestScore) {
+            $bestScore = $phpMatchResult['score'];
             $bestMatch = [
                 'student_id' => $row['id'],
                 'reg_no' => $row['reg_no'],
-                'score' => $matchResult['score'],
-                'distance' => $matchResult['distance'] ?? 0,
-                'matched' => $matchResult['match'] ?? false
+                'score' => $phpMatchResult['score'],
+                'distance' => $phpMatchResult['distance'],
+                'matched' => $phpMatchResult['match']
             ];
+            error_log("New best match: {$row['reg_no']} with score $bestScore");
         }
+        continue; // Try next image
+    }
+
+    $matchResult = $batchResults[$index] ?? null;
+    if ($matchResult === null) {
+        // No result line for this image, use simulation
+        $useSimulation = true;
+        break;
+    }
+
+    // Log the Python comparison result
+    logFaceRecognitionResult($pdo, $imgFile, $row['id'], $row['reg_no'], $matchResult, 'python_face_recognition', $row['type']);
+
+    if (isset($matchResult['score']) && $matchResult['score'] > $bestScore) {
+        $bestScore = $matchResult['score'];
+        $bestMatch = [
+            'student_id' => $row['id'],
+            'reg_no' => $row['reg_no'],
+            'score' => $matchResult['score'],
+            'distance' => $matchResult['distance'] ?? 0,
+            'matched' => $matchResult['match'] ?? false
+        ];
     }
 }
 
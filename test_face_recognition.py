@@ -2,18 +2,29 @@
 """
 Face Recognition System Test Suite
 Tests the face recognition service functionality
+
+Load mode replays a directory of real frames against /recognize:
+    python test_face_recognition.py [service_url] --load FRAMES_DIR [--concurrency 8] [--rate 20]
+        [--duration 60 | --requests N] [--session-id ID] [--binary] [--output results.json]
+        [--baseline previous.json] [--max-regression 0.2]
 """
 
 import sys
 import os
 import json
 import base64
+import argparse
+import threading
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from PIL import Image, ImageDraw
 import io
 import tempfile
 
+FRAME_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
 class FaceRecognitionTester:
     def __init__(self, service_url='http://localhost:5000'):
         self.service_url = service_url
@@ -310,16 +321,282 @@ class FaceRecognitionTester:
             print(f"❌ Failed to save results: {str(e)}")
 
 
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+class FaceRecognitionLoadTester:
+    """
+    Replays a directory of frames against /recognize at a fixed concurrency
+    and, optionally, a fixed request rate.
+
+    With a rate, requests are sent on a fixed schedule and latency is counted
+    from the scheduled send time, so a slow server is not hidden by the
+    client backing off.
+    """
+
+    def __init__(self, service_url, frames_dir, concurrency=8, rate=None, duration=60,
+                 requests_total=None, binary=False, timeout=30):
+        self.service_url = service_url
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.duration = duration
+        self.requests_total = requests_total
+        self.binary = binary
+        self.timeout = timeout
+        self.frames = self.load_frames(frames_dir)
+        self.local = threading.local()
+
+    def load_frames(self, frames_dir):
+        """Read every frame once up front so disk speed does not skew the run"""
+        frames = []
+        for name in sorted(os.listdir(frames_dir)):
+            if name.lower().endswith(FRAME_EXTENSIONS):
+                with open(os.path.join(frames_dir, name), 'rb') as f:
+                    data = f.read()
+                frames.append({
+                    'name': name,
+                    'bytes': data,
+                    'data_url': 'data:image/jpeg;base64,' + base64.b64encode(data).decode()
+                })
+        if not frames:
+            raise ValueError(f"No {'/'.join(FRAME_EXTENSIONS)} frames found in {frames_dir}")
+        return frames
+
+    def session(self):
+        """One HTTP keep-alive session per client thread"""
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send(self, index, session_id, scheduled_at):
+        """Send one frame; returns the record of how the request went"""
+        frame = self.frames[index % len(self.frames)]
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        sent_at = time.perf_counter()
+        record = {'frame': frame['name'], 'status_code': None, 'outcome': None, 'gate': None, 'error': None}
+        try:
+            if self.binary:
+                params = {'session_id': session_id} if session_id is not None else None
+                response = self.session().post(f"{self.service_url}/recognize", params=params, data=frame['bytes'],
+                                               headers={'Content-Type': 'image/jpeg'}, timeout=self.timeout)
+            else:
+                data = {'image_data': frame['data_url']}
+                if session_id is not None:
+                    data['session_id'] = session_id
+                response = self.session().post(f"{self.service_url}/recognize", data=data, timeout=self.timeout)
+            record['status_code'] = response.status_code
+            if response.status_code == 200:
+                result = response.json()
+                if result.get('recognized'):
+                    record['outcome'] = 'recognized'
+                elif not result.get('faces_detected'):
+                    record['outcome'] = 'no_face'
+                else:
+                    record['outcome'] = 'not_recognized'
+                # Session requests can be answered from the frame gate without running the
+                # pipeline; keep where the answer came from so those are reported apart
+                gate = result.get('gate')
+                if gate:
+                    record['gate'] = gate.get('source') or ('reused' if gate.get('reused') else 'computed')
+        except Exception as e:
+            record['error'] = str(e)
+
+        finished_at = time.perf_counter()
+        # Open-loop runs count the time a request spent waiting for a free client too
+        record['latency_ms'] = (finished_at - (scheduled_at if self.rate else sent_at)) * 1000
+        return record
+
+    def run_phase(self, name, session_id=None):
+        """Run one load phase and summarise it"""
+        print(f"🚀 Load phase '{name}': {self.concurrency} clients, "
+              f"{f'{self.rate} req/s' if self.rate else 'as fast as possible'}, "
+              f"{f'{self.requests_total} requests' if self.requests_total else f'{self.duration}s'}")
+
+        started = time.perf_counter()
+        deadline = started + self.duration if not self.requests_total else None
+        next_index = [0]
+        index_lock = threading.Lock()
+
+        def client():
+            """Take the next request slot until the phase is over"""
+            records = []
+            while True:
+                with index_lock:
+                    index = next_index[0]
+                    next_index[0] += 1
+                if self.requests_total and index >= self.requests_total:
+                    return records
+                scheduled_at = started + index / self.rate if self.rate else time.perf_counter()
+                if deadline and scheduled_at >= deadline:
+                    return records
+                records.append(self.send(index, session_id, scheduled_at))
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            clients = [executor.submit(client) for _ in range(self.concurrency)]
+            records = [record for future in clients for record in future.result()]
+        elapsed = time.perf_counter() - started
+        return self.summarise(name, session_id, records, elapsed)
+
+    @staticmethod
+    def latency_summary(latencies):
+        return {
+            'p50': round(percentile(latencies, 50), 1),
+            'p95': round(percentile(latencies, 95), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'max': round(latencies[-1], 1) if latencies else 0.0,
+            'mean': round(sum(latencies) / len(latencies), 1) if latencies else 0.0
+        }
+
+    def summarise(self, name, session_id, records, elapsed):
+        latencies = sorted(r['latency_ms'] for r in records if r['status_code'] == 200)
+        status_codes = {}
+        outcomes = {}
+        gate_sources = {}
+        for r in records:
+            key = str(r['status_code']) if r['status_code'] is not None else 'transport_error'
+            status_codes[key] = status_codes.get(key, 0) + 1
+            if r['outcome']:
+                outcomes[r['outcome']] = outcomes.get(r['outcome'], 0) + 1
+            if r['gate']:
+                gate_sources[r['gate']] = gate_sources.get(r['gate'], 0) + 1
+        failed = sum(1 for r in records if r['status_code'] != 200)
+        # Requests the gate answered from an earlier result; without a session every request is computed
+        computed = sorted(r['latency_ms'] for r in records
+                          if r['status_code'] == 200 and r['gate'] in (None, 'computed'))
+        reused = sorted(r['latency_ms'] for r in records
+                        if r['status_code'] == 200 and r['gate'] not in (None, 'computed'))
+
+        summary = {
+            'phase': name,
+            'session_id': session_id,
+            'requests': len(records),
+            'successful': len(latencies),
+            'elapsed_seconds': round(elapsed, 2),
+            'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0,
+            'error_rate': round(failed / len(records), 4) if records else 0,
+            'rejected_429': status_codes.get('429', 0),
+            'status_codes': status_codes,
+            'outcomes': outcomes,
+            'gate_sources': gate_sources,
+            'computed': len(computed),
+            'reused': len(reused),
+            'latency_ms': self.latency_summary(latencies),
+            'computed_latency_ms': self.latency_summary(computed),
+            'reused_latency_ms': self.latency_summary(reused),
+            'errors': sorted({r['error'] for r in records if r['error']})[:10]
+        }
+
+        latency = summary['latency_ms']
+        print(f"   {summary['requests']} requests, {summary['throughput_rps']} req/s, "
+              f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+              f"errors {summary['error_rate']:.1%} ({summary['rejected_429']} rejected)")
+        if reused:
+            computed_latency = summary['computed_latency_ms']
+            print(f"   {len(reused)} answered by the frame gate {gate_sources}; "
+                  f"{len(computed)} computed: p50 {computed_latency['p50']} ms, "
+                  f"p95 {computed_latency['p95']} ms, p99 {computed_latency['p99']} ms")
+        return summary
+
+    def server_metrics(self):
+        """The service's own per-stage latency breakdown, if it exposes one"""
+        try:
+            response = requests.get(f"{self.service_url}/metrics", params={'format': 'json'}, timeout=5)
+            if response.status_code == 200:
+                return response.json().get('latency')
+        except Exception:
+            pass
+        return None
+
+def compare_to_baseline(results, baseline, max_regression):
+    """List the phases whose p95/p99 latency or error rate regressed past the allowed ratio"""
+    regressions = []
+    previous = {phase['phase']: phase for phase in baseline.get('phases', [])}
+    for phase in results['phases']:
+        before = previous.get(phase['phase'])
+        if not before:
+            continue
+        # Compare the pipeline's own latency; the share of gate-answered requests varies run to run
+        latency_key = 'computed_latency_ms' if 'computed_latency_ms' in before else 'latency_ms'
+        for key in ('p95', 'p99'):
+            old, new = before[latency_key][key], phase[latency_key][key]
+            if old and new > old * (1 + max_regression):
+                regressions.append(f"{phase['phase']}: {key} latency {old} ms -> {new} ms")
+        if phase['error_rate'] > before['error_rate'] + 0.01:
+            regressions.append(f"{phase['phase']}: error rate {before['error_rate']:.1%} -> {phase['error_rate']:.1%}")
+    return regressions
+
+def run_load_test(args):
+    """Load mode: replay frames, write the results file, compare to a baseline"""
+    tester = FaceRecognitionLoadTester(args.service_url, args.load, concurrency=args.concurrency, rate=args.rate,
+                                       duration=args.duration, requests_total=args.requests, binary=args.binary)
+    print(f"🔗 Load testing {args.service_url} with {len(tester.frames)} frames from {args.load}")
+
+    results = {
+        'service_url': args.service_url,
+        'started_at': datetime.now().isoformat(),
+        'config': {
+            'frames': len(tester.frames),
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'duration': None if args.requests else args.duration,
+            'requests': args.requests,
+            'upload': 'binary' if args.binary else 'base64'
+        },
+        'phases': [tester.run_phase('no_session')]
+    }
+    if args.session_id is not None:
+        results['phases'].append(tester.run_phase('session', args.session_id))
+    results['server_metrics'] = tester.server_metrics()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Load test results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.max_regression)
+        if regressions:
+            print("❌ Latency regressions against the baseline:")
+            for regression in regressions:
+                print(f"   {regression}")
+            sys.exit(1)
+        print("✅ No regressions against the baseline")
+    sys.exit(0)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Face recognition service tests and load harness')
+    parser.add_argument('service_url', nargs='?', default='http://localhost:5000')
+    parser.add_argument('--load', metavar='FRAMES_DIR', help='Replay the frames in this directory against /recognize')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--rate', type=float, help='Requests per second (default: as fast as the clients allow)')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds per phase')
+    parser.add_argument('--requests', type=int, help='Requests per phase instead of a duration')
+    parser.add_argument('--session-id', help='Also run a phase with this session_id')
+    parser.add_argument('--binary', action='store_true', help='Send raw image bodies instead of base64 image_data')
+    parser.add_argument('--output', default='face_recognition_load_results.json')
+    parser.add_argument('--baseline', help='Earlier results file to check for regressions')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Allowed p95/p99 latency increase over the baseline (0.2 = 20%%)')
+    return parser.parse_args(argv)
+
 def main():
     """Main test runner"""
+    args = parse_args(sys.argv[1:])
+    if args.load:
+        run_load_test(args)
+
     print("🤖 Face Recognition System Tester")
     print("This tool tests the face recognition service functionality")
     print()
 
-    # Check if service URL is provided
-    service_url = 'http://localhost:5000'
-    if len(sys.argv) > 1:
-        service_url = sys.argv[1]
+    service_url = args.service_url
 
     print(f"🔗 Testing service at: {service_url}")
     print()
@@ -2,6 +2,7 @@
 /**
  * Database Schema Update Script
  * Adds lecturer_id column to courses table for course assignment functionality
+ * and a unique (session_id, student_id) key to attendance_records
  */
 
 require_once "config.php";
@@ -120,6 +121,42 @@ try {
     }
     echo "</div>";
 
+    // One attendance record per student per session, so concurrent face recognition writers cannot both insert it
+    echo "<div class='card'>";
+    echo "<h2>🔑 Checking Attendance Records Unique Key...</h2>";
+
+    try {
+        $stmt = $pdo->prepare("SHOW INDEX FROM attendance_records WHERE Key_name = 'uq_attendance_session_student'");
+        $stmt->execute();
+        $key_exists = $stmt->fetch();
+
+        if ($key_exists) {
+            echo "<p class='info'>ℹ️ uq_attendance_session_student key already exists</p>";
+        } else {
+            echo "<p class='info'>Removing duplicate attendance records (keeping the earliest)...</p>";
+
+            $removed = $pdo->exec("
+                DELETE dup FROM attendance_records dup
+                JOIN attendance_records keep
+                  ON keep.session_id = dup.session_id
+                 AND keep.student_id = dup.student_id
+                 AND keep.id < dup.id
+            ");
+            echo "<p class='info'>Removed $removed duplicate records</p>";
+
+            $pdo->exec("
+                ALTER TABLE attendance_records
+                ADD UNIQUE KEY uq_attendance_session_student (session_id, student_id)
+            ");
+
+            echo "<p class='success'>✅ uq_attendance_session_student key added successfully</p>";
+        }
+
+    } catch (Exception $e) {
+        echo "<p class='error'>❌ Error adding attendance records key: " . $e->getMessage() . "</p>";
+    }
+    echo "</div>";
+
     // Show final statistics
     echo "<div class='card'>";
     echo "<h2>📈 Final Database Statistics</h2>";